@@ -1,7 +1,9 @@
 from django.contrib import admin
 from django.contrib.auth import get_user_model
 
+from .models import OutgoingEmail
 
 User = get_user_model()
 
 admin.site.register(User)
+admin.site.register(OutgoingEmail)
@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class AccountConfig(AppConfig):
     name = 'account'
+
+    def ready(self):
+        from . import signals  # noqa
+        from django.core.signals import request_started
+        from .outbox import get_options, start_on_first_request
+        # не в ready(): его проходят и migrate, и shell, и любая другая команда
+        if get_options()['IN_PROCESS']:
+            request_started.connect(start_on_first_request, dispatch_uid='email_outbox')
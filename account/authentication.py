@@ -0,0 +1,176 @@
+'''
+TokenAuthentication с кэшем: без запроса Token JOIN User на каждый запрос.
+
+Два уровня:
+    - LRU в памяти процесса (ограничен MAX_ENTRIES, живёт LOCAL_TIMEOUT секунд)
+    - общий кэш из settings.CACHES (SHARED_ALIAS), если задан
+
+Сброс (account/signals.py и UserQuerySet.update) - при удалении токена (logout),
+смене пароля, is_active и is_staff. Одного удаления записи мало: в других воркерах
+она осталась бы в их локальном уровне. Поэтому у каждого токена есть поколение
+в CACHES[GENERATION_ALIAS]: сброс пишет туда новое значение, а запись кэша
+действует, только пока поколение совпадает с тем, что было при её создании -
+это проверяется на каждое попадание. При нескольких воркерах GENERATION_ALIAS
+должен быть общим (redis, memcached), locmem годится только для одного процесса.
+
+Поколение читается до запроса в БД, а сброс повторяется после коммита -
+иначе параллельный запрос мог бы закэшировать старого пользователя под новым поколением.
+'''
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from shop.db_routers import use_primary
+
+DEFAULT_SETTINGS = {
+    'MAX_ENTRIES': 10000,
+    'LOCAL_TIMEOUT': 60,
+    'SHARED_ALIAS': None,
+    'SHARED_TIMEOUT': 300,
+    'GENERATION_ALIAS': 'default',
+}
+
+
+class TokenCache:
+    key_prefix = 'auth-token:'
+    generation_prefix = 'auth-gen:'
+
+    def __init__(self, max_entries, local_timeout, shared_alias=None, shared_timeout=None,
+                 generation_alias='default'):
+        self.max_entries = max_entries
+        self.local_timeout = local_timeout
+        self.shared = caches[shared_alias] if shared_alias else None
+        self.shared_timeout = shared_timeout
+        self.generations = caches[generation_alias]
+        # поколение должно пережить любую запись, созданную до сброса,
+        # в том числе скопированную из общего уровня в локальный
+        self.generation_timeout = local_timeout + (shared_timeout or 0)
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _get_local(self, key):
+        with self._lock:
+            item = self._local.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return entry
+
+    def _set_local(self, key, entry):
+        if self.local_timeout <= 0:
+            return
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.local_timeout, entry)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def generation(self, key):
+        return self.generations.get(self.generation_prefix + key)
+
+    def get(self, key):
+        '''(user, token) или None; каждый раз новые объекты, а не общий экземпляр'''
+        entry, shared = self._get_local(key), False
+        if entry is None and self.shared is not None:
+            entry, shared = self.shared.get(self.key_prefix + key), True
+            if entry is not None:
+                self._set_local(key, entry)
+        if entry is not None:
+            generation, value = entry
+            if generation == self.generation(key):
+                with self._lock:
+                    if shared:
+                        self.shared_hits += 1
+                    else:
+                        self.local_hits += 1
+                return pickle.loads(value)
+            self.delete(key)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, user, token, generation):
+        '''generation - прочитанное до запроса в БД'''
+        entry = (generation, pickle.dumps((user, token), pickle.HIGHEST_PROTOCOL))
+        self._set_local(key, entry)
+        if self.shared is not None:
+            self.shared.set(self.key_prefix + key, entry, self.shared_timeout)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+        if self.shared is not None:
+            self.shared.delete_many([self.key_prefix + key for key in keys])
+
+    def invalidate(self, *keys):
+        '''сброс во всех воркерах: новое поколение + удаление там, где можем'''
+        generation = uuid4().hex
+        self.generations.set_many({self.generation_prefix + key: generation for key in keys},
+                                  self.generation_timeout)
+        self.delete(*keys)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+    def stats(self):
+        with self._lock:
+            hits = self.local_hits + self.shared_hits
+            total = hits + self.misses
+            return {
+                'local_hits': self.local_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': round(hits / total, 4) if total else 0,
+                'local_entries': len(self._local),
+            }
+
+
+def build_token_cache():
+    options = dict(DEFAULT_SETTINGS, **getattr(settings, 'TOKEN_AUTH_CACHE', {}))
+    return TokenCache(options['MAX_ENTRIES'], options['LOCAL_TIMEOUT'],
+                      options['SHARED_ALIAS'], options['SHARED_TIMEOUT'], options['GENERATION_ALIAS'])
+
+
+token_cache = build_token_cache()
+
+
+def invalidate_tokens(*keys):
+    # сразу и ещё раз после коммита, как main.cache.invalidate
+    if keys:
+        token_cache.invalidate(*keys)
+        transaction.on_commit(partial(token_cache.invalidate, *keys))
+
+
+def invalidate_user_tokens(*user_pks):
+    invalidate_tokens(*Token.objects.filter(user__in=user_pks).values_list('key', flat=True))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            return cached
+        generation = token_cache.generation(key)
+        # токен мог только что появиться (логин) или пропасть (логаут) - реплика может отставать
+        with use_primary():
+            user, token = super().authenticate_credentials(key)
+        token_cache.set(key, user, token, generation)
+        return user, token
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from account.models import OneTimeCode
+
+
+class Command(BaseCommand):
+    help = 'Удаляет использованные и просроченные одноразовые коды'
+
+    def handle(self, *args, **options):
+        deleted, _ = OneTimeCode.objects.expired().delete()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} codes'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from account.outbox import run_forever, send_pending
+
+
+class Command(BaseCommand):
+    help = 'Отправляет письма из очереди OutgoingEmail'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='работать постоянно, опрашивая очередь')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='пауза между опросами пустой очереди, сек')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None)
+
+    def handle(self, *args, **options):
+        if options['loop']:
+            run_forever(poll_interval=options['interval'])
+            return
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = send_pending(options['batch_size'], options['workers'])
+            if not sent and not failed:
+                break
+            total_sent += sent
+            total_failed += failed
+        self.stdout.write(self.style.SUCCESS(f'Sent: {total_sent}, failed: {total_failed}'))
@@ -0,0 +1,55 @@
+# Generated by Django 3.1 on 2026-10-18 04:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from datetime import timedelta
+
+from django.utils import timezone
+
+
+def move_codes(apps, schema_editor):
+    '''незавершённые активации/сбросы из User.activation_code'''
+    User = apps.get_model('account', 'User')
+    OneTimeCode = apps.get_model('account', 'OneTimeCode')
+    expires_at = timezone.now() + timedelta(days=1)
+    seen = set()
+    codes = []
+    for email, code, is_active in (User.objects.exclude(activation_code='')
+                                   .values_list('email', 'activation_code', 'is_active').iterator()):
+        purpose = 'password_reset' if is_active else 'activation'
+        if (purpose, code) in seen:
+            continue
+        seen.add((purpose, code))
+        codes.append(OneTimeCode(user_id=email, purpose=purpose, code=code, expires_at=expires_at))
+    OneTimeCode.objects.bulk_create(codes, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0002_outgoing_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OneTimeCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('purpose', models.CharField(choices=[('activation', 'Активация'), ('password_reset', 'Сброс пароля')], max_length=20)),
+                ('code', models.CharField(max_length=8)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField()),
+                ('used_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='codes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('purpose', 'code')},
+            },
+        ),
+        migrations.RunPython(move_codes, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='user',
+            name='activation_code',
+        ),
+    ]
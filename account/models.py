@@ -1,10 +1,30 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
-from django.core.mail import send_mail
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+
+# поля, от которых зависит аутентификация по токену, см. account/authentication.py
+AUTH_FIELDS = ('password', 'is_active', 'is_staff')
+
 
+class UserQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        '''update() идёт мимо post_save - кэш токенов сбрасываем сами'''
+        if not kwargs.keys() & set(AUTH_FIELDS):
+            return super().update(**kwargs)
+        from .authentication import invalidate_user_tokens
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list('pk', flat=True))
+            updated = super().update(**kwargs)
+            invalidate_user_tokens(*pks)
+        return updated
 
 
-class UserManager(BaseUserManager):
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
     def _create_user(self, email, password, **extra_fields):
         if not email:
             raise ValueError('Email is required')
@@ -30,7 +50,6 @@ class User(AbstractBaseUser):
     is_staff = models.BooleanField(default=False)
     first_name = models.CharField(max_length=50, blank=True)
     last_name = models.CharField(max_length=50, blank=True)
-    activation_code = models.CharField(max_length=8, blank=True)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
@@ -40,11 +59,18 @@ class User(AbstractBaseUser):
     def __str__(self):
         return f'{self.email}'
 
-    def create_activation_code(self):
-        from django.utils.crypto import get_random_string
-        code = get_random_string(8, '0123456789')
-        self.activation_code = code
-        self.save()
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # см. account/signals.py - сброс кэша токенов при смене пароля/активности/is_staff
+        instance._loaded_auth_state = instance.auth_state()
+        return instance
+
+    def auth_state(self):
+        return tuple(getattr(self, name) for name in AUTH_FIELDS)
+
+    def create_activation_code(self, purpose=None):
+        return OneTimeCode.objects.issue(self, purpose or CodePurposeChoices.activation).code
 
     def has_module_perms(self, app_label):
         return self.is_staff
@@ -54,9 +80,96 @@ class User(AbstractBaseUser):
 
     @staticmethod
     def send_activation_mail(email, activation_code):
+        from .outbox import queue_mail
         message = f"Thank you for registration. Activation code for your account: {activation_code}"
-        send_mail("Account activation",
-                  message,
-                  'test@gmail.com',
-                  [email, ]
-                  )
+        queue_mail("Account activation",
+                   message,
+                   'test@gmail.com',
+                   [email, ]
+                   )
+
+
+class EmailStatusChoices(models.TextChoices):
+    pending = ('pending', 'В очереди')
+    sent = ('sent', 'Отправлено')
+    failed = ('failed', 'Ошибка')
+
+
+class OutgoingEmail(models.Model):
+    '''очередь писем, отправляется в фоне (account/outbox.py)'''
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    from_email = models.CharField(max_length=254)
+    recipients = models.TextField()
+    status = models.CharField(max_length=15,
+                              choices=EmailStatusChoices.choices,
+                              default=EmailStatusChoices.pending)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f'{self.subject} -> {self.recipients}'
+
+
+
+class CodePurposeChoices(models.TextChoices):
+    activation = ('activation', 'Активация')
+    password_reset = ('password_reset', 'Сброс пароля')
+
+
+class OneTimeCodeQuerySet(models.QuerySet):
+    def issue(self, user, purpose):
+        '''новый код; прежние неиспользованные коды этого назначения гасятся'''
+        now = timezone.now()
+        ttl = settings.ONE_TIME_CODE_TTL[purpose]
+        with transaction.atomic(using=self.db):
+            self.filter(user=user, purpose=purpose, used_at__isnull=True).update(used_at=now)
+            while True:
+                try:
+                    with transaction.atomic(using=self.db):
+                        return self.create(user=user, purpose=purpose,
+                                           code=get_random_string(8, '0123456789'),
+                                           expires_at=now + timedelta(seconds=ttl))
+                except IntegrityError:
+                    # такой код уже есть (пока не вычищен purge_codes) - генерируем другой
+                    continue
+
+    def active(self):
+        return self.filter(used_at__isnull=True, expires_at__gt=timezone.now())
+
+    def verify(self, purpose, code, **user_filters):
+        '''действующий код вместе с пользователем - один запрос по индексу (purpose, code)'''
+        user_filters = {f'user__{key}': value for key, value in user_filters.items()}
+        return self.active().select_related('user').filter(
+            purpose=purpose, code=code, **user_filters
+        ).first()
+
+    def expired(self):
+        return self.filter(models.Q(used_at__isnull=False) | models.Q(expires_at__lte=timezone.now()))
+
+
+class OneTimeCode(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='codes')
+    purpose = models.CharField(max_length=20, choices=CodePurposeChoices.choices)
+    code = models.CharField(max_length=8)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    used_at = models.DateTimeField(blank=True, null=True)
+
+    objects = OneTimeCodeQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['purpose', 'code']
+
+    def consume(self):
+        '''гасит код; False, если его уже успели использовать параллельно'''
+        now = timezone.now()
+        updated = OneTimeCode.objects.filter(pk=self.pk, used_at__isnull=True).update(used_at=now)
+        self.used_at = now
+        return bool(updated)
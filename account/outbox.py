@@ -0,0 +1,158 @@
+'''
+Фоновая отправка писем через таблицу OutgoingEmail.
+
+queue_mail() только пишет строку в таблицу (в транзакции запроса).
+send_pending() забирает пачку готовых к отправке писем, "арендуя" их
+(next_attempt_at сдвигается вперёд, поэтому параллельные отправщики их не возьмут,
+а после падения процесса письма снова станут доступны), делит пачку между
+потоками, каждый поток шлёт свою часть через одно SMTP соединение.
+Ошибки - повтор с экспоненциальной задержкой, после MAX_ATTEMPTS письмо failed.
+
+Запуск: manage.py send_outbox --loop, либо поток в процессе
+(EMAIL_OUTBOX['IN_PROCESS'] = True) - он стартует на первом запросе,
+так что migrate, shell и прочие команды manage.py писем не шлют.
+'''
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.signals import request_started
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutgoingEmail, EmailStatusChoices
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    'IN_PROCESS': False,
+    'WORKERS': 4,
+    'BATCH_SIZE': 100,
+    'MAX_ATTEMPTS': 5,
+    'RETRY_DELAY': 30,
+    'LEASE': 300,
+    'POLL_INTERVAL': 5,
+}
+
+wakeup = threading.Event()
+
+
+def get_options():
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'EMAIL_OUTBOX', {}))
+
+
+def queue_mail(subject, message, from_email, recipient_list):
+    email = OutgoingEmail.objects.create(subject=subject, message=message, from_email=from_email,
+                                         recipients=','.join(recipient_list))
+    # фоновый поток (если запущен) не ждёт следующего опроса
+    transaction.on_commit(wakeup.set)
+    return email
+
+
+def claim_batch(batch_size, lease):
+    now = timezone.now()
+    with transaction.atomic():
+        queryset = OutgoingEmail.objects.filter(status=EmailStatusChoices.pending, next_attempt_at__lte=now)
+        if connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        emails = list(queryset.order_by('next_attempt_at')[:batch_size])
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+            next_attempt_at=now + timedelta(seconds=lease)
+        )
+    return emails
+
+
+def send_chunk(emails):
+    '''одно соединение на всю часть пачки; возвращает (отправленные id, {id: ошибка})'''
+    sent, failed = [], {}
+    try:
+        with get_connection() as smtp:
+            for email in emails:
+                message = EmailMessage(email.subject, email.message, email.from_email,
+                                       email.recipients.split(','), connection=smtp)
+                try:
+                    message.send()
+                    sent.append(email.pk)
+                except Exception as exc:
+                    failed[email.pk] = repr(exc)
+    except Exception as exc:
+        # не удалось открыть/закрыть соединение
+        for email in emails:
+            if email.pk not in sent:
+                failed[email.pk] = repr(exc)
+    return sent, failed
+
+
+def send_pending(batch_size=None, workers=None):
+    '''отправляет одну пачку, возвращает (отправлено, ошибок)'''
+    options = get_options()
+    batch_size = batch_size or options['BATCH_SIZE']
+    workers = workers or options['WORKERS']
+    emails = claim_batch(batch_size, options['LEASE'])
+    if not emails:
+        return 0, 0
+
+    chunks = [emails[i::workers] for i in range(workers) if emails[i::workers]]
+    sent, failed = [], {}
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        for chunk_sent, chunk_failed in pool.map(send_chunk, chunks):
+            sent += chunk_sent
+            failed.update(chunk_failed)
+
+    now = timezone.now()
+    OutgoingEmail.objects.filter(pk__in=sent).update(
+        status=EmailStatusChoices.sent, sent_at=now, attempts=F('attempts') + 1, last_error=''
+    )
+    for email in emails:
+        if email.pk not in failed:
+            continue
+        attempts = email.attempts + 1
+        if attempts >= options['MAX_ATTEMPTS']:
+            status, next_attempt_at = EmailStatusChoices.failed, now
+        else:
+            status = EmailStatusChoices.pending
+            next_attempt_at = now + timedelta(seconds=options['RETRY_DELAY'] * 2 ** email.attempts)
+        OutgoingEmail.objects.filter(pk=email.pk).update(
+            status=status, attempts=attempts, next_attempt_at=next_attempt_at, last_error=failed[email.pk]
+        )
+        logger.warning('Email %s failed (attempt %s): %s', email.pk, attempts, failed[email.pk])
+    return len(sent), len(failed)
+
+
+def run_forever(stop_event=None, poll_interval=None):
+    poll_interval = poll_interval or get_options()['POLL_INTERVAL']
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        close_old_connections()
+        try:
+            sent, failed = send_pending()
+        except Exception:
+            logger.exception('Email outbox iteration failed')
+            sent = failed = 0
+        if not sent and not failed:
+            wakeup.wait(poll_interval)
+            wakeup.clear()
+
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def start_outbox_thread():
+    '''фоновый поток отправки внутри веб-процесса'''
+    global _thread
+    with _thread_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=run_forever, name='email-outbox', daemon=True)
+            _thread.start()
+        return _thread
+
+
+def start_on_first_request(sender, **kwargs):
+    '''обработчик request_started: процесс обслуживает запросы - значит, и письма'''
+    request_started.disconnect(start_on_first_request, dispatch_uid='email_outbox')
+    start_outbox_thread()
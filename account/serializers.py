@@ -1,7 +1,10 @@
-from django.core.mail import send_mail
+from django.db import transaction
 from rest_framework import serializers
 from django.contrib.auth import get_user_model, authenticate
 
+from .models import OneTimeCode, CodePurposeChoices
+from .outbox import queue_mail
+
 User = get_user_model()
 
 
@@ -26,9 +29,10 @@ class RegisterSerializer(serializers.ModelSerializer):
         return attrs
 
     def create(self, validated_data):
-        user = User.objects.create(**validated_data)
-        user.create_activation_code()
-        User.send_activation_mail(user.email, user.activation_code)
+        with transaction.atomic():
+            user = User.objects.create(**validated_data)
+            code = user.create_activation_code()
+            User.send_activation_mail(user.email, code)
         return user
 
 
@@ -39,16 +43,20 @@ class ActivationSerializer(serializers.Serializer):
     def validate(self, attrs):
         email = attrs.get('email')
         activation_code = attrs.get('activation_code')
-        if not User.objects.filter(email=email, activation_code=activation_code).exists():
+        code = OneTimeCode.objects.verify(CodePurposeChoices.activation, activation_code, email=email)
+        if code is None:
             raise serializers.ValidationError('User is not found')
+        attrs['code'] = code
         return attrs
 
     def activate(self):
-        data = self.validated_data
-        user = User.objects.get(**data)
-        user.is_active = True
-        user.activation_code = ''
-        user.save()
+        code = self.validated_data['code']
+        with transaction.atomic():
+            if not code.consume():
+                raise serializers.ValidationError('Activation code was already used')
+            user = code.user
+            user.is_active = True
+            user.save()
 
 
 class LoginSerializer(serializers.Serializer):
@@ -83,9 +91,9 @@ class ForgotPasswordSerializer(serializers.Serializer):
     def send_reset_email(self):
         email = self.validated_data.get('email')
         user = User.objects.get(email=email)
-        user.create_activation_code()
-        message = f"Code for restoring your password {user.activation_code}"
-        send_mail(
+        code = user.create_activation_code(CodePurposeChoices.password_reset)
+        message = f"Code for restoring your password {code}"
+        queue_mail(
             'Password restore',
             message,
             'test@gmail.com',
@@ -99,7 +107,8 @@ class CreateNewPasswordSerializer(serializers.Serializer):
     password_confirm = serializers.CharField(min_length=6, required=True)
 
     def validate_activation_code(self, code):
-        if not User.objects.filter(activation_code=code).exists():
+        self.code = OneTimeCode.objects.verify(CodePurposeChoices.password_reset, code)
+        if self.code is None:
             raise serializers.ValidationError('Activation code seems to be incorrect')
         return code
 
@@ -111,11 +120,13 @@ class CreateNewPasswordSerializer(serializers.Serializer):
         return attrs
 
     def create_pass(self):
-        code = self.validated_data.get('activation_code')
         password = self.validated_data.get('password')
-        user = User.objects.get(activation_code=code)
-        user.set_password(password)
-        user.save()
+        with transaction.atomic():
+            if not self.code.consume():
+                raise serializers.ValidationError('Activation code seems to be incorrect')
+            user = self.code.user
+            user.set_password(password)
+            user.save()
 
 
 class ChangePasswordSerializer(serializers.Serializer):
@@ -123,15 +134,15 @@ class ChangePasswordSerializer(serializers.Serializer):
     new_pass = serializers.CharField(min_length=6, required=True)
     new_pass_confirm = serializers.CharField(min_length=6, required=True)
 
-    def validate_old_pass(self, password):
+    def validate_old_password(self, password):
         request = self.context.get('request')
         if not request.user.check_password(password):
             raise serializers.ValidationError('Password is not correct')
         return password
 
-    def validate_new_pass(self, attrs):
-        pass_ = self.validated_data.get('new_pass')
-        pass_confirm = self.validated_data.get('new_pass_confirm')
+    def validate(self, attrs):
+        pass_ = attrs.get('new_pass')
+        pass_confirm = attrs.get('new_pass_confirm')
         if pass_ != pass_confirm:
             raise serializers.ValidationError('Wrong confirmation of new password')
         return attrs
@@ -0,0 +1,23 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_tokens, invalidate_user_tokens
+
+User = get_user_model()
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    # logout удаляет токен
+    invalidate_tokens(instance.key)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    '''смена/сброс пароля, (де)активация и is_staff сбрасывают закэшированную аутентификацию'''
+    loaded = getattr(instance, '_loaded_auth_state', None)
+    if not created and loaded != instance.auth_state():
+        invalidate_user_tokens(instance.pk)
+    instance._loaded_auth_state = instance.auth_state()
@@ -1,3 +1,175 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from smtplib import SMTPException
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .authentication import TokenCache, token_cache
+from .models import CodePurposeChoices, EmailStatusChoices, OneTimeCode, OutgoingEmail
+from .outbox import queue_mail, send_pending
+
+User = get_user_model()
+
+
+class TokenCacheInvalidationTest(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create('buyer@test.com', '123456', is_active=True)
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        # кэш другого воркера: свой локальный уровень, общие только поколения
+        self.worker = TokenCache(max_entries=100, local_timeout=60)
+
+    def cache_in_worker(self):
+        key = self.token.key
+        self.worker.set(key, self.user, self.token, self.worker.generation(key))
+        self.assertIsNotNone(self.worker.get(key))
+
+    def test_logout_invalidates_other_workers(self):
+        self.cache_in_worker()
+        self.assertEqual(self.client.post('/api/v1/logout/').status_code, 200)
+        self.assertIsNone(self.worker.get(self.token.key))
+        self.assertEqual(self.client.post('/api/v1/logout/').status_code, 401)
+
+    def test_deactivation_through_queryset_update(self):
+        self.cache_in_worker()
+        self.assertEqual(self.client.get('/api/v1/auth_cache_stats/').status_code, 403)
+
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertIsNone(self.worker.get(self.token.key))
+        self.assertEqual(self.client.get('/api/v1/auth_cache_stats/').status_code, 401)
+
+    def test_password_change_invalidates_other_workers(self):
+        self.cache_in_worker()
+        user = User.objects.get(pk=self.user.pk)
+        user.set_password('654321')
+        user.save()
+        self.assertIsNone(self.worker.get(self.token.key))
+
+    def test_staff_change_invalidates(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.client.get('/api/v1/auth_cache_stats/').status_code, 200)
+        self.cache_in_worker()
+
+        user = User.objects.get(pk=self.user.pk)
+        user.is_staff = False
+        user.save()
+        self.assertIsNone(self.worker.get(self.token.key))
+        self.assertEqual(self.client.get('/api/v1/auth_cache_stats/').status_code, 403)
+
+
+class FailingBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise SMTPException('Connection refused')
+
+
+class OutboxTest(TestCase):
+    def test_pending_mail_is_sent_once(self):
+        queue_mail('Hello', 'first', 'shop@test.com', ['a@test.com', 'b@test.com'])
+        queue_mail('Hello', 'second', 'shop@test.com', ['c@test.com'])
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(send_pending(workers=2), (2, 0))
+        self.assertEqual(sorted(message.body for message in mail.outbox), ['first', 'second'])
+        self.assertIn(['a@test.com', 'b@test.com'], [message.to for message in mail.outbox])
+        self.assertFalse(OutgoingEmail.objects.exclude(status=EmailStatusChoices.sent).exists())
+        self.assertEqual(send_pending(), (0, 0))
+
+    @override_settings(EMAIL_BACKEND='account.tests.FailingBackend',
+                       EMAIL_OUTBOX={'MAX_ATTEMPTS': 2, 'RETRY_DELAY': 0})
+    def test_failed_mail_is_retried_then_given_up(self):
+        email = queue_mail('Hello', 'text', 'shop@test.com', ['a@test.com'])
+        with self.assertLogs('account.outbox', 'WARNING') as logs:
+            self.assertEqual(send_pending(), (0, 1))
+        self.assertIn(f'Email {email.pk} failed (attempt 1)', logs.output[0])
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (EmailStatusChoices.pending, 1))
+        self.assertIn('Connection refused', email.last_error)
+
+        with self.assertLogs('account.outbox', 'WARNING'):
+            self.assertEqual(send_pending(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (EmailStatusChoices.failed, 2))
+        self.assertEqual(send_pending(), (0, 0))
+
+    @override_settings(EMAIL_OUTBOX={'IN_PROCESS': True})
+    def test_thread_starts_with_first_request(self):
+        with mock.patch('account.outbox.start_outbox_thread') as start:
+            # ready() проходит любая команда manage.py - поток там не нужен
+            apps.get_app_config('account').ready()
+            start.assert_not_called()
+            self.client.get('/api/v1/categories/')
+            self.client.get('/api/v1/categories/')
+        start.assert_called_once_with()
+
+
+class OneTimeCodeTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create('buyer@test.com', '123456')
+        self.client = APIClient()
+
+    def activate(self, code):
+        return self.client.post('/api/v1/activation/', {'email': self.user.email, 'activation_code': code})
+
+    def reset_password(self, code, password='654321'):
+        return self.client.post('/api/v1/reset_password_complete/', {
+            'activation_code': code, 'password': password, 'password_confirm': password,
+        })
+
+    def test_code_is_used_once(self):
+        code = self.user.create_activation_code()
+        self.assertEqual(self.activate(code).status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_active)
+        self.assertEqual(self.activate(code).status_code, 400)
+
+        code = self.user.create_activation_code(CodePurposeChoices.password_reset)
+        self.assertEqual(self.reset_password(code).status_code, 200)
+        self.assertEqual(self.reset_password(code, 'qwerty').status_code, 400)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('654321'))
+
+    def test_expired_code_is_rejected(self):
+        code = self.user.create_activation_code()
+        OneTimeCode.objects.filter(code=code).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.activate(code).status_code, 400)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+
+    def test_code_for_other_purpose_is_rejected(self):
+        reset_code = self.user.create_activation_code(CodePurposeChoices.password_reset)
+        self.assertEqual(self.activate(reset_code).status_code, 400)
+        activation_code = self.user.create_activation_code()
+        self.assertEqual(self.reset_password(activation_code).status_code, 400)
+        # оба кода по-прежнему годны для своего назначения
+        self.assertEqual(self.activate(activation_code).status_code, 200)
+        self.assertEqual(self.reset_password(reset_code).status_code, 200)
+
+    def test_new_code_replaces_previous(self):
+        old = self.user.create_activation_code()
+        new = self.user.create_activation_code()
+        self.assertEqual(self.activate(old).status_code, 400)
+        self.assertEqual(self.activate(new).status_code, 200)
+
+    def test_purge_removes_only_stale_codes(self):
+        used = OneTimeCode.objects.issue(self.user, CodePurposeChoices.activation)
+        used.consume()
+        expired = OneTimeCode.objects.issue(self.user, CodePurposeChoices.password_reset)
+        OneTimeCode.objects.filter(pk=expired.pk).update(expires_at=timezone.now())
+        active = OneTimeCode.objects.issue(self.user, CodePurposeChoices.activation)
+
+        out = StringIO()
+        call_command('purge_codes', stdout=out)
+        self.assertIn('Deleted 2 codes', out.getvalue())
+        self.assertEqual(list(OneTimeCode.objects.values_list('pk', flat=True)), [active.pk])
@@ -10,4 +10,5 @@ urlpatterns = [
     path('reset_password/', views.ResetPasswordView.as_view()),
     path('reset_password_complete/', views.ResetPasswordCompleteView.as_view()),
     path('change_password/', views.ChangePasswordView.as_view()),
+    path('auth_cache_stats/', views.TokenCacheStatsView.as_view()),
 ]
\ No newline at end of file
@@ -2,9 +2,10 @@ from django.shortcuts import render
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from .authentication import token_cache
 from .serializers import RegisterSerializer, ActivationSerializer, LoginSerializer, ForgotPasswordSerializer, \
     CreateNewPasswordSerializer, ChangePasswordSerializer
 
@@ -48,7 +49,7 @@ class LogoutView(APIView):
 
 class ResetPasswordView(APIView):
     def post(self, request):
-        serializer = ForgotPasswordSerializer
+        serializer = ForgotPasswordSerializer(data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.send_reset_email()
             return Response('Code for password restore was sent to your email', status=status.HTTP_200_OK)
@@ -66,12 +67,19 @@ class ChangePasswordView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        serializer = ChangePasswordSerializer(data=request.data)
+        serializer = ChangePasswordSerializer(data=request.data, context={'request': request})
         if serializer.is_valid(raise_exception=True):
             serializer.set_new_password()
             return Response('Password changes successfully!', status=status.HTTP_200_OK)
 
 
+class TokenCacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(token_cache.stats(), status=status.HTTP_200_OK)
+
+
 class UserProfileView(APIView):
     pass
 
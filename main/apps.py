@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+def ensure_search_schema(sender, using, **kwargs):
+    from .search import ensure_search_schema
+    ensure_search_schema(connections[using])
 
 
 class MainConfig(AppConfig):
     name = 'main'
+
+    def ready(self):
+        from . import signals  # noqa
+        post_migrate.connect(ensure_search_schema, sender=self)
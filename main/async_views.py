@@ -0,0 +1,117 @@
+'''
+Async варианты читающих эндпоинтов для запуска под shop/asgi.py (api/v1/async/...).
+
+ORM в Django 3.1 синхронный, а sync view под ASGI выполняются в одном общем потоке
+(sync_to_async(thread_sensitive=True)) - запросы к БД встают в очередь друг за другом.
+Здесь view остаётся асинхронным, а вся работа с БД (те же вьюсеты DRF: фильтры,
+пагинация, кэш каталога, ETag) уходит в отдельный пул из ASYNC_DB['MAX_CONNECTIONS']
+потоков - это и есть ограничение одновременных соединений с БД.
+Если ждущих больше MAX_WAITING, отвечаем 503 сразу, не копя очередь.
+
+Ответ рендерится тоже в пуле и отдаётся обычным HttpResponse,
+чтобы Django не гонял render() ещё раз через sync_to_async.
+'''
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpResponse, JsonResponse
+
+from .views import ProductViewSet, OrderViewSet
+
+DEFAULT_SETTINGS = {
+    'MAX_CONNECTIONS': 10,
+    'MAX_WAITING': 1000,
+}
+
+
+def get_options():
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'ASYNC_DB', {}))
+
+
+class DBPool:
+    def __init__(self, max_connections, max_waiting):
+        self.max_connections = max_connections
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_connections,
+                                                    thread_name_prefix='async-db')
+            return self._executor
+
+    def is_full(self):
+        return self.waiting >= self.max_connections + self.max_waiting
+
+    async def run(self, func, *args):
+        self.waiting += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # run_in_executor контекст не переносит, а в нём выбор реплики (shop/db_routers.py)
+            # и метрики запроса (shop/instrumentation.py)
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self.executor, partial(context.run, self._call, func, args))
+        finally:
+            self.waiting -= 1
+
+    @staticmethod
+    def _call(func, args):
+        # соединения живут в потоках пула: те же правила CONN_MAX_AGE, что и у обычного запроса
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+
+db_pool = DBPool(**{key.lower(): value for key, value in get_options().items()})
+
+
+def render_view(view, request, args, kwargs):
+    '''выполняет sync view и рендерит ответ - в потоке пула'''
+    # время ожидания свободного потока в view не входит, оно остаётся в total
+    metrics = getattr(request, '_metrics', None)
+    if metrics is not None:
+        metrics.view_started = time.perf_counter()
+    response = view(request, *args, **kwargs)
+    if metrics is not None:
+        metrics.view_finished = time.perf_counter()
+    if not hasattr(response, 'render'):
+        return response
+    response.render()
+    if metrics is not None:
+        metrics.render_finished = time.perf_counter()
+    plain = HttpResponse(response.content, status=response.status_code)
+    for header, value in response.items():
+        plain[header] = value
+    plain.cookies = response.cookies
+    return plain
+
+
+def async_view(view):
+    async def wrapper(request, *args, **kwargs):
+        if db_pool.is_full():
+            response = JsonResponse({'detail': 'Server is busy, try again later'}, status=503)
+            response['Retry-After'] = '1'
+            return response
+        return await db_pool.run(render_view, view, request, args, kwargs)
+    # как у DRF: аутентификация по токену, CSRF не нужен.
+    # не через @csrf_exempt - он делает из корутины обычную функцию
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+product_list = async_view(ProductViewSet.as_view({'get': 'list'}))
+product_detail = async_view(ProductViewSet.as_view({'get': 'retrieve'}, detail=True))
+product_like = async_view(ProductViewSet.as_view({'post': 'like'}, detail=True))
+order_list = async_view(OrderViewSet.as_view({'get': 'list'}))
@@ -0,0 +1,361 @@
+'''
+Нагрузочные замеры API (manage.py benchmark).
+
+seed() заполняет базу синтетическими данными bulk insert-ами: категории, продукты,
+пользователи с токенами, отзывы, лайки, заказы. Данные детерминированы (random.Random(seed)),
+поэтому прогоны на одной и той же машине сравнимы между собой.
+
+run_scenarios() гоняет запросы через django.test.Client в том же процессе (без сети),
+для каждого сценария считает p50/p95/p99, среднее, запросов в секунду и число SQL запросов
+на всех соединениях: GET-и с настроенными репликами читают с них (в manage.py benchmark
+реплики - зеркала тестовой базы).
+compare() сверяет результат с сохранённым baseline: рост p95 больше допуска
+или любой рост числа SQL запросов - регрессия.
+
+run_concurrency() - пропускная способность при N одновременных запросах:
+WSGI (N потоков с django.test.Client), ASGI с обычными view и ASGI с async view
+(api/v1/async/, main/async_views.py) через AsyncClient.
+'''
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connections
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .cache import catalog_cache
+from .models import Category, Product, Review, Order, OrderItems, WishList, DailySales, StatusChoices
+
+User = get_user_model()
+
+SCALES = {
+    'small': {'categories': 10, 'products': 1000, 'users': 100, 'reviews': 5000, 'likes': 3000, 'orders': 2000},
+    'medium': {'categories': 50, 'products': 20000, 'users': 2000, 'reviews': 100000, 'likes': 50000,
+               'orders': 40000},
+    'large': {'categories': 200, 'products': 200000, 'users': 20000, 'reviews': 1000000, 'likes': 500000,
+              'orders': 400000},
+}
+
+WORDS = ('телефон', 'ноутбук', 'чехол', 'зарядка', 'наушники', 'планшет', 'камера', 'колонка',
+         'phone', 'laptop', 'case', 'charger', 'black', 'white', 'pro', 'mini', 'max', 'lite')
+
+BATCH_SIZE = 2000
+
+
+def bulk(model, objects):
+    for start in range(0, len(objects), BATCH_SIZE):
+        model.objects.bulk_create(objects[start:start + BATCH_SIZE])
+
+
+def seed(counts, seed=0):
+    '''заполняет пустую базу, возвращает данные для сценариев'''
+    rng = random.Random(seed)
+    categories = [Category(slug=f'category-{i}', title=f'Category {i}') for i in range(counts['categories'])]
+    bulk(Category, categories)
+
+    bulk(Product, [Product(title=' '.join(rng.sample(WORDS, 3)).capitalize()[:100],
+                           description=' '.join(rng.choices(WORDS, k=30)),
+                           price=rng.randint(100, 100000) / 100,
+                           category_id=rng.choice(categories).slug)
+                   for _ in range(counts['products'])])
+    product_ids = list(Product.objects.values_list('pk', flat=True))
+    prices = dict(Product.objects.values_list('pk', 'price'))
+
+    # один хэш на всех: хэшировать пароль на каждого пользователя слишком долго
+    password = make_password('benchmark')
+    users = [User(email=f'user{i}@bench.local', password=password, is_active=True)
+             for i in range(counts['users'])]
+    users.append(User(email='admin@bench.local', password=password, is_active=True, is_staff=True))
+    bulk(User, users)
+    bulk(Token, [Token(user=user, key=f'{i:040x}') for i, user in enumerate(users)])
+
+    pairs = set()
+    while len(pairs) < min(counts['reviews'], len(users) * len(product_ids)):
+        pairs.add((rng.randrange(len(users) - 1), rng.choice(product_ids)))
+    bulk(Review, [Review(author_id=users[user].email, product_id=product, text=' '.join(rng.choices(WORDS, k=12)),
+                         rating=rng.randint(1, 5))
+                  for user, product in pairs])
+
+    pairs = set()
+    while len(pairs) < min(counts['likes'], len(users) * len(product_ids)):
+        pairs.add((rng.randrange(len(users) - 1), rng.choice(product_ids)))
+    bulk(WishList, [WishList(user_id=users[user].email, product_id=product, is_liked=True)
+                    for user, product in pairs])
+
+    statuses = [StatusChoices.new, StatusChoices.in_progress, StatusChoices.done, StatusChoices.cancelled]
+    for start in range(0, counts['orders'], BATCH_SIZE):
+        orders, items = [], []
+        for _ in range(min(BATCH_SIZE, counts['orders'] - start)):
+            chosen = rng.sample(product_ids, min(len(product_ids), rng.randint(1, 5)))
+            quantities = [rng.randint(1, 3) for _ in chosen]
+            orders.append(Order(user_id=users[rng.randrange(len(users) - 1)].email, status=rng.choice(statuses),
+                                total_sum=sum(prices[pk] * q for pk, q in zip(chosen, quantities))))
+            items.append(list(zip(chosen, quantities)))
+        Order.objects.bulk_create(orders)
+        if orders[0].pk is None:
+            # бэкенд не вернул id (SQLite до 3.35) - последние созданные заказы
+            ids = sorted(Order.objects.order_by('-pk').values_list('pk', flat=True)[:len(orders)])
+            for order, pk in zip(orders, ids):
+                order.pk = pk
+        OrderItems.objects.bulk_create([OrderItems(order_id=order.pk, product_id=pk, quantity=q, price=prices[pk])
+                                        for order, order_items in zip(orders, items) for pk, q in order_items])
+
+    # заказы за последние 90 дней, чтобы отчёты по дням были не из одной строки
+    now = timezone.now()
+    order_ids = list(Order.objects.values_list('pk', flat=True))
+    by_day = {}
+    for pk in order_ids:
+        by_day.setdefault(rng.randrange(90), []).append(pk)
+    for days, ids in by_day.items():
+        for start in range(0, len(ids), BATCH_SIZE):
+            Order.objects.filter(pk__in=ids[start:start + BATCH_SIZE]).update(created_at=now - timedelta(days=days))
+
+    # сигналы на bulk insert не срабатывают - денормализованные поля пересчитываем целиком
+    Product.objects.rebuild_ratings()
+    Product.objects.rebuild_likes_count()
+    Category.objects.refresh_stats()
+    DailySales.objects.rebuild()
+    catalog_cache.invalidate_all()
+
+    return {
+        'product_ids': product_ids,
+        'categories': [category.slug for category in categories],
+        'tokens': [f'{i:040x}' for i in range(len(users) - 1)],
+        'admin_token': f'{len(users) - 1:040x}',
+        'today': timezone.localdate(now),
+    }
+
+
+class Scenario:
+    def __init__(self, name, path, method='get', admin=False, auth=False, data=None, cold=False):
+        self.name = name
+        self.path = path  # функция (rng, data) -> путь
+        self.method = method
+        self.admin = admin
+        self.auth = auth or admin
+        self.data = data  # функция (rng, data) -> тело запроса
+        # cold - перед каждым запросом сбрасывается кэш каталога
+        self.cold = cold
+
+
+def default_scenarios():
+    def product(rng, data):
+        return rng.choice(data['product_ids'])
+
+    def new_order(rng, data):
+        chosen = rng.sample(data['product_ids'], min(3, len(data['product_ids'])))
+        return {'products': [{'product': pk, 'quantity': 1} for pk in chosen]}
+
+    def sales_range(rng, data):
+        return f"date_from={data['today'] - timedelta(days=30)}&date_to={data['today']}"
+
+    return [
+        Scenario('products_list', lambda rng, data: '/api/v1/products/'),
+        Scenario('products_list_cold', lambda rng, data: '/api/v1/products/', cold=True),
+        Scenario('products_filter_cold', lambda rng, data: f"/api/v1/products/?category={rng.choice(data['categories'])}"
+                                                           f"&ordering=-rating", cold=True),
+        Scenario('products_search_cold', lambda rng, data: f'/api/v1/products/?search={rng.choice(WORDS)}', cold=True),
+        Scenario('products_cursor_cold', lambda rng, data: '/api/v1/products/?pagination=cursor&ordering=price',
+                 cold=True),
+        Scenario('product_detail_cold', lambda rng, data: f'/api/v1/products/{product(rng, data)}/', cold=True),
+        Scenario('product_reviews_cold', lambda rng, data: f'/api/v1/products/{product(rng, data)}/reviews/',
+                 cold=True),
+        Scenario('product_like', lambda rng, data: f'/api/v1/products/{product(rng, data)}/like/', method='post',
+                 auth=True),
+        Scenario('wishlist', lambda rng, data: '/api/v1/me/wishlist/', auth=True),
+        Scenario('orders_list', lambda rng, data: '/api/v1/orders/', auth=True),
+        Scenario('orders_list_admin', lambda rng, data: '/api/v1/orders/?pagination=cursor', admin=True),
+        Scenario('order_create', lambda rng, data: '/api/v1/orders/', method='post', auth=True, data=new_order),
+        Scenario('sales_by_day', lambda rng, data: f'/api/v1/analytics/sales/?{sales_range(rng, data)}', admin=True),
+        Scenario('sales_by_product', lambda rng, data: f'/api/v1/analytics/sales/?{sales_range(rng, data)}'
+                                                       f'&group_by=product', admin=True),
+    ]
+
+
+def concurrency_scenarios():
+    '''эндпоинты, у которых есть async вариант'''
+    def product(rng, data):
+        return rng.choice(data['product_ids'])
+
+    return [
+        Scenario('products_list_cold', lambda rng, data: f"/api/v1/products/?page={rng.randint(1, 20)}", cold=True),
+        Scenario('product_detail_cold', lambda rng, data: f'/api/v1/products/{product(rng, data)}/', cold=True),
+        Scenario('orders_list', lambda rng, data: '/api/v1/orders/', auth=True),
+        Scenario('product_like', lambda rng, data: f'/api/v1/products/{product(rng, data)}/like/', method='post',
+                 auth=True),
+    ]
+
+
+@contextmanager
+def capture_queries():
+    '''CaptureQueriesContext на всех соединениях, отдаёт список - len() по каждому'''
+    with ExitStack() as stack:
+        yield [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+
+
+def percentile(values, percent):
+    '''nearest-rank по отсортированному списку'''
+    # ceil, а не round(x + 0.5): round банковский, и на ровных x (p95 из 20) брал бы следующий ранг
+    index = max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def run_scenario(scenario, data, iterations, warmup, seed=0):
+    rng = random.Random(seed)
+    client = Client()
+    durations, queries, errors = [], [], 0
+    started = time.perf_counter()
+    for i in range(warmup + iterations):
+        token = data['admin_token'] if scenario.admin else rng.choice(data['tokens'])
+        headers = {'HTTP_AUTHORIZATION': f'Token {token}'} if scenario.auth else {}
+        path = scenario.path(rng, data)
+        body = scenario.data(rng, data) if scenario.data else None
+        if scenario.cold:
+            catalog_cache.invalidate_all()
+        if i == warmup:
+            started = time.perf_counter()
+        with capture_queries() as captured:
+            request_started = time.perf_counter()
+            if body is None:
+                response = getattr(client, scenario.method)(path, **headers)
+            else:
+                response = getattr(client, scenario.method)(path, body, content_type='application/json', **headers)
+            if hasattr(response, 'streaming_content'):
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - request_started
+        if i < warmup:
+            continue
+        durations.append(elapsed * 1000)
+        queries.append(sum(len(context) for context in captured))
+        if response.status_code >= 400:
+            errors += 1
+    total = time.perf_counter() - started
+    return dict(summarize(durations, errors, total),
+                mean_ms=round(sum(durations) / len(durations), 3), queries=max(queries))
+
+
+def summarize(durations, errors, total):
+    durations = sorted(durations)
+    return {
+        'requests': len(durations),
+        'errors': errors,
+        'p50_ms': round(percentile(durations, 50), 3),
+        'p95_ms': round(percentile(durations, 95), 3),
+        'p99_ms': round(percentile(durations, 99), 3),
+        'rps': round(len(durations) / total, 1) if total else 0,
+    }
+
+
+def make_requests(scenario, data, count, seed, path_prefix=None):
+    '''заранее сгенерированные (путь, токен) - чтобы все режимы гоняли одно и то же'''
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        path = scenario.path(rng, data)
+        if path_prefix:
+            path = path.replace('/api/v1/', path_prefix, 1)
+        token = data['admin_token'] if scenario.admin else rng.choice(data['tokens'])
+        requests.append((path, token if scenario.auth else None))
+    return requests
+
+
+def run_wsgi_concurrent(scenario, requests, concurrency):
+    local = threading.local()
+
+    def call(request):
+        path, token = request
+        client = getattr(local, 'client', None) or Client(raise_request_exception=False)
+        local.client = client
+        headers = {'HTTP_AUTHORIZATION': f'Token {token}'} if token else {}
+        if scenario.cold:
+            catalog_cache.invalidate_all()
+        started = time.perf_counter()
+        response = getattr(client, scenario.method)(path, **headers)
+        return (time.perf_counter() - started) * 1000, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, requests))
+    total = time.perf_counter() - started
+    return summarize([ms for ms, _ in results], sum(status >= 400 for _, status in results), total)
+
+
+def run_asgi_concurrent(scenario, requests, concurrency):
+    async def run():
+        client = AsyncClient(raise_request_exception=False)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(request):
+            path, token = request
+            # AsyncClient в Django 3.1 принимает заголовки только в виде ASGI scope
+            headers = [(b'authorization', f'Token {token}'.encode())] if token else []
+            async with semaphore:
+                if scenario.cold:
+                    catalog_cache.invalidate_all()
+                started = time.perf_counter()
+                response = await getattr(client, scenario.method)(path, headers=headers)
+                return (time.perf_counter() - started) * 1000, response.status_code
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[call(request) for request in requests])
+        return results, time.perf_counter() - started
+
+    results, total = asyncio.run(run())
+    return summarize([ms for ms, _ in results], sum(status >= 400 for _, status in results), total)
+
+
+def run_concurrency(scenarios, data, count, concurrency, seed=0):
+    '''{сценарий: {'wsgi': ..., 'asgi_sync': ..., 'asgi_async': ...}}'''
+    results = {}
+    for scenario in scenarios:
+        requests = make_requests(scenario, data, count, seed)
+        async_requests = make_requests(scenario, data, count, seed, path_prefix='/api/v1/async/')
+        results[scenario.name] = {
+            'wsgi': run_wsgi_concurrent(scenario, requests, concurrency),
+            'asgi_sync': run_asgi_concurrent(scenario, requests, concurrency),
+            'asgi_async': run_asgi_concurrent(scenario, async_requests, concurrency),
+        }
+    return results
+
+
+def run_scenarios(scenarios, data, iterations, warmup, seed=0):
+    return {scenario.name: run_scenario(scenario, data, iterations, warmup, seed) for scenario in scenarios}
+
+
+def compare(results, baseline, tolerance):
+    '''список регрессий (строки) относительно baseline'''
+    problems = []
+    for name, result in results.items():
+        if result['errors']:
+            problems.append(f"{name}: {result['errors']} requests failed")
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['queries'] > base['queries']:
+            problems.append(f"{name}: SQL queries {base['queries']} -> {result['queries']}")
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            problems.append(f"{name}: p95 {base['p95_ms']}ms -> {result['p95_ms']}ms "
+                            f"(more than {tolerance:.0%} slower)")
+    return problems
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)['results']
+
+
+def save_baseline(path, results, meta):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'meta': meta, 'results': results}, file, indent=2, ensure_ascii=False, sort_keys=True)
+        file.write('\n')
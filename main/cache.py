@@ -0,0 +1,245 @@
+'''
+Кэш ответов каталога (ProductViewSet list/retrieve).
+
+Ключ = путь + отсортированные query-параметры + версии.
+Версии: общая для всего каталога, для списков и для каждого продукта.
+Сигналы Product/Review/Category (main/signals.py) поднимают версии,
+старые записи просто перестают читаться и вытесняются LRU/TTL.
+Версия появляется только при подъёме, до этого она 0 - чтение ничего
+не создаёт, иначе каждый product:<pk> из URL оставлял бы в кэше запись навсегда.
+
+Бэкенд задаётся settings.CATALOG_CACHE:
+    'BACKEND': 'lru'    - записи в LRU в памяти процесса (по умолчанию)
+    'BACKEND': 'django' - записи в любом кэше из settings.CACHES ('ALIAS')
+Версии в обоих случаях - в CACHES[VERSIONS_ALIAS]: сброс, сделанный одним воркером,
+должны увидеть все, иначе остальные отдавали бы свой локальный LRU до TIMEOUT.
+Поэтому при нескольких воркерах VERSIONS_ALIAS должен быть общим (redis, memcached),
+locmem годится только для одного процесса. Цена 'lru' - один get_many версий на запрос.
+'''
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from hashlib import md5
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+
+DEFAULT_SETTINGS = {
+    'BACKEND': 'lru',
+    'ALIAS': 'default',
+    'VERSIONS_ALIAS': 'default',
+    'TIMEOUT': 60,
+    'MAX_ENTRIES': 1000,
+}
+
+
+def next_version(current):
+    # от времени, а не current + 1: если версия потерялась (эвикция, рестарт memcached),
+    # новая не совпадёт со старой, и старые ключи не оживут
+    return max(current + 1, int(time.time() * 1000))
+
+
+class LRUCache:
+    # значения хранятся pickle-ом, как в locmem: без ссылок на сериализаторы и без общих мутаций
+    def __init__(self, max_entries, timeout, versions_alias='default'):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        # записи свои у каждого процесса, версии - общие
+        self.versions = SharedVersions(versions_alias, timeout)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get_versions(self, names):
+        return self.versions.get_versions(names)
+
+    def bump_version(self, name):
+        self.versions.bump_version(name)
+
+    def clear(self):
+        # версии общие - их не трогаем, без записей они ничего не держат
+        with self._lock:
+            self._data.clear()
+
+
+class SharedVersions:
+    '''версии в кэше Django - общие для всех воркеров, если общий сам кэш'''
+    version_prefix = 'catalog-version:'
+
+    def __init__(self, alias, timeout):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get_versions(self, names):
+        keys = [self.version_prefix + name for name in names]
+        found = self.cache.get_many(keys)
+        return [found.get(key, 0) for key in keys]
+
+    def bump_version(self, name):
+        # версия живёт дольше любой записи, созданной под предыдущей (TIMEOUT),
+        # после этого её можно забыть - под 0 живых записей уже нет
+        key = self.version_prefix + name
+        self.cache.set(key, next_version(self.cache.get(key, 0)), self.timeout * 2)
+
+
+class DjangoCache:
+    def __init__(self, alias, timeout, versions_alias=None):
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.versions = SharedVersions(versions_alias or alias, timeout)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def get_versions(self, names):
+        return self.versions.get_versions(names)
+
+    def bump_version(self, name):
+        self.versions.bump_version(name)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class CatalogCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def make_key(self, request, version_names):
+        params = sorted((key, sorted(values)) for key, values in request.query_params.lists())
+        raw = f'{request.get_host()}{request.path}?{urlencode(params, doseq=True)}'
+        versions = self.backend.get_versions(version_names)
+        suffix = ':'.join(str(version) for version in versions)
+        return f'catalog:{md5(raw.encode()).hexdigest()}:{suffix}'
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def invalidate_product(self, pk):
+        self.backend.bump_version(f'product:{pk}')
+        self.backend.bump_version('list')
+
+    def invalidate_lists(self):
+        self.backend.bump_version('list')
+
+    def invalidate_all(self):
+        self.backend.bump_version('catalog')
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+def build_catalog_cache():
+    options = dict(DEFAULT_SETTINGS, **getattr(settings, 'CATALOG_CACHE', {}))
+    if options['BACKEND'] == 'django':
+        backend = DjangoCache(options['ALIAS'], options['TIMEOUT'], options['VERSIONS_ALIAS'])
+    elif options['BACKEND'] == 'lru':
+        backend = LRUCache(options['MAX_ENTRIES'], options['TIMEOUT'], options['VERSIONS_ALIAS'])
+    else:
+        raise ValueError(f"Unknown CATALOG_CACHE backend: {options['BACKEND']}")
+    return CatalogCache(backend)
+
+
+catalog_cache = build_catalog_cache()
+
+
+def invalidate(func, *args):
+    # сразу и ещё раз после коммита: иначе параллельный запрос
+    # может успеть закэшировать старые данные под новой версией
+    func(*args)
+    transaction.on_commit(partial(func, *args))
+
+
+class CatalogCacheMixin:
+    '''кэширует list/retrieve вьюсета, ответы помечаются заголовком X-Cache'''
+    cached_actions = ('list', 'retrieve')
+
+    def get_cache_versions(self):
+        versions = ['catalog']
+        if self.detail:
+            versions.append(f'product:{self.kwargs[self.lookup_url_kwarg or self.lookup_field]}')
+        else:
+            versions.append('list')
+        return versions
+
+    def is_cacheable(self, request):
+        return request.method == 'GET' and self.action in self.cached_actions
+
+    def cached(self, handler, request, *args, **kwargs):
+        if not self.is_cacheable(request):
+            return handler(request, *args, **kwargs)
+        key = catalog_cache.make_key(request, self.get_cache_versions())
+        data = catalog_cache.get(key)
+        if data is not None:
+            response = Response(data)
+            response['X-Cache'] = 'HIT'
+            return response
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            catalog_cache.set(key, response.data)
+        response['X-Cache'] = 'MISS'
+        return response
+
+    def cached_value(self, request, name, compute):
+        '''значение для запроса под теми же версиями, что и ответ (в статистику не идёт)'''
+        key = f'{catalog_cache.make_key(request, self.get_cache_versions())}:{name}'
+        value = catalog_cache.backend.get(key)
+        if value is None:
+            value = compute()
+            catalog_cache.backend.set(key, value)
+        return value
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(super().retrieve, request, *args, **kwargs)
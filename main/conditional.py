@@ -0,0 +1,129 @@
+'''
+Conditional GET (ETag / Last-Modified) для list/retrieve.
+
+Валидатор считается одним агрегатным запросом (Max по полям updated_at + Count)
+по тому же отфильтрованному queryset, что и ответ, поэтому 304 отдаётся
+без выборки объектов и без сериализации. Во вьюсетах с CatalogCacheMixin
+результат запроса кэшируется под теми же версиями, что и сам ответ,
+и на попадании в кэш запросов к БД нет совсем.
+
+Если conditional_fields идут через связь "многие" (items__product__updated_at),
+агрегат - это join по всей отфильтрованной таблице ещё до пагинации.
+Тогда conditional_per_page: list сначала выбирает страницу (с prefetch, как для ответа),
+валидатор считается в Python по её объектам, 304 - без сериализации.
+'''
+import calendar
+from functools import partial
+from hashlib import md5
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+
+def collect_values(objects, path):
+    '''значения поля по пути через связи (в т.ч. "многие" - из prefetch), None пропускаются'''
+    for attr in path.split('__'):
+        values = []
+        for obj in objects:
+            value = getattr(obj, attr)
+            if hasattr(value, 'all'):
+                values.extend(value.all())
+            elif value is not None:
+                values.append(value)
+        objects = values
+    return objects
+
+
+class ConditionalGetMixin:
+    # поля, изменение которых меняет представление (можно через связи)
+    conditional_fields = ('updated_at',)
+    conditional_actions = ('list', 'retrieve')
+    # list: валидатор по объектам запрошенной страницы, а не агрегатом по всему queryset
+    conditional_per_page = False
+
+    def get_validator_queryset(self):
+        queryset = self.get_queryset()
+        if self.action == 'retrieve':
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            return queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return self.filter_queryset(queryset)
+
+    def aggregate_validators(self):
+        aggregates = {f'max_{i}': Max(field) for i, field in enumerate(self.conditional_fields)}
+        return self.get_validator_queryset().order_by().aggregate(
+            objects_count=Count('pk', distinct=True), **aggregates
+        )
+
+    def get_validators(self, request):
+        try:
+            if hasattr(self, 'cached_value') and self.is_cacheable(request):
+                values = self.cached_value(request, 'validators', self.aggregate_validators)
+            else:
+                values = self.aggregate_validators()
+        except (TypeError, ValueError, ValidationError):
+            # pk не того типа (products/abc/) - 404 отдаст сам handler, как в get_object
+            return None, None
+        if self.action == 'retrieve' and not values['objects_count']:
+            return None, None
+        return self.make_validators(request, values)
+
+    def make_validators(self, request, values):
+        dates = [value for key, value in values.items() if key.startswith('max_') and value]
+        last_modified = max(dates) if dates else None
+        user = request.user.pk if request.user.is_authenticated else ''
+        raw = '|'.join([request.get_full_path(), str(user)] +
+                       [str(value) for value in sorted(values.items())])
+        etag = f'"{md5(raw.encode()).hexdigest()}"'
+        return etag, last_modified
+
+    def conditional(self, handler, request, *args, **kwargs):
+        if request.method != 'GET' or self.action not in self.conditional_actions:
+            return handler(request, *args, **kwargs)
+        etag, last_modified = self.get_validators(request)
+        if etag is None:
+            return handler(request, *args, **kwargs)
+        return self.conditional_response(request, etag, last_modified, partial(handler, request, *args, **kwargs))
+
+    def conditional_response(self, request, etag, last_modified, handler):
+        timestamp = calendar.timegm(last_modified.utctimetuple()) if last_modified else None
+        response = get_conditional_response(request._request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = handler()
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if timestamp is not None:
+                response['Last-Modified'] = http_date(timestamp)
+        return response
+
+    def page_validators(self, objects):
+        '''то же, что aggregate_validators, но по уже выбранным объектам страницы'''
+        values = {f'max_{i}': max(collect_values(objects, field), default=None)
+                  for i, field in enumerate(self.conditional_fields)}
+        values['objects'] = [obj.pk for obj in objects]
+        # в ответе постраничной пагинации есть count
+        page = getattr(self.paginator, 'page', None)
+        values['objects_count'] = page.paginator.count if page is not None else len(objects)
+        return values
+
+    def list_per_page(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        objects = page if page is not None else list(queryset)
+
+        def respond():
+            data = self.get_serializer(objects, many=True).data
+            return self.get_paginated_response(data) if page is not None else Response(data)
+
+        etag, last_modified = self.make_validators(request, self.page_validators(objects))
+        return self.conditional_response(request, etag, last_modified, respond)
+
+    def list(self, request, *args, **kwargs):
+        if self.conditional_per_page and request.method == 'GET' and 'list' in self.conditional_actions:
+            return self.list_per_page(request)
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
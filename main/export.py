@@ -0,0 +1,91 @@
+'''
+Потоковая выгрузка заказов (orders/export/) в CSV или NDJSON.
+
+Заказы читаются через .iterator() - на PostgreSQL это серверный курсор,
+строки приходят пачками по chunk_size; позиции догружаются одним запросом
+на пачку. В памяти только текущая пачка, ответ отдаётся по мере чтения.
+
+CSV - строка на позицию (поля заказа повторяются), заказ без позиций - одна строка.
+NDJSON - объект заказа на строку, позиции списком items.
+
+Под ASGI Django 3.1 перебирает streaming_content прямо в event loop, где ORM
+запрещён (SynchronousOnlyOperation). Поэтому shop/asgi.py использует свой
+ASGIHandler (shop/handlers.py): каждая пачка читается через sync_to_async
+и сразу уходит клиенту.
+'''
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import OrderItems
+
+ORDER_FIELDS = ('id', 'user_id', 'status', 'total_sum', 'created_at', 'updated_at', 'notes')
+ITEM_FIELDS = ('product_id', 'product__title', 'price', 'quantity')
+CSV_HEADER = ('order_id', 'user', 'status', 'total_sum', 'created_at', 'updated_at', 'notes',
+              'product_id', 'product_title', 'price', 'quantity')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def iter_chunks(queryset, chunk_size):
+    '''пачки заказов (dict) вместе с их позициями'''
+    chunk = []
+    for order in queryset.values(*ORDER_FIELDS).iterator(chunk_size=chunk_size):
+        chunk.append(order)
+        if len(chunk) >= chunk_size:
+            yield attach_items(chunk, queryset.db)
+            chunk = []
+    if chunk:
+        yield attach_items(chunk, queryset.db)
+
+
+def attach_items(orders, using):
+    by_id = {order['id']: order for order in orders}
+    for order in orders:
+        order['items'] = []
+    items = OrderItems.objects.using(using).filter(order_id__in=list(by_id)).order_by('order_id', 'pk')
+    for item in items.values('order_id', *ITEM_FIELDS):
+        by_id[item.pop('order_id')]['items'].append(item)
+    return orders
+
+
+class Echo:
+    '''csv.writer пишет сюда и сразу получает строку обратно'''
+    def write(self, value):
+        return value
+
+
+def export_csv(queryset, chunk_size):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for orders in iter_chunks(queryset, chunk_size):
+        lines = []
+        for order in orders:
+            head = [order[field] for field in ORDER_FIELDS]
+            head[4], head[5] = order['created_at'].isoformat(), order['updated_at'].isoformat()
+            for item in order['items'] or [dict.fromkeys(ITEM_FIELDS, '')]:
+                lines.append(writer.writerow(head + [item[field] for field in ITEM_FIELDS]))
+        yield ''.join(lines)
+
+
+def export_ndjson(queryset, chunk_size):
+    for orders in iter_chunks(queryset, chunk_size):
+        lines = []
+        for order in orders:
+            data = {'id': order['id'], 'user': order['user_id']}
+            data.update((field, order[field]) for field in ORDER_FIELDS[2:])
+            data['items'] = [{'product': item['product_id'], 'title': item['product__title'],
+                              'price': item['price'], 'quantity': item['quantity']}
+                             for item in order['items']]
+            lines.append(json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+        yield ''.join(lines)
+
+
+EXPORTERS = {
+    'csv': export_csv,
+    'ndjson': export_ndjson,
+}
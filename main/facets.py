@@ -0,0 +1,108 @@
+'''
+Фасеты для списка продуктов: products/?facets=category,price,rating
+
+Считаются по тому же отфильтрованному queryset (ProductFilter), что и страница,
+и отдаются рядом с results в поле facets:
+    - category - кол-во продуктов по категориям, один GROUP BY
+    - price    - кол-во по интервалам цены [от, до), последний без верхней границы
+    - rating   - кол-во продуктов с рейтингом не ниже порога ("4 и выше"), без отзывов не считаются
+price и rating считаются одним агрегатным запросом: Count(filter=...) на каждый интервал.
+
+Границы цен - settings.PRODUCT_FACETS['PRICE_BUCKETS'],
+клиент может передать свои: price_buckets=0,1000,5000
+'''
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Count, Q
+from rest_framework.exceptions import ValidationError
+
+# price - DecimalField(max_digits=10, decimal_places=2): границы больше не влезут в поле
+MAX_PRICE = Decimal(10) ** 8
+
+DEFAULT_SETTINGS = {
+    'PRICE_BUCKETS': (0, 100, 500, 1000, 5000),
+    'RATING_BANDS': (4, 3, 2, 1),
+    'MAX_PRICE_BUCKETS': 20,
+}
+
+FACETS = ('category', 'price', 'rating')
+
+
+def get_options():
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'PRODUCT_FACETS', {}))
+
+
+def parse_facets(value):
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in FACETS]
+    if unknown:
+        raise ValidationError({'facets': f'Unknown facets: {unknown}, expected: {", ".join(FACETS)}'})
+    return list(dict.fromkeys(names))
+
+
+def parse_price_buckets(value, max_buckets):
+    try:
+        edges = [Decimal(edge) for edge in value.split(',') if edge.strip()]
+    except InvalidOperation:
+        raise ValidationError({'price_buckets': 'Expected comma separated numbers'})
+    if not edges or len(edges) > max_buckets or any(not edge.is_finite() or edge < 0 for edge in edges):
+        raise ValidationError({'price_buckets': f'Expected from 1 to {max_buckets} non-negative numbers'})
+    if max(edges) >= MAX_PRICE:
+        raise ValidationError({'price_buckets': f'Bucket edges must be less than {MAX_PRICE}'})
+    if edges != sorted(set(edges)):
+        raise ValidationError({'price_buckets': 'Bucket edges must be increasing'})
+    return edges
+
+
+def price_ranges(edges):
+    '''[(от, до)]: до первой границы (если она больше 0), между границами и после последней'''
+    edges = [Decimal(edge) for edge in edges]
+    bounds = ([None] if edges[0] > 0 else []) + edges + [None]
+    return list(zip(bounds, bounds[1:]))
+
+
+def money(value):
+    return None if value is None else str(value.quantize(Decimal('0.01')))
+
+
+def count_categories(queryset):
+    rows = (queryset.values('category', 'category__title').annotate(count=Count('pk'))
+            .order_by('category__title'))
+    return [{'slug': row['category'], 'title': row['category__title'], 'count': row['count']} for row in rows]
+
+
+def count_ranges(queryset, ranges, bands):
+    aggregates = {}
+    for i, (low, high) in enumerate(ranges):
+        condition = Q()
+        if low is not None:
+            condition &= Q(price__gte=low)
+        if high is not None:
+            condition &= Q(price__lt=high)
+        aggregates[f'price_{i}'] = Count('pk', filter=condition)
+    for i, band in enumerate(bands):
+        aggregates[f'rating_{i}'] = Count('pk', filter=Q(rating_count__gt=0, rating__gte=band))
+    counts = queryset.aggregate(**aggregates)
+    price = [{'from': money(low), 'to': money(high), 'count': counts[f'price_{i}']}
+             for i, (low, high) in enumerate(ranges)]
+    rating = [{'from': band, 'count': counts[f'rating_{i}']} for i, band in enumerate(bands)]
+    return price, rating
+
+
+def compute_facets(queryset, names, price_edges=None):
+    '''names - из parse_facets, queryset - отфильтрованный, сортировка не важна'''
+    options = get_options()
+    queryset = queryset.order_by()
+    facets = {}
+    if 'category' in names:
+        facets['category'] = count_categories(queryset)
+    if 'price' in names or 'rating' in names:
+        ranges = price_ranges(price_edges or options['PRICE_BUCKETS']) if 'price' in names else []
+        bands = options['RATING_BANDS'] if 'rating' in names else []
+        price, rating = count_ranges(queryset, ranges, bands)
+        if 'price' in names:
+            facets['price'] = price
+        if 'rating' in names:
+            facets['rating'] = rating
+    return facets
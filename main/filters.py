@@ -1,23 +1,35 @@
 '''
 Продукты могут фильтроваться по категории, по названию|описанию,
-про цене(дороже, дешевле)
+про цене(дороже, дешевле), по рейтингу (не ниже), а также искаться полнотекстово (search=)
 
 Заказы могут фильтроваться (по продукту, по дате, по сумме)
 '''
 import django_filters
 from django_filters.rest_framework import FilterSet
 from main.models import Product, Order
+from main.search import filter_field, search_products
 
 
 class ProductFilter(FilterSet):
-    title = django_filters.CharFilter(field_name='title', lookup_expr='icontains')
-    description = django_filters.CharFilter(field_name='description', lookup_expr='icontains')
+    # по индексу поиска, см. main/search.py filter_field
+    title = django_filters.CharFilter(method='filter_field')
+    description = django_filters.CharFilter(method='filter_field')
     price_from = django_filters.NumberFilter(field_name='price', lookup_expr='gte')
     price_to = django_filters.NumberFilter(field_name='price', lookup_expr='lte')
+    # для фасета rating: "4 и выше"
+    rating_from = django_filters.NumberFilter(field_name='rating', lookup_expr='gte')
+    search = django_filters.CharFilter(method='filter_search')
 
     class Meta:
         model = Product
-        fields = ('category', 'title', 'description', 'price_from', 'price_to')
+        fields = ('category', 'title', 'description', 'price_from', 'price_to', 'rating_from', 'search')
+
+    def filter_field(self, queryset, name, value):
+        return filter_field(queryset, name, value)
+
+    def filter_search(self, queryset, name, value):
+        '''результаты отсортированы по релевантности, если не передан ordering'''
+        return search_products(queryset, value)
 
 
 class OrderFilter(FilterSet):
@@ -26,7 +38,7 @@ class OrderFilter(FilterSet):
     total_sum_from = django_filters.NumberFilter(field_name='total_sum', lookup_expr='gte')
     total_sum_to = django_filters.NumberFilter(field_name='total_sum', lookup_expr='lte')
     created_at = django_filters.DateTimeFromToRangeFilter(field_name='created_at')
-    product = django_filters.CharFilter(field_name='products__product__title', lookup_expr='icontains')
+    product = django_filters.CharFilter(field_name='items__product__title', lookup_expr='icontains', distinct=True)
 
     class Meta:
         model = Order
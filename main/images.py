@@ -0,0 +1,184 @@
+'''
+Уменьшенные копии Product.image (renditions) для srcset.
+
+render_image() - чистый Pillow без Django, выполняется в пуле процессов:
+на вход байты оригинала, на выход байты копий в нескольких ширинах и форматах,
+ориентация из EXIF применяется, сами EXIF данные не сохраняются.
+Файлы кладутся рядом с оригиналом: products/renditions/<имя>_<ширина>w.<ext>,
+карта путей хранится в Product.renditions: {'webp': {'200': path}, 'jpeg': {...}}.
+
+Генерация запускается после сохранения продукта с новой картинкой (main/signals.py),
+для уже загруженных картинок - manage.py generate_renditions. Копии прежней картинки
+удаляются при её замене и при удалении продукта.
+'''
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    'SIZES': (200, 400, 800),
+    'FORMATS': ('webp', 'jpeg'),
+    'QUALITY': 80,
+    'WORKERS': 2,
+    'ASYNC': True,
+}
+
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def get_options():
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'IMAGE_RENDITIONS', {}))
+
+
+def render_image(data, sizes, formats, quality):
+    '''[(ширина, формат, байты)]; больше оригинала не увеличиваем'''
+    from PIL import Image, ImageOps
+
+    image = Image.open(BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    rgb = image.convert('RGB')
+    if has_alpha:
+        rgba = image.convert('RGBA')
+        # JPEG без прозрачности - на белом фоне
+        rgb = Image.new('RGB', rgba.size, (255, 255, 255))
+        rgb.paste(rgba, mask=rgba.split()[3])
+
+    widths = sorted({min(size, image.width) for size in sizes})
+    result = []
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        for fmt in formats:
+            source = rgba if fmt == 'webp' and has_alpha else rgb
+            resized = source.resize((width, height), Image.LANCZOS) if width != image.width else source
+            buffer = BytesIO()
+            # exif не передаётся - в копиях его нет
+            if fmt == 'jpeg':
+                resized.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+            else:
+                resized.save(buffer, 'WEBP', quality=quality, method=4)
+            result.append((width, fmt, buffer.getvalue()))
+    return result
+
+
+_executor = None
+_savers = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: веб-процесс многопоточный, fork из него небезопасен
+            _executor = ProcessPoolExecutor(max_workers=get_options()['WORKERS'],
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def get_savers():
+    '''потоки, которые дожидаются пула процессов и пишут результат в storage и БД'''
+    global _savers
+    with _executor_lock:
+        if _savers is None:
+            _savers = ThreadPoolExecutor(max_workers=get_options()['WORKERS'],
+                                         thread_name_prefix='renditions')
+        return _savers
+
+
+def rendition_name(image_name, width, fmt):
+    directory, filename = os.path.split(image_name)
+    stem = os.path.splitext(filename)[0]
+    return f'{directory}/renditions/{stem}_{width}w.{EXTENSIONS[fmt]}'
+
+
+def delete_renditions(renditions):
+    for paths in renditions.values():
+        for path in paths.values():
+            default_storage.delete(path)
+
+
+def save_renditions(product_id, image_name, rendered):
+    '''пишет файлы и карту путей в продукт; вызывается в основном процессе'''
+    from .cache import catalog_cache
+    from .models import Product
+
+    product = Product.objects.filter(pk=product_id).only('image', 'renditions').first()
+    if product is None or product.image.name != image_name:
+        # продукт удалён или картинку уже заменили - эти копии не нужны
+        return None
+    renditions = {}
+    for width, fmt, data in rendered:
+        name = rendition_name(image_name, width, fmt)
+        default_storage.delete(name)
+        renditions.setdefault(fmt, {})[str(width)] = default_storage.save(name, ContentFile(data))
+    delete_renditions({fmt: {width: path for width, path in paths.items()
+                             if path not in renditions.get(fmt, {}).values()}
+                       for fmt, paths in product.renditions.items()})
+    # srcset в ответе поменялся - updated_at сдвигаем, иначе ETag/Last-Modified останутся старыми
+    Product.objects.filter(pk=product_id).update(renditions=renditions, updated_at=timezone.now())
+    catalog_cache.invalidate_product(product_id)
+    return renditions
+
+
+def read_image(image_name):
+    with default_storage.open(image_name, 'rb') as file:
+        return file.read()
+
+
+def submit(image_name, executor=None):
+    '''отправляет картинку в пул процессов, возвращает future с байтами копий'''
+    options = get_options()
+    executor = executor or get_executor()
+    return executor.submit(render_image, read_image(image_name),
+                           options['SIZES'], options['FORMATS'], options['QUALITY'])
+
+
+def save_rendered(product_id, image_name, future):
+    '''выполняется в get_savers(): соединение с БД у потока своё - закрываем сами'''
+    try:
+        return save_renditions(product_id, image_name, future.result())
+    except Exception:
+        logger.exception('Failed to generate renditions for product %s', product_id)
+        raise
+    finally:
+        connections.close_all()
+
+
+def generate_renditions(product_id, image_name):
+    '''
+    после загрузки картинки: в фоне (ASYNC) или сразу.
+    В фоне возвращает future, его result() - карта путей или исключение генерации
+    '''
+    options = get_options()
+    if not options['ASYNC']:
+        rendered = render_image(read_image(image_name), options['SIZES'],
+                                options['FORMATS'], options['QUALITY'])
+        return save_renditions(product_id, image_name, rendered)
+    # не в done-callback: тот выполняется в служебном потоке пула процессов
+    return get_savers().submit(save_rendered, product_id, image_name, submit(image_name))
+
+
+def build_srcset(renditions, request=None):
+    '''{'webp': 'url 200w, url 400w', 'jpeg': ...}'''
+    srcset = {}
+    for fmt, paths in renditions.items():
+        items = []
+        for width, path in sorted(paths.items(), key=lambda item: int(item[0])):
+            url = default_storage.url(path)
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            items.append(f'{url} {width}w')
+        srcset[fmt] = ', '.join(items)
+    return srcset
@@ -0,0 +1,219 @@
+'''
+Потоковый импорт каталога из фида поставщика (manage.py import_products).
+
+Файл читается построчно (CSV с заголовком или JSONL), в памяти - только текущая пачка.
+Колонки: sku, title, description, price, category (slug), category_title, image.
+Продукт ищется по sku: найден - обновляется, нет - создаётся.
+Категория ищется по slug, новая создаётся с category_title (или slug, если его нет),
+у существующей title меняется, только если category_title передан.
+Название категории уникально: занятый другой категорией category_title - ошибка строки,
+занятый slug без category_title - к названию добавляется номер: "phones (2)".
+
+Каждая пачка - отдельная транзакция через bulk_create/bulk_update,
+поэтому сигналы не срабатывают: сводка по категориям пересчитывается в каждой пачке,
+кэш каталога сбрасывается один раз в конце,
+поисковый индекс поддерживают триггеры в БД, копии картинок - generate_renditions.
+'''
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import catalog_cache
+from .models import Category, Product
+
+UPDATE_FIELDS = ('title', 'description', 'price', 'category', 'image', 'renditions', 'updated_at')
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_rows(file, fmt):
+    '''(номер строки, dict)'''
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                yield number, RowError(f'invalid json: {exc}')
+                continue
+            yield number, row if isinstance(row, dict) else RowError('row is not an object')
+
+
+def clean_row(row):
+    def value(name):
+        raw = row.get(name)
+        return '' if raw is None else str(raw).strip()
+
+    sku = value('sku')
+    if not sku:
+        raise RowError('sku is required')
+    if len(sku) > Product._meta.get_field('sku').max_length:
+        raise RowError('sku is too long')
+    title = value('title')
+    if not title or len(title) > Product._meta.get_field('title').max_length:
+        raise RowError('title is empty or too long')
+    try:
+        price = Decimal(value('price'))
+    except InvalidOperation:
+        raise RowError(f'invalid price: {value("price")!r}')
+    if not price.is_finite() or price < 0 or price >= 10 ** 8:
+        raise RowError(f'invalid price: {value("price")!r}')
+    category = value('category')
+    try:
+        validate_slug(category)
+    except ValidationError:
+        raise RowError(f'invalid category slug: {category!r}')
+    if len(category) > Category._meta.get_field('slug').max_length:
+        raise RowError('category slug is too long')
+    return {
+        'sku': sku,
+        'title': title,
+        'description': value('description'),
+        'price': price.quantize(Decimal('0.01')),
+        'category': category,
+        'category_title': value('category_title'),
+        'image': value('image') or None,
+    }
+
+
+class ProductImporter:
+    def __init__(self, chunk_size=1000, on_reject=None):
+        self.chunk_size = chunk_size
+        self.on_reject = on_reject
+        self.created = 0
+        self.updated = 0
+        self.rejected = 0
+        # slug -> title, чтобы не трогать одну категорию в каждой пачке
+        self._categories = {}
+
+    def reject(self, line, error):
+        self.rejected += 1
+        if self.on_reject is not None:
+            self.on_reject(line, error)
+
+    def run(self, rows, on_chunk=None):
+        chunk = {}
+        for line, row in rows:
+            if isinstance(row, Exception):
+                self.reject(line, str(row))
+                continue
+            try:
+                cleaned = clean_row(row)
+            except RowError as exc:
+                self.reject(line, str(exc))
+                continue
+            # повтор sku внутри пачки - побеждает последняя строка
+            chunk.pop(cleaned['sku'], None)
+            chunk[cleaned['sku']] = (line, cleaned)
+            if len(chunk) >= self.chunk_size:
+                self.import_chunk(chunk)
+                chunk = {}
+                if on_chunk is not None:
+                    on_chunk(self)
+        if chunk:
+            self.import_chunk(chunk)
+            if on_chunk is not None:
+                on_chunk(self)
+        if self.created or self.updated:
+            catalog_cache.invalidate_all()
+
+    def import_chunk(self, chunk):
+        try:
+            with transaction.atomic():
+                created, updated, rejected = self._import_chunk(chunk)
+        except Exception as exc:
+            # пачка откатилась целиком, вместе с категориями
+            self._categories = {}
+            for line, _ in chunk.values():
+                self.reject(line, f'chunk failed: {exc!r}')
+            return
+        self.created += created
+        self.updated += updated
+        for line, error in rejected:
+            self.reject(line, error)
+
+    @staticmethod
+    def free_title(slug, claimed):
+        '''название для новой категории без category_title: slug, если занят - "slug (2)" и т.д.'''
+        max_length = Category._meta.get_field('title').max_length
+        title, number = slug, 1
+        while title in claimed or Category.objects.filter(title=title).exists():
+            number += 1
+            suffix = f' ({number})'
+            title = slug[:max_length - len(suffix)] + suffix
+        return title
+
+    def upsert_categories(self, rows):
+        '''создаёт и переименовывает категории, возвращает {slug: ошибка} для тех, где название занято'''
+        # None - title не передан, категория просто должна существовать
+        wanted = {}
+        for _, row in rows:
+            slug, title = row['category'], row['category_title'] or None
+            if slug not in self._categories or (title and self._categories[slug] != title):
+                wanted[slug] = title or wanted.get(slug)
+        if not wanted:
+            return {}
+        existing = Category.objects.in_bulk(list(wanted))
+        # title -> slug: кто уже занял нужные названия, и в БД, и в этой пачке
+        claimed = dict(Category.objects.filter(title__in=[title for title in wanted.values() if title])
+                       .values_list('title', 'slug'))
+        errors, changed, new = {}, [], []
+        for slug, title in wanted.items():
+            if title and claimed.get(title, slug) != slug:
+                errors[slug] = f'category title {title!r} is already used by category {claimed[title]!r}'
+                continue
+            category = existing.get(slug)
+            if category is None:
+                category = Category(slug=slug, title=title or self.free_title(slug, claimed))
+                new.append(category)
+            elif title and category.title != title:
+                category.title = title
+                changed.append(category)
+            claimed[category.title] = slug
+            self._categories[slug] = category.title
+        Category.objects.bulk_update(changed, ['title'])
+        Category.objects.bulk_create(new)
+        return errors
+
+    def _import_chunk(self, chunk):
+        '''(создано, обновлено, [(строка, ошибка)])'''
+        rows = list(chunk.values())
+        errors = self.upsert_categories(rows)
+        rejected = [(line, errors[row['category']]) for line, row in rows if row['category'] in errors]
+        rows = [(line, row) for line, row in rows if row['category'] not in errors]
+        chunk = {row['sku']: (line, row) for line, row in rows}
+        existing = {sku: (pk, image, renditions, category) for sku, pk, image, renditions, category in
+                    Product.objects.filter(sku__in=list(chunk)).values_list('sku', 'pk', 'image', 'renditions',
+                                                                            'category_id')}
+        now = timezone.now()
+        to_create, to_update = [], []
+        # сводка нужна и новым категориям продуктов, и тем, откуда они ушли
+        categories = {row['category'] for _, row in rows}
+        for _, row in rows:
+            product = Product(sku=row['sku'], title=row['title'], description=row['description'],
+                              price=row['price'], category_id=row['category'], image=row['image'])
+            if row['sku'] in existing:
+                product.pk, image, renditions, category = existing[row['sku']]
+                categories.add(category)
+                # картинка сменилась - старые копии больше не подходят, generate_renditions сделает новые
+                product.renditions = renditions if (image or None) == row['image'] else {}
+                product.updated_at = now
+                to_update.append(product)
+            else:
+                to_create.append(product)
+        Product.objects.bulk_create(to_create)
+        Product.objects.bulk_update(to_update, UPDATE_FIELDS)
+        Category.objects.filter(pk__in=categories).refresh_stats()
+        return len(to_create), len(to_update), rejected
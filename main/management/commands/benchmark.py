@@ -0,0 +1,118 @@
+import logging
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from main.benchmark import (SCALES, compare, concurrency_scenarios, default_scenarios, load_baseline,
+                            run_concurrency, run_scenarios, save_baseline, seed)
+from shop.db_routers import get_options as get_routing_options
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный прогон API на синтетических данных в отдельной тестовой базе '
+            '(SQLite или PostgreSQL - что настроено в DATABASES)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=SCALES, default='small', help='размер набора данных')
+        for name in SCALES['small']:
+            parser.add_argument(f'--{name}', type=int, help=f'переопределить число {name}')
+        parser.add_argument('--iterations', type=int, default=200, help='запросов на сценарий')
+        parser.add_argument('--warmup', type=int, default=20, help='запросов на прогрев (не учитываются)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--only', action='append', help='запустить только эти сценарии')
+        parser.add_argument('--baseline', help='сравнить с baseline (JSON), регрессия - ошибка')
+        parser.add_argument('--save-baseline', help='сохранить результат как baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='допустимый рост p95 относительно baseline (0.25 = 25%%)')
+        parser.add_argument('--concurrency', type=int,
+                            help='вместо обычного прогона сравнить WSGI и ASGI (sync и async view) '
+                                 'при стольких одновременных запросах')
+        parser.add_argument('--keep-db', action='store_true',
+                            help='не удалять тестовую базу после прогона (для разбора планов запросов)')
+
+    def handle(self, *args, **options):
+        counts = dict(SCALES[options['scale']])
+        counts.update((name, options[name]) for name in counts if options[name] is not None)
+        scenarios = default_scenarios()
+        if options['only']:
+            unknown = set(options['only']) - {scenario.name for scenario in scenarios}
+            if unknown:
+                raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+            scenarios = [scenario for scenario in scenarios if scenario.name in options['only']]
+        baseline = load_baseline(options['baseline']) if options['baseline'] else None
+
+        setup_test_environment()
+        # медленные запросы под нагрузкой - ожидаемо, лог shop.requests.slow тут только шумит
+        logging.getLogger('shop.requests').setLevel(logging.ERROR)
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+            # in-memory база с shared cache блокирует таблицы целиком при параллельной записи
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'shop-benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        replicas = self.mirror_replicas()
+        try:
+            self.stdout.write(f'Seeding {connection.vendor} database: '
+                              + ', '.join(f'{name}={count}' for name, count in counts.items()))
+            data = seed(counts, options['seed'])
+            if options['concurrency']:
+                results = run_concurrency(concurrency_scenarios(), data, options['iterations'],
+                                          options['concurrency'], options['seed'])
+            else:
+                results = run_scenarios(scenarios, data, options['iterations'], options['warmup'], options['seed'])
+        finally:
+            for alias, settings_dict in replicas.items():
+                connections[alias].close()
+                connections[alias].settings_dict = settings_dict
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keep_db'])
+            teardown_test_environment()
+
+        if options['concurrency']:
+            self.print_concurrency(results, options['concurrency'])
+            return
+
+        self.print_results(results, baseline)
+        if options['save_baseline']:
+            meta = {'vendor': connection.vendor, 'counts': counts, 'iterations': options['iterations']}
+            save_baseline(options['save_baseline'], results, meta)
+            self.stdout.write(f"Baseline saved to {options['save_baseline']}")
+        problems = compare(results, baseline or {}, options['tolerance'])
+        if problems:
+            for problem in problems:
+                self.stderr.write(self.style.ERROR(problem))
+            raise CommandError(f'{len(problems)} regressions')
+        self.stdout.write(self.style.SUCCESS('No regressions'))
+
+    def mirror_replicas(self):
+        '''
+        реплики из DATABASE_ROUTING - зеркала тестовой базы, как в тестах (TEST MIRROR):
+        иначе GET-и читали бы настоящие реплики. Возвращает прежние настройки
+        '''
+        replicas = {}
+        for alias in get_routing_options()['REPLICAS']:
+            replicas[alias] = connections[alias].settings_dict
+            connections[alias].close()
+            connections[alias].creation.set_as_test_mirror(connection.settings_dict)
+        return replicas
+
+    def print_results(self, results, baseline):
+        header = f"{'scenario':<24}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'rps':>9}{'queries':>9}"
+        if baseline:
+            header += f"{'base p95':>10}"
+        self.stdout.write(header)
+        for name, result in results.items():
+            line = (f"{name:<24}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+                    f"{result['rps']:>9.1f}{result['queries']:>9}")
+            if baseline and name in baseline:
+                line += f"{baseline[name]['p95_ms']:>10.2f}"
+            self.stdout.write(line)
+
+    def print_concurrency(self, results, concurrency):
+        modes = ('wsgi', 'asgi_sync', 'asgi_async')
+        self.stdout.write(f'{concurrency} concurrent requests, rps / p95 ms / errors')
+        self.stdout.write(f"{'scenario':<24}" + ''.join(f'{mode:>24}' for mode in modes))
+        for name, result in results.items():
+            cells = ''.join(f"{result[mode]['rps']:>10.1f} /{result[mode]['p95_ms']:>7.1f} /{result[mode]['errors']:>3}"
+                            for mode in modes)
+            self.stdout.write(f'{name:<24}{cells}')
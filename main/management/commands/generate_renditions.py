@@ -0,0 +1,56 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+
+from main.images import get_options, save_renditions, submit
+from main.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Генерирует уменьшенные копии картинок продуктов (по умолчанию - только где их ещё нет)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='перегенерировать для всех продуктов с картинкой')
+        parser.add_argument('--product', type=int, action='append', dest='products',
+                            help='id продукта (можно указать несколько раз)')
+        parser.add_argument('--workers', type=int, help='число процессов (по умолчанию IMAGE_RENDITIONS.WORKERS)')
+
+    def handle(self, *args, **options):
+        queryset = Product.objects.exclude(image='').exclude(image__isnull=True)
+        if options['products']:
+            queryset = queryset.filter(pk__in=options['products'])
+        elif not options['all']:
+            queryset = queryset.filter(renditions={})
+        items = queryset.order_by('pk').values_list('pk', 'image').iterator()
+        workers = options['workers'] or get_options()['WORKERS']
+
+        done = failed = 0
+        pending = {}
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for pk, image_name in items:
+                # не читаем в память больше картинок, чем успеваем обработать
+                if len(pending) >= workers * 2:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        ok = self.save(future, *pending.pop(future))
+                        done, failed = done + ok, failed + (not ok)
+                try:
+                    pending[submit(image_name, pool)] = (pk, image_name)
+                except Exception as exc:
+                    self.stderr.write(f'Product {pk}: {exc!r}')
+                    failed += 1
+            for future in wait(pending).done:
+                ok = self.save(future, *pending[future])
+                done, failed = done + ok, failed + (not ok)
+
+        self.stdout.write(self.style.SUCCESS(f'Generated renditions for {done} products, failed: {failed}'))
+
+    def save(self, future, pk, image_name):
+        try:
+            save_renditions(pk, image_name, future.result())
+            return True
+        except Exception as exc:
+            self.stderr.write(f'Product {pk}: {exc!r}')
+            return False
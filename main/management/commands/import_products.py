@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.importer import ProductImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Потоковый импорт продуктов из CSV/JSONL (upsert по sku, категории по slug)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='файл фида, "-" - stdin')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='по умолчанию - по расширению файла')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='строк в одной транзакции')
+        parser.add_argument('--rejects', help='файл, куда писать отклонённые строки (номер строки и причина)')
+        parser.add_argument('--encoding', default='utf-8-sig')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        if path != '-' and not os.path.exists(path):
+            raise CommandError(f'File not found: {path}')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+
+        rejects = open(options['rejects'], 'w', encoding='utf-8') if options['rejects'] else None
+        shown = 0
+
+        def on_reject(line, error):
+            nonlocal shown
+            if rejects is not None:
+                rejects.write(f'{line}\t{error}\n')
+            # в консоль - только первые, чтобы не утонуть в выводе
+            if shown < 20:
+                self.stderr.write(f'line {line}: {error}')
+                shown += 1
+
+        started = time.monotonic()
+
+        def on_chunk(importer):
+            if options['verbosity'] > 1:
+                self.stdout.write(self.progress(importer, started))
+
+        importer = ProductImporter(options['chunk_size'], on_reject)
+        file = sys.stdin if path == '-' else open(path, encoding=options['encoding'], newline='')
+        try:
+            importer.run(read_rows(file, fmt), on_chunk)
+        finally:
+            if file is not sys.stdin:
+                file.close()
+            if rejects is not None:
+                rejects.close()
+
+        self.stdout.write(self.style.SUCCESS(self.progress(importer, started)))
+
+    def progress(self, importer, started):
+        elapsed = time.monotonic() - started
+        total = importer.created + importer.updated + importer.rejected
+        rate = total / elapsed if elapsed else 0
+        return (f'created {importer.created}, updated {importer.updated}, rejected {importer.rejected} '
+                f'in {elapsed:.1f}s ({rate:.0f} rows/s)')
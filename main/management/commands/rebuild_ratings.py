@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from main.cache import catalog_cache
+from main.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сохранённый рейтинг продуктов по таблице отзывов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, action='append', dest='products',
+                            help='id продукта (можно указать несколько раз)')
+
+    def handle(self, *args, **options):
+        queryset = Product.objects.all()
+        if options['products']:
+            queryset = queryset.filter(pk__in=options['products'])
+        updated = queryset.rebuild_ratings()
+        catalog_cache.invalidate_all()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt ratings for {updated} products'))
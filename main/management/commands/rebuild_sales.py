@@ -0,0 +1,24 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import DailySales
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'Invalid date: {value!r}, expected YYYY-MM-DD')
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сводку продаж (день x продукт) по таблице заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', type=parse_date, help='первый день, YYYY-MM-DD')
+        parser.add_argument('--to', dest='date_to', type=parse_date, help='последний день, YYYY-MM-DD')
+
+    def handle(self, *args, **options):
+        created = DailySales.objects.rebuild(options['date_from'], options['date_to'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt sales summary: {created} rows'))
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def create_search_schema(apps, schema_editor):
+    from main.search import create_search_schema
+    create_search_schema(schema_editor)
+
+
+def drop_search_schema(apps, schema_editor):
+    from main.search import drop_search_schema
+    drop_search_schema(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_product_rating'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_schema, drop_search_schema),
+    ]
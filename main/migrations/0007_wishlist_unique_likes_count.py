@@ -0,0 +1,47 @@
+# Generated by Django 3.1 on 2026-10-18 04:55
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, Max, Min, OuterRef, Subquery
+from django.db.models.functions import Cast, Coalesce
+
+
+def dedupe_likes(apps, schema_editor):
+    WishList = apps.get_model('main', 'WishList')
+    duplicates = (WishList.objects.values('user', 'product')
+                  .annotate(rows=Count('id'), keep=Min('id'),
+                            liked=Max(Cast('is_liked', IntegerField())))
+                  .filter(rows__gt=1))
+    for row in duplicates:
+        WishList.objects.filter(user=row['user'], product=row['product']).exclude(id=row['keep']).delete()
+        WishList.objects.filter(id=row['keep']).update(is_liked=bool(row['liked']))
+
+
+def fill_likes_count(apps, schema_editor):
+    Product = apps.get_model('main', 'Product')
+    WishList = apps.get_model('main', 'WishList')
+    likes = (WishList.objects.filter(product=OuterRef('pk'), is_liked=True)
+             .order_by().values('product').annotate(c=Count('id')).values('c'))
+    Product.objects.update(likes_count=Coalesce(Subquery(likes), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0006_review_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_likes, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='product',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='wishlist',
+            unique_together={('user', 'product')},
+        ),
+        migrations.RunPython(fill_likes_count, migrations.RunPython.noop),
+    ]
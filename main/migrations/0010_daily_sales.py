@@ -0,0 +1,66 @@
+# Generated by Django 3.1 on 2026-10-18 05:06
+
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def fill_item_prices(apps, schema_editor):
+    # цена на момент старых заказов неизвестна - берём текущую
+    Product = apps.get_model('main', 'Product')
+    OrderItems = apps.get_model('main', 'OrderItems')
+    OrderItems.objects.update(price=Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')))
+
+
+def build_daily_sales(apps, schema_editor):
+    OrderItems = apps.get_model('main', 'OrderItems')
+    DailySales = apps.get_model('main', 'DailySales')
+    revenue = ExpressionWrapper(F('price') * F('quantity'),
+                                output_field=DecimalField(max_digits=14, decimal_places=2))
+    rows = (OrderItems.objects.exclude(order__status='cancelled').order_by()
+            .values('product_id', day=TruncDate('order__created_at'))
+            .annotate(revenue=Sum(revenue), quantity=Sum('quantity'),
+                      orders_count=Count('order_id', distinct=True)))
+    DailySales.objects.bulk_create((DailySales(**row) for row in rows.iterator()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_product_sku'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitems',
+            name='price',
+            field=models.DecimalField(decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.RunPython(fill_item_prices, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitems',
+            name='price',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('orders_count', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='daily_sales', to='main.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dailysales',
+            index=models.Index(fields=['product', 'day'], name='main_dailys_product_49934d_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailysales',
+            unique_together={('day', 'product')},
+        ),
+        migrations.RunPython(build_daily_sales, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.1 on 2026-10-18 05:23
+
+from django.db import migrations, models
+from django.db.models import Avg, Count, Max, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_category_stats(apps, schema_editor):
+    Category = apps.get_model('main', 'Category')
+    Product = apps.get_model('main', 'Product')
+    products = Product.objects.filter(category=OuterRef('pk')).order_by().values('category')
+    Category.objects.update(
+        products_count=Coalesce(Subquery(products.annotate(c=Count('id')).values('c')), 0),
+        price_min=Subquery(products.annotate(m=Min('price')).values('m')),
+        price_max=Subquery(products.annotate(m=Max('price')).values('m')),
+        rating_avg=Coalesce(Subquery(products.filter(rating_count__gt=0).annotate(a=Avg('rating')).values('a')),
+                            0.0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_product_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='price_max',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='price_min',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='products_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='rating_avg',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(fill_category_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.1 on 2026-10-18 07:10
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_rating_totals(apps, schema_editor):
+    Category = apps.get_model('main', 'Category')
+    Product = apps.get_model('main', 'Product')
+    rated = Product.objects.filter(category=OuterRef('pk'), rating_count__gt=0).order_by().values('category')
+    Category.objects.update(
+        rating_total=Coalesce(Subquery(rated.annotate(s=Sum('rating')).values('s')), 0.0),
+        rated_count=Coalesce(Subquery(rated.annotate(c=Count('id')).values('c')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_category_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='rated_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='rating_total',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_rating_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1 on 2026-10-18 09:40
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_liked_at(apps, schema_editor):
+    # когда лайкнули раньше - неизвестно, порядок между ними сохранит сортировка по id
+    WishList = apps.get_model('main', 'WishList')
+    WishList.objects.filter(is_liked=True).update(liked_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_category_rating_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wishlist',
+            name='liked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_liked_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='wishlist',
+            index=models.Index(fields=['user', 'liked_at'], name='main_wishli_user_id_0aa9cc_idx'),
+        ),
+    ]
@@ -1,19 +1,170 @@
+from decimal import Decimal
+
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (F, Case, When, Value, FloatField, DecimalField, Sum, Count, OuterRef, Subquery,
+                              ExpressionWrapper, Avg, Max, Min)
+from django.db.models.functions import Cast, Coalesce, Greatest, Round, TruncDate
+from django.utils import timezone
 
 User = get_user_model()
 
 
+class OutOfStock(Exception):
+    def __init__(self, product_ids):
+        super().__init__(f'Not enough stock for products: {product_ids}')
+        self.product_ids = product_ids
+
+
+class CategoryQuerySet(models.QuerySet):
+    def refresh_stats(self):
+        '''пересчитывает кол-во продуктов, диапазон цен и средний рейтинг по таблице продуктов'''
+        products = Product.objects.filter(category=OuterRef('pk')).order_by().values('category')
+        # продукты без отзывов в средний рейтинг не входят
+        rated = products.filter(rating_count__gt=0)
+
+        def stat(queryset, aggregate):
+            return Subquery(queryset.annotate(value=aggregate).values('value'))
+
+        return self.update(
+            products_count=Coalesce(stat(products, Count('id')), 0),
+            price_min=stat(products, Min('price')),
+            price_max=stat(products, Max('price')),
+            rating_total=Coalesce(stat(rated, Sum('rating')), 0.0),
+            rated_count=Coalesce(stat(rated, Count('id')), 0),
+            rating_avg=Coalesce(stat(rated, Avg('rating')), 0.0),
+            updated_at=timezone.now()
+        )
+
+    def apply_rating_delta(self, total_delta, rated_delta):
+        '''сдвигает сумму рейтингов и кол-во продуктов с отзывами, средний - из них же, без чтения продуктов'''
+        total = F('rating_total') + total_delta
+        rated = F('rated_count') + rated_delta
+        # F() в UPDATE - старые значения, условие "продуктов с отзывами не осталось"
+        none_left = When(rated_count=-rated_delta, then=Value(0.0))
+        return self.update(
+            rating_total=Case(none_left, default=total, output_field=FloatField()),
+            rated_count=rated,
+            rating_avg=Case(none_left, default=ExpressionWrapper(total / rated, output_field=FloatField())),
+            updated_at=timezone.now()
+        )
+
+
 class Category(models.Model):
     title = models.CharField(max_length=100, unique=True)
     slug = models.SlugField(max_length=100, primary_key=True)
+    # сводка по продуктам для categories/, пересчитывает CategoryQuerySet.refresh_stats
+    products_count = models.PositiveIntegerField(default=0, editable=False)
+    price_min = models.DecimalField(max_digits=10, decimal_places=2, null=True, editable=False)
+    price_max = models.DecimalField(max_digits=10, decimal_places=2, null=True, editable=False)
+    rating_avg = models.FloatField(default=0, editable=False)
+    # из них rating_avg: отзыв сдвигает их на разницу (ProductQuerySet.apply_rating_delta)
+    rating_total = models.FloatField(default=0, editable=False)
+    rated_count = models.PositiveIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = CategoryQuerySet.as_manager()
 
     def __str__(self):
         return self.title
 
 
+class ProductQuerySet(models.QuerySet):
+    def _refresh_rating(self):
+        return self.update(rating=Case(
+            When(rating_count=0, then=Value(0.0)),
+            default=Cast('rating_sum', FloatField()) / F('rating_count'),
+            output_field=FloatField()
+        ))
+
+    def apply_rating_delta(self, sum_delta, count_delta):
+        '''сдвигает сумму и кол-во оценок без чтения отзывов, сводку категорий - так же на разницу'''
+        with transaction.atomic(using=self.db):
+            self.update(rating_sum=F('rating_sum') + sum_delta,
+                        rating_count=F('rating_count') + count_delta,
+                        updated_at=timezone.now())
+            self._refresh_rating()
+            deltas = {}
+            for category_id, rating_sum, rating_count, rating in self.values_list(
+                    'category_id', 'rating_sum', 'rating_count', 'rating'):
+                # рейтинг до изменения - так же, как его считает _refresh_rating
+                old_count = rating_count - count_delta
+                old = (rating_sum - sum_delta) / old_count if old_count else None
+                new = rating if rating_count else None
+                total, rated = deltas.get(category_id, (0.0, 0))
+                deltas[category_id] = (total + (new or 0) - (old or 0),
+                                       rated + (new is not None) - (old is not None))
+            # по одной строке на категорию и в одном порядке - без дедлоков
+            for category_id, (total, rated) in sorted(deltas.items()):
+                if total or rated:
+                    Category.objects.filter(pk=category_id).apply_rating_delta(total, rated)
+
+    def rebuild_ratings(self):
+        '''полностью пересчитывает рейтинг по таблице отзывов'''
+        reviews = Review.objects.filter(product=OuterRef('pk')).order_by().values('product')
+        with transaction.atomic(using=self.db):
+            updated = self.update(
+                rating_sum=Coalesce(Subquery(reviews.annotate(s=Sum('rating')).values('s')), 0),
+                rating_count=Coalesce(Subquery(reviews.annotate(c=Count('id')).values('c')), 0),
+                updated_at=timezone.now()
+            )
+            self._refresh_rating()
+            Category.objects.filter(pk__in=self.values('category')).refresh_stats()
+        return updated
+
+    def rebuild_likes_count(self):
+        '''пересчитывает likes_count по таблице лайков'''
+        likes = (WishList.objects.filter(product=OuterRef('pk'), is_liked=True)
+                 .order_by().values('product').annotate(c=Count('id')).values('c'))
+        return self.update(likes_count=Coalesce(Subquery(likes), 0), updated_at=timezone.now())
+
+    @staticmethod
+    def adjusted_price(percent=None, amount=None):
+        '''новая цена: +percent % или +amount, округлена до копеек и не ниже 0'''
+        money = DecimalField(max_digits=10, decimal_places=2)
+        if percent is not None:
+            # Round в Django 3.1 без точности: округляем цену в копейках
+            cents = ExpressionWrapper(F('price') * Value(100 + percent, output_field=money), output_field=money)
+            # умножение, а не деление на 100: в SQLite целое / 100 - целочисленное деление
+            price = ExpressionWrapper(Round(cents) * Value(Decimal('0.01'), output_field=money), output_field=money)
+        else:
+            price = ExpressionWrapper(F('price') + Value(amount, output_field=money), output_field=money)
+        # 0 числом: Decimal в SQLite уходит строкой, а MAX(число, строка) - строка
+        return Greatest(price, Value(0), output_field=money)
+
+    def adjust_prices(self, percent=None, amount=None):
+        '''меняет цену всех продуктов выборки одним UPDATE'''
+        return self.update(price=self.adjusted_price(percent, amount), updated_at=timezone.now())
+
+    def reserve_stock(self, quantities):
+        '''
+        списывает остаток {product_id: кол-во} условными UPDATE - только там, где хватает.
+        Продукты без учёта остатка лучше не передавать - на них уходит лишний запрос.
+        Вызывать внутри transaction.atomic(): при нехватке хоть одного продукта
+        кидает OutOfStock, и транзакция откатывает уже списанное.
+        '''
+        missing = []
+        # в порядке id: параллельные заказы берут блокировки строк в одном порядке, без дедлоков
+        for product_id, quantity in sorted(quantities.items()):
+            reserved = self.filter(pk=product_id, stock__gte=quantity).update(stock=F('stock') - quantity)
+            if not reserved:
+                missing.append(product_id)
+        if missing:
+            # у продуктов без учёта (stock None) списывать нечего
+            missing = sorted(self.filter(pk__in=missing, stock__isnull=False).values_list('pk', flat=True))
+        if missing:
+            raise OutOfStock(missing)
+
+    def release_stock(self, quantities):
+        # в том же порядке, что и reserve_stock
+        for product_id, quantity in sorted(quantities.items()):
+            self.filter(pk=product_id, stock__isnull=False).update(stock=F('stock') + quantity)
+
+
 class Product(models.Model):
+    # артикул поставщика, по нему import_products находит продукт
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
     title = models.CharField(max_length=100)
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
@@ -23,10 +174,54 @@ class Product(models.Model):
     image = models.ImageField(upload_to='products',
                               blank=True,
                               null=True)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating = models.FloatField(default=0, editable=False)
+    likes_count = models.PositiveIntegerField(default=0, editable=False)
+    # остаток на складе, None - не учитывается (продаётся без ограничений).
+    # списывается при заказе ProductQuerySet.reserve_stock
+    stock = models.PositiveIntegerField(null=True, blank=True)
+    # уменьшенные копии image для srcset, см. main/images.py
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    # меняется и при изменении отзывов - по нему считаются ETag/Last-Modified
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = ProductQuerySet.as_manager()
+
+    # меняются только через UPDATE с F() (отзывы, лайки, заказы, картинки) - обычный save()
+    # прочитанного раньше продукта затёр бы их устаревшими значениями
+    counter_fields = ('rating_sum', 'rating_count', 'rating', 'likes_count', 'stock', 'renditions')
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'image' in field_names:
+            instance._loaded_image = instance.image.name or ''
+        if 'stock' in field_names:
+            instance._loaded_stock = instance.stock
+        if 'category_id' in field_names and 'price' in field_names:
+            instance._loaded_stats = (instance.category_id, instance.price)
+        return instance
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not self._state.adding and not force_insert:
+            skip = set(self.counter_fields)
+            # остаток, выставленный явно (админом), пишем как есть
+            if getattr(self, '_loaded_stock', self.stock) != self.stock:
+                skip.discard('stock')
+            update_fields = [field.name for field in self._meta.concrete_fields
+                             if not field.primary_key and field.name not in skip]
+        super().save(force_insert, force_update, using, update_fields)
+        self._loaded_stock = self.stock
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        if fields is None or 'stock' in fields:
+            self._loaded_stock = self.stock
+
 
 class Review(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE,
@@ -41,6 +236,29 @@ class Review(models.Model):
 
     class Meta:
         unique_together = ['author', 'product']
+        # для keyset-пагинации отзывов продукта
+        indexes = [
+            models.Index(fields=['product', 'created_at']),
+            models.Index(fields=['product', 'rating']),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_rating = (instance.product_id, instance.rating)
+        return instance
+
+    def save(self, *args, **kwargs):
+        # агрегаты продукта обновляются в post_save, в той же транзакции
+        with transaction.atomic(using=kwargs.get('using')):
+            if self.pk is not None and not hasattr(self, '_loaded_rating'):
+                # объект собран руками (Review(pk=..., ...)) - прежние значения берём из БД,
+                # иначе post_save посчитает существующий отзыв второй раз
+                loaded = (Review.objects.using(kwargs.get('using')).filter(pk=self.pk)
+                          .values_list('product_id', 'rating').first())
+                if loaded is not None:
+                    self._loaded_rating = loaded
+            super().save(*args, **kwargs)
 
 
 class StatusChoices(models.TextChoices):
@@ -57,8 +275,21 @@ class Order(models.Model):
     status = models.CharField(max_length=15, choices=StatusChoices.choices)
     total_sum = models.DecimalField(max_digits=10, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     notes = models.TextField(blank=True)
 
+    def apply_stock_change(self, old_status):
+        '''отмена заказа возвращает остаток, заказ из отменённых снова его резервирует'''
+        was_reserved = old_status != StatusChoices.cancelled
+        is_reserved = self.status != StatusChoices.cancelled
+        if was_reserved == is_reserved:
+            return
+        quantities = dict(self.items.values_list('product_id', 'quantity'))
+        if is_reserved:
+            Product.objects.reserve_stock(quantities)
+        else:
+            Product.objects.release_stock(quantities)
+
 
 class OrderItems(models.Model):
     order = models.ForeignKey(Order,
@@ -68,10 +299,122 @@ class OrderItems(models.Model):
                                 on_delete=models.DO_NOTHING,
                                 related_name='order_items')
     quantity = models.PositiveSmallIntegerField(default=1)
+    # цена продукта на момент заказа
+    price = models.DecimalField(max_digits=10, decimal_places=2)
 
     class Meta:
         unique_together = ['order', 'product']
 
+    def save(self, *args, **kwargs):
+        if self.price is None:
+            self.price = self.product.price
+        super().save(*args, **kwargs)
+
+
+class DailySalesQuerySet(models.QuerySet):
+    @staticmethod
+    def aggregate_items(items):
+        '''позиции -> строки сводки (день, продукт, кол-во, выручка, заказов)'''
+        # revenue раньше quantity: иначе F('quantity') в выручке сошлётся на Sum('quantity')
+        revenue = ExpressionWrapper(F('price') * F('quantity'),
+                                    output_field=DecimalField(max_digits=14, decimal_places=2))
+        return (items.order_by()
+                .values('product_id', day=TruncDate('order__created_at'))
+                .annotate(revenue=Sum(revenue), quantity=Sum('quantity'),
+                          orders_count=Count('order_id', distinct=True)))
+
+    def apply_orders(self, order_ids, sign=1):
+        '''
+        Добавляет (sign=1) или вычитает (sign=-1) позиции заказов из сводки.
+        Строки (день, продукт) создаются пустыми через INSERT ... ON CONFLICT DO NOTHING,
+        затем сдвигаются F() выражениями - без чтения и без гонок между заказами.
+        '''
+        rows = list(self.aggregate_items(OrderItems.objects.filter(order_id__in=order_ids)))
+        # в одном порядке для всех заказов: параллельные UPDATE не ждут друг друга крест-накрест
+        rows.sort(key=lambda row: (row['day'], row['product_id']))
+        with transaction.atomic(using=self.db):
+            self.bulk_create([DailySales(day=row['day'], product_id=row['product_id']) for row in rows],
+                             ignore_conflicts=True)
+            for row in rows:
+                self.filter(day=row['day'], product_id=row['product_id']).update(
+                    quantity=F('quantity') + sign * row['quantity'],
+                    revenue=F('revenue') + sign * row['revenue'],
+                    orders_count=F('orders_count') + sign * row['orders_count'],
+                )
+            if sign < 0:
+                # как после rebuild: пустых строк в сводке нет
+                for row in rows:
+                    self.filter(day=row['day'], product_id=row['product_id'], orders_count__lte=0).delete()
+        return len(rows)
+
+    def apply_status_change(self, order_id, old_status, new_status):
+        '''отменённые заказы в сводку не входят'''
+        was_counted = old_status != StatusChoices.cancelled
+        is_counted = new_status != StatusChoices.cancelled
+        if was_counted != is_counted:
+            self.apply_orders([order_id], 1 if is_counted else -1)
+
+    def rebuild(self, date_from=None, date_to=None, batch_size=1000):
+        '''пересчитывает сводку за период (или целиком) по таблице заказов'''
+        items = OrderItems.objects.exclude(order__status=StatusChoices.cancelled)
+        days = self
+        if date_from is not None:
+            items = items.filter(order__created_at__date__gte=date_from)
+            days = days.filter(day__gte=date_from)
+        if date_to is not None:
+            items = items.filter(order__created_at__date__lte=date_to)
+            days = days.filter(day__lte=date_to)
+        created = 0
+        with transaction.atomic(using=self.db):
+            days.delete()
+            batch = []
+            for row in self.aggregate_items(items).iterator(chunk_size=batch_size):
+                batch.append(DailySales(**row))
+                if len(batch) >= batch_size:
+                    created += len(self.bulk_create(batch))
+                    batch = []
+            created += len(self.bulk_create(batch))
+        return created
+
+
+class DailySales(models.Model):
+    '''сводка продаж день x продукт, без отменённых заказов (см. DailySalesQuerySet)'''
+    day = models.DateField()
+    product = models.ForeignKey(Product,
+                                on_delete=models.DO_NOTHING,
+                                related_name='daily_sales')
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    orders_count = models.IntegerField(default=0)
+
+    objects = DailySalesQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['day', 'product']
+        indexes = [models.Index(fields=['product', 'day'])]
+
+
+class WishListQuerySet(models.QuerySet):
+    def toggle(self, user, product):
+        '''
+        Переключает лайк без read-modify-write: INSERT ... ON CONFLICT DO NOTHING,
+        затем UPDATE SET is_liked = NOT is_liked. Строка остаётся заблокированной
+        до конца транзакции, поэтому прочитанное значение - наше.
+        '''
+        with transaction.atomic(using=self.db):
+            self.bulk_create([WishList(user=user, product=product)], ignore_conflicts=True)
+            like = self.filter(user=user, product=product)
+            # в CASE для liked_at is_liked ещё прежний - время ставится только новому лайку
+            now = Value(timezone.now(), output_field=models.DateTimeField())
+            like.update(is_liked=Case(When(is_liked=True, then=Value(False)), default=Value(True)),
+                        liked_at=Case(When(is_liked=False, then=now), default=F('liked_at')))
+            is_liked = like.values_list('is_liked', flat=True).get()
+            Product.objects.filter(pk=product.pk).update(
+                likes_count=F('likes_count') + (1 if is_liked else -1),
+                updated_at=timezone.now()
+            )
+        return is_liked
+
 
 class WishList(models.Model):
     user = models.ForeignKey(User,
@@ -81,4 +424,14 @@ class WishList(models.Model):
                                 on_delete=models.CASCADE)
 
     is_liked = models.BooleanField(default=False)
+    # когда лайкнули последний раз, по нему сортируется me/wishlist/
+    liked_at = models.DateTimeField(blank=True, null=True)
+
+    objects = WishListQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['user', 'product']
+        indexes = [
+            models.Index(fields=['user', 'liked_at']),
+        ]
 
@@ -0,0 +1,192 @@
+'''
+Пагинация списков продуктов и заказов.
+
+По умолчанию - обычная постраничная (PageNumberPagination).
+Keyset (курсорная) включается параметром ?pagination=cursor,
+дальше клиент просто ходит по ссылкам next/previous.
+Курсор хранит значения полей сортировки последней записи + pk,
+поэтому нет ни COUNT(*), ни OFFSET.
+'''
+import datetime
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    '''DjangoJSONEncoder режет время до миллисекунд - записи из одной миллисекунды
+    терялись бы между страницами, поэтому время с микросекундами'''
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    mode_query_param = 'pagination'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    page_size = api_settings.PAGE_SIZE
+
+    @property
+    def max_page_size(self):
+        return getattr(settings, 'MAX_PAGE_SIZE', 100)
+
+    @classmethod
+    def is_requested(cls, request):
+        return (cls.cursor_query_param in request.query_params or
+                request.query_params.get(cls.mode_query_param) == 'cursor')
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, queryset):
+        '''
+        Сортировка из OrderingFilter (или Meta.ordering модели)
+        + pk в конце, чтобы порядок был строгим при одинаковых значениях
+        '''
+        ordering = list(queryset.query.order_by) or list(queryset.model._meta.ordering)
+        result = []
+        for item in ordering:
+            if not isinstance(item, str) or item == '?':
+                raise NotFound('Keyset pagination does not support this ordering')
+            desc = item.startswith('-')
+            name = item.lstrip('-')
+            if name in ('pk', queryset.model._meta.pk.name):
+                continue
+            result.append((name, desc))
+        result.append(('pk', result[0][1] if result else False))
+        return result
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.model = queryset.model
+        self.ordering = self.get_ordering(queryset)
+        self.cursor = self.decode_cursor(request)
+
+        reverse = self.cursor is not None and self.cursor['r']
+        order_by = [('-' if desc != reverse else '') + name for name, desc in self.ordering]
+        queryset = queryset.order_by(*order_by)
+        if self.cursor is not None:
+            queryset = queryset.filter(self.keyset_filter(self.cursor['v'], reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+        self.page = results
+        return results
+
+    def keyset_filter(self, values, reverse):
+        '''(a, b, pk) > (x, y, z) с учётом направления каждого поля'''
+        condition = Q()
+        equal = {}
+        for (name, desc), value in zip(self.ordering, values):
+            lookup = 'lt' if desc != reverse else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+    def get_value(self, obj, name):
+        for attr in name.split('__'):
+            obj = getattr(obj, attr)
+        return obj
+
+    def encode_cursor(self, obj, reverse):
+        payload = {
+            'o': [('-' if desc else '') + name for name, desc in self.ordering],
+            'v': [self.get_value(obj, name) for name, _ in self.ordering],
+            'r': reverse,
+        }
+        data = json.dumps(payload, cls=CursorEncoder, separators=(',', ':'))
+        token = urlsafe_b64encode(data.encode()).decode().rstrip('=')
+        url = remove_query_param(self.request.build_absolute_uri(), self.mode_query_param)
+        return replace_query_param(url, self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            data = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            payload = json.loads(data.decode())
+            ordering = [('-' if desc else '') + name for name, desc in self.ordering]
+            if payload['o'] != ordering or len(payload['v']) != len(ordering):
+                raise ValueError
+            payload['v'] = [self.to_python(name, value)
+                            for (name, _), value in zip(self.ordering, payload['v'])]
+            payload['r'] = bool(payload['r'])
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return payload
+
+    def to_python(self, name, value):
+        model = self.model
+        field = None
+        for attr in name.split('__'):
+            try:
+                field = model._meta.pk if attr == 'pk' else model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                # аннотация (например, релевантность поиска) - значение как есть
+                return value
+            model = field.related_model or model
+        return field.to_python(value)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class ShopPagination(PageNumberPagination):
+    '''постраничная по умолчанию, keyset - по запросу клиента'''
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_class.is_requested(request):
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
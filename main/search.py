@@ -0,0 +1,207 @@
+'''
+Полнотекстовый поиск по продуктам.
+
+PostgreSQL: колонка main_product.search_vector (tsvector, заполняется триггером)
+с GIN индексом + pg_trgm similarity по названию для опечаток.
+SQLite: FTS5 таблица main_product_fts (синхронизируется триггерами),
+чтобы поиск работал локально без Postgres.
+Остальные СУБД: icontains по словам, без индекса - медленно, но не 500.
+
+Фильтры title= / description= (filter_field) - по одной колонке: на PostgreSQL
+icontains по trigram GIN индексам, на SQLite - FTS5 с фильтром по колонке.
+
+Обе схемы создаются миграцией 0004_product_search. SQLite при пересоздании
+таблицы (ALTER в миграциях) теряет триггеры, поэтому после migrate они
+восстанавливаются в ensure_search_schema.
+'''
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, Case, FloatField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = 'russian'
+TRIGRAM_WEIGHT = 0.5
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+POSTGRESQL_SCHEMA = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'ALTER TABLE main_product ADD COLUMN search_vector tsvector',
+    f'''
+    CREATE FUNCTION main_product_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE TRIGGER main_product_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description ON main_product
+    FOR EACH ROW EXECUTE PROCEDURE main_product_search_vector_update()
+    ''',
+    'UPDATE main_product SET title = title',
+    'CREATE INDEX main_product_search_vector_gin ON main_product USING gin (search_vector)',
+    # gin_trgm_ops ускоряет и similarity, и icontains-фильтры ProductFilter
+    'CREATE INDEX main_product_title_trgm ON main_product USING gin (title gin_trgm_ops)',
+    'CREATE INDEX main_product_description_trgm ON main_product USING gin (description gin_trgm_ops)',
+]
+
+POSTGRESQL_DROP = [
+    'DROP INDEX IF EXISTS main_product_description_trgm',
+    'DROP INDEX IF EXISTS main_product_title_trgm',
+    'DROP TRIGGER IF EXISTS main_product_search_vector_trigger ON main_product',
+    'DROP FUNCTION IF EXISTS main_product_search_vector_update()',
+    'ALTER TABLE main_product DROP COLUMN IF EXISTS search_vector',
+]
+
+SQLITE_TABLE = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS main_product_fts USING fts5(
+        title, description,
+        content='main_product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+'''
+
+SQLITE_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS main_product_fts_insert AFTER INSERT ON main_product BEGIN
+        INSERT INTO main_product_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS main_product_fts_delete AFTER DELETE ON main_product BEGIN
+        INSERT INTO main_product_fts(main_product_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS main_product_fts_update
+    AFTER UPDATE OF title, description ON main_product BEGIN
+        INSERT INTO main_product_fts(main_product_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO main_product_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END
+    ''',
+]
+
+SQLITE_REBUILD = "INSERT INTO main_product_fts(main_product_fts) VALUES ('rebuild')"
+
+SQLITE_DROP = [
+    'DROP TRIGGER IF EXISTS main_product_fts_update',
+    'DROP TRIGGER IF EXISTS main_product_fts_delete',
+    'DROP TRIGGER IF EXISTS main_product_fts_insert',
+    'DROP TABLE IF EXISTS main_product_fts',
+]
+
+
+def create_search_schema(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        statements = POSTGRESQL_SCHEMA
+    elif vendor == 'sqlite':
+        statements = [SQLITE_TABLE] + SQLITE_TRIGGERS + [SQLITE_REBUILD]
+    else:
+        return
+    for sql in statements:
+        schema_editor.execute(sql, params=None)
+
+
+def drop_search_schema(schema_editor):
+    statements = {'postgresql': POSTGRESQL_DROP, 'sqlite': SQLITE_DROP}
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql, params=None)
+
+
+def ensure_search_schema(connection):
+    '''восстанавливает FTS триггеры SQLite, если таблицу пересоздали'''
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'main_product_fts'")
+        if cursor.fetchone() is None:
+            return
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+                       "AND name LIKE 'main_product_fts_%'")
+        if cursor.fetchone()[0] == len(SQLITE_TRIGGERS):
+            return
+        for sql in SQLITE_TRIGGERS:
+            cursor.execute(sql)
+        cursor.execute(SQLITE_REBUILD)
+
+
+def search_products(queryset, query):
+    '''фильтрует продукты по запросу и сортирует по релевантности (search_rank)'''
+    words = WORD_RE.findall(query)
+    if not words:
+        return queryset.none()
+    vendor = connections[queryset.db].vendor
+    if vendor == 'postgresql':
+        queryset = _search_postgresql(queryset, ' '.join(words))
+    elif vendor == 'sqlite':
+        queryset = _search_sqlite(queryset, words)
+    else:
+        queryset = _search_icontains(queryset, words)
+    return queryset.order_by('-search_rank', '-pk')
+
+
+def filter_field(queryset, field, value):
+    '''
+    продукты, у которых в поле field (title/description) есть value; порядок не меняется.
+    На SQLite - все слова value как префиксы слов поля ("pho" найдёт "Phone", а "hone" - нет),
+    на остальных СУБД - icontains как раньше (на PostgreSQL его обслуживает trigram индекс)
+    '''
+    if connections[queryset.db].vendor != 'sqlite':
+        return queryset.filter(**{f'{field}__icontains': value})
+    words = WORD_RE.findall(value)
+    if not words:
+        return queryset.none()
+    match = f'{field} : ({_fts_terms(words)})'
+    ids = RawSQL('SELECT rowid FROM main_product_fts WHERE main_product_fts MATCH %s', (match,))
+    return queryset.filter(pk__in=ids)
+
+
+def _search_postgresql(queryset, query):
+    tsquery = f"plainto_tsquery('{SEARCH_CONFIG}', %s)"
+    match = RawSQL(
+        f'(main_product.search_vector @@ {tsquery} OR main_product.title %% %s)',
+        (query, query), output_field=BooleanField()
+    )
+    rank = RawSQL(
+        f'ts_rank(main_product.search_vector, {tsquery}) + '
+        f'{TRIGRAM_WEIGHT} * similarity(main_product.title, %s)',
+        (query, query), output_field=FloatField()
+    )
+    return queryset.annotate(search_match=match, search_rank=rank).filter(search_match=True)
+
+
+def _fts_terms(words):
+    # каждое слово - префиксный терм, кавычки экранируют синтаксис FTS5
+    return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+
+
+def _search_sqlite(queryset, words):
+    match = _fts_terms(words)
+    ids = RawSQL('SELECT rowid FROM main_product_fts WHERE main_product_fts MATCH %s', (match,))
+    # bm25 тем лучше, чем меньше, поэтому берём с минусом (вес названия 10, описания 1)
+    rank = RawSQL(
+        'SELECT -bm25(main_product_fts, 10.0, 1.0) FROM main_product_fts '
+        'WHERE main_product_fts MATCH %s AND main_product_fts.rowid = main_product.id',
+        (match,), output_field=FloatField()
+    )
+    return queryset.filter(pk__in=ids).annotate(search_rank=rank)
+
+
+def _search_icontains(queryset, words):
+    # каждое слово - в названии или описании; все слова в названии - выше
+    match, in_title = Q(), Q()
+    for word in words:
+        match &= Q(title__icontains=word) | Q(description__icontains=word)
+        in_title &= Q(title__icontains=word)
+    rank = Case(When(in_title, then=Value(1.0)), default=Value(0.0), output_field=FloatField())
+    return queryset.filter(match).annotate(search_rank=rank)
@@ -1,30 +1,66 @@
+from django.db import connection, transaction
 from rest_framework import serializers
-from .models import Product, Review, OrderItems, Order
+from .images import build_srcset
+from .models import Category, Product, Review, OrderItems, Order, StatusChoices, DailySales, OutOfStock
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
 
+class CategorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Category
+        fields = ('slug', 'title', 'products_count', 'price_min', 'price_max', 'rating_avg')
+
+    def to_representation(self, instance):
+        representation = super().to_representation(instance)
+        representation['rating_avg'] = round(instance.rating_avg, 1)
+        return representation
+
+
 class ProductListSerializer(serializers.ModelSerializer):
+    srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = Product
-        fields = ('id', 'title', 'price', 'image')
+        fields = ('id', 'title', 'price', 'image', 'srcset', 'rating', 'likes_count')
+
+    def get_srcset(self, instance):
+        return build_srcset(instance.renditions, self.context.get('request'))
+
+    def to_representation(self, instance):
+        representation = super().to_representation(instance)
+        representation['rating'] = round(instance.rating, 1)
+        return representation
 
 
 class ProductDetailsSerializer(serializers.ModelSerializer):
+    # остальные отзывы - постранично через products/{id}/reviews/
+    latest_reviews_count = 3
+    srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = Product
-        fields = '__all__'
+        # счётчики, renditions и updated_at - служебные, наружу (и на запись) не отдаются
+        fields = ('id', 'sku', 'title', 'description', 'price', 'category', 'image', 'srcset', 'stock')
+        extra_kwargs = {
+            # артикул нужен только импорту (main/importer.py)
+            'sku': {'write_only': True},
+            # меняется на каждом заказе мимо кэша каталога и ETag - наружу не отдаём
+            'stock': {'write_only': True},
+        }
+
+    def get_srcset(self, instance):
+        return build_srcset(instance.renditions, self.context.get('request'))
 
     def get_rating(self, instance):
-        total_rating = sum(instance.reviews.values_list('rating', flat=True))
-        reviews_count = instance.reviews.count()
-        rating = total_rating / reviews_count if reviews_count > 0 else 0
-        return round(rating, 1)
+        return round(instance.rating, 1)
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
-        representation['reviews'] = ReviewSerializer(instance.reviews.all(), many=True).data
+        reviews = instance.reviews.select_related('author').order_by('-created_at', '-pk')
+        representation['reviews'] = ReviewSerializer(reviews[:self.latest_reviews_count], many=True).data
+        representation['reviews_count'] = instance.rating_count
         representation['rating'] = self.get_rating(instance)
         return representation
 
@@ -69,33 +105,182 @@ class ReviewSerializer(serializers.ModelSerializer):
 
 
 class OrderItemsSerializer(serializers.ModelSerializer):
+    # продукты грузятся пачкой в OrderSerializer.validate_products (в пакете - в OrderListSerializer)
+    product = serializers.IntegerField(source='product_id')
+
+    class Meta:
+        model = OrderItems
+        fields = ('product', 'quantity')
+
+
+class OrderProductSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Product
+        fields = ('id', 'title', 'price', 'image')
+
+
+class OrderItemDetailsSerializer(serializers.ModelSerializer):
+    product = OrderProductSerializer(read_only=True)
+
     class Meta:
         model = OrderItems
         fields = ('product', 'quantity')
 
 
+class OrderDetailsSerializer(serializers.ModelSerializer):
+    '''чтение заказа: позиции и продукты должны быть подгружены во вьюхе (prefetch)'''
+    items = OrderItemDetailsSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Order
+        fields = ('id', 'status', 'total_sum', 'created_at', 'notes', 'items')
+
+
+class OrderListSerializer(serializers.ListSerializer):
+    def to_internal_value(self, data):
+        # продукты всех заказов пакета - одним in_bulk, заказы берут их в validate_products
+        self.loaded_products = Product.objects.only('id', 'price', 'stock').in_bulk(
+            self.collect_product_ids(data)
+        )
+        return super().to_internal_value(data)
+
+    @staticmethod
+    def collect_product_ids(data):
+        '''id продуктов из сырых данных пакета, мусор потом отсеет валидация заказов'''
+        product_field = serializers.IntegerField()
+        ids = set()
+        for order in data if isinstance(data, list) else ():
+            items = order.get('products') if isinstance(order, dict) else None
+            for item in items if isinstance(items, list) else ():
+                try:
+                    ids.add(product_field.to_internal_value(item['product']))
+                except (TypeError, KeyError, serializers.ValidationError):
+                    pass
+        return ids
+
+    def create(self, validated_data):
+        '''пакет заказов: заказы и позиции всех заказов пишутся bulk insert-ами'''
+        with transaction.atomic():
+            built = [self.child.build_order(attrs) for attrs in validated_data]
+            orders = [order for order, _ in built]
+            if connection.features.can_return_rows_from_bulk_insert:
+                Order.objects.bulk_create(orders)
+            else:
+                # SQLite/MySQL (в Django 3.1) не возвращают pk из bulk insert, а они нужны позициям:
+                # тут заказы по одному INSERT-у, позиции и сводка - всё равно пачкой
+                for order in orders:
+                    order.save()
+            items = []
+            for order, order_items in built:
+                for item in order_items:
+                    item.order = order
+                    items.append(item)
+            OrderItems.objects.bulk_create(items)
+            DailySales.objects.apply_orders([order.pk for order in orders])
+            self.child.reserve_stock(items)
+        return orders
+
+
 class OrderSerializer(serializers.ModelSerializer):
-    products = OrderItemsSerializer(many=True)
+    products = OrderItemsSerializer(many=True, source='items')
 
     class Meta:
         model = Order
         fields = ('products', 'notes')
+        list_serializer_class = OrderListSerializer
 
-    def create(self, validated_data):
-        total_sum = 0
+    def validate_products(self, items):
+        if not items:
+            raise serializers.ValidationError('Order must contain at least one product')
+        ids = [item['product_id'] for item in items]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError('Each product can be added to the order only once')
+        products = getattr(self.parent, 'loaded_products', None)
+        if products is None:
+            products = Product.objects.only('id', 'price', 'stock').in_bulk(ids)
+        missing = [pk for pk in ids if pk not in products]
+        if missing:
+            raise serializers.ValidationError(f'Products not found: {missing}')
+        # распроданное отсекаем сразу, без транзакции; окончательно решает reserve_stock
+        sold_out = [pk for pk, item in zip(ids, items)
+                    if products[pk].stock is not None and products[pk].stock < item['quantity']]
+        if sold_out:
+            raise serializers.ValidationError(f'Not enough stock for products: {sold_out}')
+        for item in items:
+            item['product'] = products[item.pop('product_id')]
+        return items
+
+    def build_order(self, validated_data):
+        '''несохранённый заказ с уже посчитанной суммой и его позиции'''
         request = self.context.get('request')
-        validated_data['user'] = request.user
-        validated_data['status'] = 'new'
-        validated_data['total_sum'] = total_sum
-        products = validated_data.pop('products')
-        order = Order.objects.create(**validated_data)
-        for prod in products:
-            total_sum += prod['product'].price * prod['quantity']
-            OrderItems.objects.create(order=order, **prod)
-        order.total_sum = total_sum
-        order.save()
+        items = [OrderItems(price=item['product'].price, **item) for item in validated_data.pop('items')]
+        total_sum = sum(item.product.price * item.quantity for item in items)
+        order = Order(user=request.user, status=StatusChoices.new,
+                      total_sum=total_sum, **validated_data)
+        return order, items
+
+    def create(self, validated_data):
+        order, items = self.build_order(validated_data)
+        with transaction.atomic():
+            order.save()
+            for item in items:
+                item.order = order
+            OrderItems.objects.bulk_create(items)
+            DailySales.objects.apply_orders([order.pk])
+            self.reserve_stock(items)
         return order
 
+    @staticmethod
+    def stock_quantities(items):
+        '''{product_id: кол-во} только по продуктам с учётом остатка'''
+        quantities = {}
+        for item in items:
+            if item.product.stock is not None:
+                quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+        return quantities
+
+    def reserve_stock(self, items):
+        # последним в транзакции: строки продуктов заблокированы только до коммита
+        try:
+            Product.objects.reserve_stock(self.stock_quantities(items))
+        except OutOfStock as exc:
+            raise serializers.ValidationError({'products': [str(exc)]})
+
+
+class SalesQuerySerializer(serializers.Serializer):
+    '''параметры analytics/sales/'''
+    date_from = serializers.DateField()
+    date_to = serializers.DateField()
+    group_by = serializers.ChoiceField(choices=('day', 'product', 'category'), default='day')
+    product = serializers.IntegerField(required=False)
+    category = serializers.CharField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+    def validate(self, attrs):
+        if attrs['date_from'] > attrs['date_to']:
+            raise serializers.ValidationError('date_from must not be later than date_to')
+        return attrs
+
+
+class PriceAdjustmentSerializer(serializers.Serializer):
+    '''products/adjust_prices/: percent (-10 - скидка 10%) или amount (+5.00)'''
+    percent = serializers.DecimalField(max_digits=5, decimal_places=2, min_value=-100, max_value=1000,
+                                       required=False)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+    dry_run = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        if ('percent' in attrs) == ('amount' in attrs):
+            raise serializers.ValidationError('Pass either percent or amount')
+        return attrs
+
+
+class OrderUpdateSerializer(serializers.ModelSerializer):
+    '''админ меняет статус и заметки, состав заказа не редактируется'''
+    class Meta:
+        model = Order
+        fields = ('status', 'notes')
+
 
 
 
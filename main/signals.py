@@ -0,0 +1,96 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import catalog_cache, invalidate
+from .images import delete_renditions, generate_renditions
+from .models import Category, Product, Review, WishList
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, **kwargs):
+    '''поддерживаем рейтинг продукта инкрементально'''
+    # не created - прежние значения из from_db или из Review.save
+    old_product_id, old_rating = getattr(instance, '_loaded_rating', (instance.product_id, instance.rating))
+    if created:
+        Product.objects.filter(pk=instance.product_id).apply_rating_delta(instance.rating, 1)
+    elif old_product_id != instance.product_id:
+        Product.objects.filter(pk=old_product_id).apply_rating_delta(-old_rating, -1)
+        Product.objects.filter(pk=instance.product_id).apply_rating_delta(instance.rating, 1)
+        invalidate(catalog_cache.invalidate_product, old_product_id)
+    elif old_rating != instance.rating:
+        Product.objects.filter(pk=instance.product_id).apply_rating_delta(instance.rating - old_rating, 0)
+    else:
+        # рейтинг тот же, но в деталях продукта последние отзывы - ETag/Last-Modified должны смениться
+        Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+    instance._loaded_rating = (instance.product_id, instance.rating)
+    # в деталях продукта отзывы и рейтинг, в списке - рейтинг
+    invalidate(catalog_cache.invalidate_product, instance.product_id)
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    product_id, rating = getattr(instance, '_loaded_rating', (instance.product_id, instance.rating))
+    Product.objects.filter(pk=product_id).apply_rating_delta(-rating, -1)
+    invalidate(catalog_cache.invalidate_product, product_id)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate(catalog_cache.invalidate_product, instance.pk)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_stats_changed(sender, instance, created=False, **kwargs):
+    '''сводка старой и новой категории, если сменились категория или цена'''
+    loaded = getattr(instance, '_loaded_stats', None)
+    current = (instance.category_id, instance.price)
+    if kwargs['signal'] is post_save and not created and loaded == current:
+        return
+    Category.objects.filter(pk__in={current[0], loaded[0] if loaded else None} - {None}).refresh_stats()
+    instance._loaded_stats = current
+
+
+@receiver(post_save, sender=Product)
+def product_image_changed(sender, instance, created=False, **kwargs):
+    name = instance.image.name or ''
+    if name == getattr(instance, '_loaded_image', ''):
+        return
+    instance._loaded_image = name
+    if not created:
+        # копии прежней картинки берём из БД: генерация могла закончиться уже после загрузки instance
+        old = Product.objects.filter(pk=instance.pk).values_list('renditions', flat=True).first()
+        if old:
+            Product.objects.filter(pk=instance.pk).update(renditions={}, updated_at=timezone.now())
+            transaction.on_commit(partial(delete_renditions, old))
+    instance.renditions = {}
+    if name:
+        transaction.on_commit(partial(generate_renditions, instance.pk, name))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    if instance.renditions:
+        transaction.on_commit(partial(delete_renditions, instance.renditions))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    invalidate(catalog_cache.invalidate_lists)
+
+
+@receiver(post_delete, sender=WishList)
+def like_deleted(sender, instance, **kwargs):
+    # например, каскадом при удалении пользователя
+    if instance.is_liked:
+        Product.objects.filter(pk=instance.product_id).update(
+            likes_count=F('likes_count') - 1, updated_at=timezone.now()
+        )
+        invalidate(catalog_cache.invalidate_product, instance.product_id)
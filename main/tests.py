@@ -1,3 +1,1084 @@
-from django.test import TestCase
+import io
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, router, transaction
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from shop.db_routers import ReplicaRoutingMiddleware
+from shop.handlers import ASGIHandler
+
+from . import export
+from .cache import DjangoCache, LRUCache, SharedVersions, catalog_cache
+from .images import generate_renditions, read_image, render_image
+from .importer import ProductImporter, read_rows
+from .models import Category, DailySales, Order, OrderItems, Product, Review, StatusChoices, WishList
+from .search import filter_field, search_products
+from .views import OrderViewSet
+
+User = get_user_model()
+
+
+class ProductRatingTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.phone = Product.objects.create(title='Phone', description='phone', price=10, category=category)
+        self.other = Product.objects.create(title='Phone pro', description='phone', price=30, category=category)
+        self.users = [User.objects.create(f'buyer{i}@test.com', '123456', is_active=True) for i in range(2)]
+
+    def rating(self, product):
+        product = Product.objects.get(pk=product.pk)
+        return product.rating_sum, product.rating_count, product.rating
+
+    def test_reviews_shift_rating(self):
+        review = Review.objects.create(author=self.users[0], product=self.phone, text='ok', rating=4)
+        Review.objects.create(author=self.users[1], product=self.phone, text='ok', rating=1)
+        self.assertEqual(self.rating(self.phone), (5, 2, 2.5))
+
+        review.rating = 2
+        review.save()
+        self.assertEqual(self.rating(self.phone), (3, 2, 1.5))
+        review.product = self.other
+        review.save()
+        self.assertEqual((self.rating(self.phone), self.rating(self.other)), ((1, 1, 1.0), (2, 1, 2.0)))
+        review.delete()
+        self.assertEqual(self.rating(self.other), (0, 0, 0))
+
+    def test_save_of_unloaded_review_is_not_counted_twice(self):
+        review = Review.objects.create(author=self.users[0], product=self.phone, text='ok', rating=4)
+        # объект не из from_db: тот же отзыв, собранный по pk
+        Review(pk=review.pk, author=self.users[0], product=self.phone, text='better', rating=5,
+               created_at=review.created_at).save()
+        self.assertEqual(self.rating(self.phone), (5, 1, 5.0))
+        Review(pk=review.pk, author=self.users[0], product=self.other, text='moved', rating=3,
+               created_at=review.created_at).save()
+        self.assertEqual((self.rating(self.phone), self.rating(self.other)), ((0, 0, 0), (3, 1, 3.0)))
+        self.assertEqual(Category.objects.get(pk='phones').rated_count, 1)
+
+    def test_rebuild_fixes_drifted_counters(self):
+        Review.objects.create(author=self.users[0], product=self.phone, text='ok', rating=4)
+        Review.objects.create(author=self.users[1], product=self.phone, text='ok', rating=2)
+        Product.objects.filter(pk=self.phone.pk).update(rating_sum=100, rating_count=7, rating=1)
+        Product.objects.filter(pk=self.other.pk).apply_rating_delta(5, 1)
+
+        self.assertEqual(Product.objects.rebuild_ratings(), 2)
+        self.assertEqual((self.rating(self.phone), self.rating(self.other)), ((6, 2, 3.0), (0, 0, 0)))
+        phones = Category.objects.get(pk='phones')
+        self.assertEqual((phones.rated_count, phones.rating_avg), (1, 3.0))
+
+    def test_counters_are_not_exposed_or_writable(self):
+        Review.objects.create(author=self.users[0], product=self.phone, text='ok', rating=4)
+        admin = APIClient()
+        admin.force_authenticate(User.objects.create_superuser('admin@test.com', '123456'))
+        response = admin.patch(f'/api/v1/products/{self.phone.pk}/', {
+            'price': 20, 'rating_sum': 100, 'rating_count': 50, 'likes_count': 7, 'sku': 'P-1',
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.rating(self.phone), (4, 1, 4.0))
+        product = Product.objects.get(pk=self.phone.pk)
+        self.assertEqual((product.price, product.likes_count, product.sku), (20, 0, 'P-1'))
+
+        data = APIClient().get(f'/api/v1/products/{self.phone.pk}/').data
+        self.assertEqual(sorted(data), ['category', 'description', 'id', 'image', 'price', 'rating',
+                                        'reviews', 'reviews_count', 'srcset', 'title'])
+        self.assertEqual((data['rating'], data['reviews_count']), (4.0, 1))
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create('buyer@test.com', '123456', is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_cursor_walks_orders_created_in_one_millisecond(self):
+        base = timezone.now().replace(microsecond=123000)
+        for i in range(4):
+            order = Order.objects.create(user=self.user, status=StatusChoices.new, total_sum=10, notes=str(i))
+            Order.objects.filter(pk=order.pk).update(created_at=base + timedelta(microseconds=i * 100))
+
+        expected = list(Order.objects.order_by('created_at', 'pk').values_list('notes', flat=True))
+        seen, url = [], '/api/v1/orders/?pagination=cursor&page_size=1&ordering=created_at'
+        # страниц не больше, чем заказов - иначе курсор зациклился
+        for _ in expected:
+            response = self.client.get(url)
+            seen += [order['notes'] for order in response.data['results']]
+            url = response.data['next']
+            if url is None:
+                break
+        self.assertIsNone(url)
+        self.assertEqual(seen, expected)
+
+        # и обратно по previous
+        seen = []
+        for _ in expected:
+            seen = [order['notes'] for order in response.data['results']] + seen
+            url = response.data['previous']
+            if url is None:
+                break
+            response = self.client.get(url)
+        self.assertIsNone(url)
+        self.assertEqual(seen, expected)
+
+
+class ProductSearchTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.phone = Product.objects.create(title='Phone X', description='smart phone', price=10, category=category)
+        self.case = Product.objects.create(title='Case', description='case for your phone', price=1,
+                                           category=category)
+        self.laptop = Product.objects.create(title='Laptop', description='fast', price=100, category=category)
+
+    def search(self, query):
+        response = APIClient().get('/api/v1/products/', {'search': query})
+        self.assertEqual(response.status_code, 200)
+        return [product['title'] for product in response.data['results']]
+
+    def test_matches_by_prefix_and_ranks_title_higher(self):
+        self.assertEqual(self.search('phone'), ['Phone X', 'Case'])
+        self.assertEqual(self.search('lapt'), ['Laptop'])
+        self.assertEqual(self.search('phone fast'), [])
+        self.assertEqual(self.search('!!!'), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.laptop.title = 'Notebook'
+        self.laptop.save()
+        self.assertEqual(self.search('lapt'), [])
+        self.assertEqual(self.search('notebook'), ['Notebook'])
+
+        self.phone.delete()
+        self.assertEqual(self.search('phone'), ['Case'])
+
+    def test_title_and_description_filters_use_index(self):
+        def titles(params):
+            response = APIClient().get('/api/v1/products/', dict(params, ordering='price'))
+            return [product['title'] for product in response.data['results']]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(titles({'title': 'pho'}), ['Phone X'])
+        self.assertIn('main_product_fts', queries.captured_queries[-1]['sql'])
+        self.assertEqual(titles({'description': 'phone'}), ['Case', 'Phone X'])
+        self.assertEqual(titles({'description': 'your phone', 'title': 'case'}), ['Case'])
+        self.assertEqual(titles({'title': '!!!'}), [])
+
+    def test_other_databases_fall_back_to_icontains(self):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            found = search_products(Product.objects.all(), 'phone')
+            self.assertEqual([product.title for product in found], ['Phone X', 'Case'])
+            found = filter_field(Product.objects.order_by('pk'), 'title', 'hone')
+            self.assertEqual([product.title for product in found], ['Phone X'])
+
+
+class OrderBatchTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create('buyer@test.com', '123456', is_active=True))
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.phone = Product.objects.create(title='Phone', description='phone', price=10, category=category,
+                                            stock=3)
+        self.case = Product.objects.create(title='Case', description='case', price=1, category=category)
+
+    def post(self, data):
+        return self.client.post('/api/v1/orders/batch/', data, format='json')
+
+    def test_batch_creates_orders_items_and_sales(self):
+        batch = [
+            {'products': [{'product': self.phone.pk, 'quantity': 1}, {'product': self.case.pk, 'quantity': 2}]},
+            {'products': [{'product': self.case.pk, 'quantity': 3}], 'notes': 'second'},
+            {'products': [{'product': self.phone.pk, 'quantity': 2}]},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(batch)
+        self.assertEqual(response.status_code, 201)
+        # продукты всех заказов - одним запросом на весь пакет
+        product_selects = [query for query in queries.captured_queries
+                           if query['sql'].startswith('SELECT') and 'FROM "main_product"' in query['sql']]
+        self.assertEqual(len(product_selects), 1)
+
+        totals = list(Order.objects.order_by('pk').values_list('total_sum', 'notes'))
+        self.assertEqual(totals, [(12, ''), (3, 'second'), (20, '')])
+        self.assertEqual(OrderItems.objects.count(), 4)
+        sales = {row.product_id: (row.quantity, row.orders_count) for row in DailySales.objects.all()}
+        self.assertEqual(sales, {self.phone.pk: (3, 2), self.case.pk: (5, 2)})
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock, 0)
+
+    def assertNothingCreated(self):
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItems.objects.exists())
+        self.assertFalse(DailySales.objects.exists())
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock, 3)
+
+    def test_invalid_order_rejects_whole_batch(self):
+        valid = {'products': [{'product': self.case.pk, 'quantity': 1}]}
+        response = self.post([valid, {'products': [{'product': 999, 'quantity': 1}]}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('999', str(response.data[1]['products']))
+        self.assertNothingCreated()
+
+    def test_sold_out_batch_is_rolled_back(self):
+        # каждый заказ по отдельности проходит валидацию, вместе - остатка не хватает
+        order = {'products': [{'product': self.phone.pk, 'quantity': 2}, {'product': self.case.pk, 'quantity': 1}]}
+        response = self.post([order, order])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(self.phone.pk), str(response.data['products']))
+        self.assertNothingCreated()
+
+    def test_batch_body_is_checked(self):
+        order = {'products': [{'product': self.case.pk, 'quantity': 1}]}
+        for data in ([], order, [order] * 101):
+            self.assertEqual(self.post(data).status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderReadQueriesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create('buyer@test.com', '123456', is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.products = [
+            Product.objects.create(title=f'Phone {i}', description='phone', price=10 + i, category=category)
+            for i in range(3)
+        ]
+
+    def create_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(user=self.user, status=StatusChoices.new, total_sum=0)
+            for product in self.products:
+                OrderItems.objects.create(order=order, product=product, quantity=2)
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        self.create_orders(5)
+        # COUNT(*), заказы, позиции вместе с продуктами; ETag считается по ним же
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/orders/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 5)
+
+        # keyset-пагинации COUNT(*) не нужен
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/orders/?pagination=cursor&page_size=3')
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_list_etag_covers_only_requested_page(self):
+        self.create_orders(7)
+        url = '/api/v1/orders/?ordering=created_at'
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(3):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # заказ со второй страницы первую не меняет
+        last = Order.objects.order_by('-created_at').first()
+        Order.objects.filter(pk=last.pk).update(notes='changed', updated_at=timezone.now())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertNotEqual(self.client.get(f'{url}&page=2')['ETag'], etag)
+
+        # продукт в позициях страницы и новый заказ (count в ответе) - меняют
+        self.products[0].title = 'Phone 0 Pro'
+        self.products[0].save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['items'][0]['product']['title'], 'Phone 0 Pro')
+        etag = response['ETag']
+        self.create_orders(1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.data['count']), (200, 8))
+
+    def test_retrieve_contains_item_details(self):
+        self.create_orders(1)
+        order = Order.objects.get()
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/api/v1/orders/{order.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], StatusChoices.new)
+        item = response.data['items'][0]
+        self.assertEqual(item['quantity'], 2)
+        self.assertEqual(item['product']['title'], 'Phone 0')
+        self.assertEqual(item['product']['price'], '10.00')
+        self.assertIn('image', item['product'])
+
+
+class CatalogCacheTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.product = Product.objects.create(title='Phone', description='phone', price=10, category=category)
+        self.url = f'/api/v1/products/{self.product.pk}/'
+        catalog_cache.reset_stats()
+
+    def test_hits_misses_and_invalidation(self):
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'HIT')
+        self.assertEqual(self.client.get('/api/v1/products/')['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/api/v1/products/')['X-Cache'], 'HIT')
+        self.assertEqual(catalog_cache.stats(), {'hits': 2, 'misses': 2, 'hit_rate': 0.5})
+
+        # изменение продукта сбрасывает и детали, и списки
+        self.product.price = 20
+        self.product.save()
+        response = self.client.get(self.url)
+        self.assertEqual((response['X-Cache'], response.data['price']), ('MISS', '20.00'))
+        self.assertEqual(self.client.get('/api/v1/products/')['X-Cache'], 'MISS')
+
+    def test_reads_do_not_create_versions(self):
+        for backend in (LRUCache(max_entries=10, timeout=60), DjangoCache('default', timeout=60)):
+            self.assertEqual(backend.get_versions(['product:999998', 'product:999999']), [0, 0])
+            backend.bump_version('product:1')
+            self.assertNotEqual(backend.get_versions(['product:1']), [0])
+        self.assertEqual(self.client.get('/api/v1/products/999999/').status_code, 404)
+        self.assertIsNone(caches['default'].get(SharedVersions.version_prefix + 'product:999999'))
+
+    def test_invalidation_reaches_other_workers(self):
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'HIT')
+        # у другого воркера свой LRU, но версии те же - сброс там виден и здесь
+        other_worker = LRUCache(max_entries=10, timeout=60)
+        other_worker.bump_version(f'product:{self.product.pk}')
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'MISS')
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.product = Product.objects.create(title='Phone', description='phone', price=10, category=category)
+        self.url = f'/api/v1/products/{self.product.pk}/'
+
+    def test_not_modified_skips_serialization(self):
+        etag = self.client.get(self.url)['ETag']
+        # валидаторы закэшированы вместе с ответом
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_with_product(self):
+        etag = self.client.get(self.url)['ETag']
+        self.product.price = 20
+        self.product.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_malformed_pk_is_not_found(self):
+        self.assertEqual(self.client.get('/api/v1/products/abc/').status_code, 404)
+
+    def test_etag_changes_with_review_text(self):
+        user = User.objects.create('buyer@test.com', '123456', is_active=True)
+        review = Review.objects.create(author=user, product=self.product, text='ok', rating=4)
+        etag = self.client.get(self.url)['ETag']
+        review.text = 'better than expected'
+        review.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['reviews'][0]['text'], 'better than expected')
+
+
+class ProductReviewsTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.product = Product.objects.create(title='Phone', description='phone', price=10, category=category)
+
+    def test_pages_keep_reviews_from_one_millisecond(self):
+        base = timezone.now().replace(microsecond=456000)
+        for i in range(4):
+            author = User.objects.create(f'buyer{i}@test.com', '123456', is_active=True)
+            review = Review.objects.create(author=author, product=self.product, text=f'review {i}', rating=5)
+            Review.objects.filter(pk=review.pk).update(created_at=base + timedelta(microseconds=i * 100))
+
+        client = APIClient()
+        seen, url = [], f'/api/v1/products/{self.product.pk}/reviews/?page_size=1'
+        # по умолчанию -created_at, страниц не больше, чем отзывов
+        for _ in range(4):
+            response = client.get(url)
+            seen += [review['text'] for review in response.data['results']]
+            url = response.data['next']
+            if url is None:
+                break
+        self.assertIsNone(url)
+        self.assertEqual(seen, ['review 3', 'review 2', 'review 1', 'review 0'])
+
+
+class WishListToggleTest(TransactionTestCase):
+    # переключения идут из нескольких потоков - данные должны быть закоммичены
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.product = Product.objects.create(title='Phone', description='phone', price=10, category=category)
+        self.users = [User.objects.create(f'buyer{i}@test.com', '123456', is_active=True) for i in range(4)]
+
+    def toggle(self, user):
+        try:
+            # SQLite не пускает параллельных писателей (table is locked) - повторяем всю транзакцию
+            for _ in range(100):
+                try:
+                    return WishList.objects.toggle(user, self.product)
+                except OperationalError as exc:
+                    error = exc
+                    time.sleep(0.01)
+            raise AssertionError(f'toggle kept failing: {error}')
+        finally:
+            connection.close()
+
+    def test_parallel_toggles_keep_likes_count(self):
+        # нечётное число переключений - лайк, чётное - нет
+        toggles = {user: 5 if i % 2 else 4 for i, user in enumerate(self.users)}
+        tasks = [user for user, count in toggles.items() for _ in range(count)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(self.toggle, tasks))
+
+        liked = set(WishList.objects.filter(is_liked=True).values_list('user', flat=True))
+        self.assertEqual(liked, {user.pk for user, count in toggles.items() if count % 2})
+        self.assertEqual(WishList.objects.count(), len(self.users))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.likes_count, 2)
+        Product.objects.filter(pk=self.product.pk).rebuild_likes_count()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.likes_count, 2)
+
+
+class WishListViewTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.products = [
+            Product.objects.create(title=f'Phone {i}', description='phone', price=10 + i, category=category)
+            for i in range(3)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create('buyer@test.com', '123456', is_active=True))
+
+    def like(self, product, client=None):
+        return (client or self.client).post(f'/api/v1/products/{product.pk}/like/').data
+
+    def wishlist(self):
+        response = self.client.get('/api/v1/me/wishlist/')
+        self.assertTrue(all(product['is_liked'] for product in response.data['results']))
+        return [product['title'] for product in response.data['results']]
+
+    def test_wishlist_orders_by_last_like(self):
+        for product in self.products:
+            self.assertEqual(self.like(product), 'liked')
+        self.assertEqual(self.wishlist(), ['Phone 2', 'Phone 1', 'Phone 0'])
+
+        # лайкнули заново - снова первый
+        self.assertEqual(self.like(self.products[0]), 'disliked')
+        self.assertEqual(self.wishlist(), ['Phone 2', 'Phone 1'])
+        self.like(self.products[0])
+        self.assertEqual(self.wishlist(), ['Phone 0', 'Phone 2', 'Phone 1'])
+        self.assertEqual(APIClient().get('/api/v1/me/wishlist/').status_code, 401)
+
+    def test_is_liked_is_per_user(self):
+        self.like(self.products[1])
+        other = APIClient()
+        other.force_authenticate(User.objects.create('other@test.com', '123456', is_active=True))
+        self.like(self.products[2], other)
+
+        # список и детали общие в кэше каталога - флаги у каждого свои
+        for client, liked in ((self.client, 'Phone 1'), (other, 'Phone 2')):
+            results = client.get('/api/v1/products/').data['results']
+            self.assertEqual({product['title']: product['is_liked'] for product in results},
+                             {f'Phone {i}': f'Phone {i}' == liked for i in range(3)})
+        self.assertTrue(self.client.get(f'/api/v1/products/{self.products[1].pk}/').data['is_liked'])
+        self.assertFalse(other.get(f'/api/v1/products/{self.products[1].pk}/').data['is_liked'])
+
+        anonymous = APIClient()
+        self.assertNotIn('is_liked', anonymous.get('/api/v1/products/').data['results'][0])
+        self.assertNotIn('is_liked', anonymous.get(f'/api/v1/products/{self.products[1].pk}/').data)
+
+
+def make_image(width, height, fmt='JPEG', mode='RGB', **save_kwargs):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new(mode, (width, height), (200, 0, 0, 0) if mode == 'RGBA' else (200, 0, 0)).save(
+        buffer, fmt, **save_kwargs
+    )
+    return buffer.getvalue()
+
+
+class RenditionsTestMixin:
+    '''картинки пишутся во временный MEDIA_ROOT'''
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.category = Category.objects.create(slug='phones', title='Phones')
+
+    def create_product(self, image):
+        return Product.objects.create(title='Phone', description='phone', price=10, category=self.category,
+                                      image=ContentFile(image, name='phone.jpg'))
+
+    def assertFilesExist(self, renditions, exist=True):
+        paths = [path for paths in renditions.values() for path in paths.values()]
+        self.assertTrue(paths)
+        self.assertEqual([default_storage.exists(path) for path in paths], [exist] * len(paths))
+
+
+class RenderImageTest(TestCase):
+    def test_sizes_orientation_and_exif(self):
+        from PIL import Image
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # повёрнута на 90°
+        rendered = render_image(make_image(600, 300, exif=exif.tobytes()), (200, 400, 800), ('webp', 'jpeg'), 80)
+        # ориентация применена (300x600), больше оригинала не увеличиваем
+        self.assertEqual([(width, fmt) for width, fmt, _ in rendered],
+                         [(200, 'webp'), (200, 'jpeg'), (300, 'webp'), (300, 'jpeg')])
+        for width, fmt, data in rendered:
+            image = Image.open(io.BytesIO(data))
+            self.assertEqual((image.format, image.size), (fmt.upper(), (width, width * 2)))
+            self.assertFalse(image.getexif())
+
+    def test_transparent_image_gets_white_background_in_jpeg(self):
+        from PIL import Image
+
+        rendered = render_image(make_image(100, 100, 'PNG', 'RGBA'), (50,), ('webp', 'jpeg'), 80)
+        images = {fmt: Image.open(io.BytesIO(data)) for _, fmt, data in rendered}
+        self.assertEqual(images['webp'].mode, 'RGBA')
+        self.assertEqual(images['jpeg'].convert('RGB').getpixel((25, 25)), (255, 255, 255))
+
+
+@override_settings(IMAGE_RENDITIONS={'SIZES': (200, 400), 'ASYNC': False})
+class ProductRenditionsTest(RenditionsTestMixin, TransactionTestCase):
+    # генерация идёт в on_commit
+    databases = '__all__'
+
+    def test_renditions_follow_product_image(self):
+        product = self.create_product(make_image(300, 150))
+        product.refresh_from_db()
+        old = product.renditions
+        self.assertEqual({fmt: sorted(paths) for fmt, paths in old.items()},
+                         {'webp': ['200', '300'], 'jpeg': ['200', '300']})
+        self.assertFilesExist(old)
+
+        response = APIClient().get(f'/api/v1/products/{product.pk}/')
+        srcset = response.data['srcset']
+        self.assertEqual(srcset['webp'], ', '.join(
+            f'http://testserver{default_storage.url(old["webp"][width])} {width}w' for width in ('200', '300')
+        ))
+        self.assertTrue(srcset['jpeg'].endswith('.jpg 300w'))
+        listed = APIClient().get('/api/v1/products/').data['results'][0]
+        self.assertEqual(listed['srcset'], srcset)
+
+        product.image = ContentFile(make_image(500, 500), name='phone-2.jpg')
+        product.save()
+        product.refresh_from_db()
+        self.assertEqual(sorted(product.renditions['jpeg']), ['200', '400'])
+        self.assertFilesExist(product.renditions)
+        self.assertFilesExist(old, exist=False)
+
+        current = product.renditions
+        product.delete()
+        self.assertFilesExist(current, exist=False)
+
+    @override_settings(IMAGE_RENDITIONS={'SIZES': (200,), 'ASYNC': True})
+    def test_background_generation_saves_in_worker_thread(self):
+        with mock.patch('main.signals.generate_renditions'):
+            product = self.create_product(make_image(300, 150))
+
+        def submit_inline(image_name):
+            future = Future()
+            future.set_result(render_image(read_image(image_name), (200,), ('jpeg',), 80))
+            return future
+
+        with mock.patch('main.images.submit', side_effect=submit_inline):
+            renditions = generate_renditions(product.pk, product.image.name).result(timeout=10)
+        self.assertEqual(Product.objects.get(pk=product.pk).renditions, renditions)
+        self.assertFilesExist(renditions)
+
+        failed = Future()
+        failed.set_exception(OSError('cannot identify image file'))
+        with mock.patch('main.images.submit', return_value=failed), self.assertLogs('main.images', 'ERROR'):
+            with self.assertRaises(OSError):
+                generate_renditions(product.pk, product.image.name).result(timeout=10)
+
+
+class GenerateRenditionsCommandTest(RenditionsTestMixin, TestCase):
+    @override_settings(IMAGE_RENDITIONS={'SIZES': (200,), 'FORMATS': ('jpeg',)})
+    def test_generates_missing_renditions(self):
+        product = self.create_product(make_image(300, 150))
+        broken = self.create_product(b'not an image')
+        Product.objects.create(title='Case', description='case', price=1, category=self.category)
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command('generate_renditions', '--workers', '1', stdout=out, stderr=err)
+        self.assertIn('Generated renditions for 1 products, failed: 1', out.getvalue())
+        self.assertIn(f'Product {broken.pk}', err.getvalue())
+        product.refresh_from_db()
+        self.assertEqual(list(product.renditions['jpeg']), ['200'])
+        self.assertFilesExist(product.renditions)
+
+        # по умолчанию - только где копий ещё нет, --product перегенерирует
+        out = io.StringIO()
+        call_command('generate_renditions', '--workers', '1', stdout=out, stderr=io.StringIO())
+        self.assertIn('Generated renditions for 0 products, failed: 1', out.getvalue())
+        out = io.StringIO()
+        call_command('generate_renditions', '--workers', '1', '--product', str(product.pk), stdout=out)
+        self.assertIn('Generated renditions for 1 products, failed: 0', out.getvalue())
+
+
+class ProductImportTest(TestCase):
+    def run_import(self, feed):
+        errors = []
+        importer = ProductImporter(chunk_size=2, on_reject=lambda line, error: errors.append((line, error)))
+        importer.run(read_rows(io.StringIO(feed), 'csv'))
+        return importer, errors
+
+    def test_creates_then_updates_by_sku(self):
+        importer, errors = self.run_import(
+            'sku,title,price,category,category_title\n'
+            'A-1,Phone,100,phones,Phones\n'
+            'A-2,Case,abc,phones,\n'
+            'A-3,Charger,5,phones,\n'
+        )
+        self.assertEqual((importer.created, importer.updated, importer.rejected), (2, 0, 1))
+        self.assertEqual([line for line, _ in errors], [3])
+        self.assertEqual(Category.objects.get(slug='phones').products_count, 2)
+
+        importer, errors = self.run_import('sku,title,price,category\nA-1,Phone X,150,phones\n')
+        self.assertEqual((importer.created, importer.updated, errors), (0, 1, []))
+        product = Product.objects.get(sku='A-1')
+        self.assertEqual((product.title, str(product.price)), ('Phone X', '150.00'))
+        self.assertEqual(Category.objects.get(slug='phones').title, 'Phones')
+
+    def test_category_title_collision(self):
+        Category.objects.create(slug='mobile', title='phones')
+        importer, errors = self.run_import(
+            'sku,title,price,category,category_title\n'
+            'A-1,Phone,100,phones,\n'
+            'A-2,Tablet,200,tablets,phones\n'
+            'A-3,Watch,50,watches,Watches\n'
+        )
+        # slug без category_title получает свободное название, занятый category_title - ошибка строки
+        self.assertEqual(Category.objects.get(slug='phones').title, 'phones (2)')
+        self.assertEqual(importer.created, 2)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][0], 3)
+        self.assertIn("already used by category 'mobile'", errors[0][1])
+        self.assertFalse(Category.objects.filter(slug='tablets').exists())
+        self.assertEqual(sorted(Product.objects.values_list('sku', flat=True)), ['A-1', 'A-3'])
+
+
+class OrderExportAsgiTest(TransactionTestCase):
+    # view под ASGI выполняется в отдельном потоке - данные должны быть закоммичены;
+    # GET с настроенными репликами читает с реплики
+    databases = '__all__'
+
+    def test_export_streams_through_asgi_handler(self):
+        admin = User.objects.create_superuser('admin@test.com', '123456')
+        token = Token.objects.create(user=admin)
+        category = Category.objects.create(slug='phones', title='Phones')
+        product = Product.objects.create(title='Phone', description='phone', price=10, category=category)
+        for _ in range(3):
+            order = Order.objects.create(user=admin, status=StatusChoices.new, total_sum=20)
+            OrderItems.objects.create(order=order, product=product, quantity=2)
+
+        messages = []
+        # сколько пачек заказов было прочитано к моменту отправки каждого куска
+        chunks_read = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+            if message.get('body'):
+                chunks_read.append(attach_items.call_count)
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': '/api/v1/orders/export/', 'query_string': b'type=csv',
+            'headers': [(b'host', b'testserver'), (b'authorization', f'Token {token.key}'.encode())],
+        }
+        with mock.patch.object(OrderViewSet, 'export_chunk_size', 1), \
+                mock.patch('main.export.attach_items', wraps=export.attach_items) as attach_items:
+            async_to_sync(ASGIHandler())(scope, receive, send)
+        self.assertEqual(messages[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in messages[1:]).decode()
+        self.assertEqual(len(body.splitlines()), 4)
+        self.assertFalse(messages[-1].get('more_body'))
+        # заголовок ушёл до первого запроса заказов, дальше - по пачке на кусок
+        self.assertEqual(chunks_read, [0, 1, 2, 3])
+
+
+class DailySalesTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.phone = Product.objects.create(title='Phone', description='phone', price=10, category=category)
+        self.case = Product.objects.create(title='Case', description='case', price=1, category=category)
+        self.buyer = APIClient()
+        self.buyer.force_authenticate(User.objects.create('buyer@test.com', '123456', is_active=True))
+        self.admin = APIClient()
+        self.admin.force_authenticate(User.objects.create_superuser('admin@test.com', '123456'))
+
+    def sales(self):
+        return {row.product_id: (row.quantity, row.orders_count) for row in DailySales.objects.all()}
+
+    def test_cancelled_orders_are_excluded(self):
+        for quantity in (1, 2):
+            response = self.buyer.post('/api/v1/orders/', {'products': [
+                {'product': self.case.pk, 'quantity': quantity}, {'product': self.phone.pk, 'quantity': quantity},
+            ]}, format='json')
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.sales(), {self.phone.pk: (3, 2), self.case.pk: (3, 2)})
+
+        first, second = Order.objects.order_by('pk')
+        self.admin.patch(f'/api/v1/orders/{first.pk}/', {'status': StatusChoices.cancelled}, format='json')
+        self.assertEqual(self.sales(), {self.phone.pk: (2, 1), self.case.pk: (2, 1)})
+        self.admin.patch(f'/api/v1/orders/{second.pk}/', {'status': StatusChoices.cancelled}, format='json')
+        self.assertEqual(self.sales(), {})
+
+        # вернули из отмены - снова в сводке, так же, как после полного пересчёта
+        self.admin.patch(f'/api/v1/orders/{first.pk}/', {'status': StatusChoices.new}, format='json')
+        self.assertEqual(self.sales(), {self.phone.pk: (1, 1), self.case.pk: (1, 1)})
+        DailySales.objects.rebuild()
+        self.assertEqual(self.sales(), {self.phone.pk: (1, 1), self.case.pk: (1, 1)})
+
+
+class BenchmarkTest(TransactionTestCase):
+    '''сам бенчмарк гоняется через manage.py benchmark, тут - что он не сломан'''
+    # без общей транзакции GET-и с настроенными репликами идут на реплику - там тоже считаем запросы
+    databases = '__all__'
+
+    def test_scenarios_run_without_errors(self):
+        from .benchmark import compare, default_scenarios, run_scenarios, seed
+
+        counts = {'categories': 2, 'products': 20, 'users': 5, 'reviews': 30, 'likes': 10, 'orders': 10}
+        data = seed(counts)
+        self.assertEqual(Product.objects.count(), 20)
+        results = run_scenarios(default_scenarios(), data, iterations=3, warmup=1)
+        self.assertEqual(compare(results, results, tolerance=0), [])
+        self.assertGreater(results['product_detail_cold']['queries'], 0)
+
+        leaner = {name: dict(result, queries=result['queries'] - 1) for name, result in results.items()}
+        self.assertEqual(len(compare(results, leaner, tolerance=0)), len(results))
+
+    def test_queries_are_counted_on_all_connections(self):
+        from .benchmark import capture_queries
+
+        with capture_queries() as captured:
+            for alias in connections:
+                Product.objects.using(alias).count()
+        self.assertEqual(sum(len(context) for context in captured), len(connections.all()))
+
+    def test_percentile_is_nearest_rank(self):
+        from .benchmark import percentile
+
+        values = list(range(1, 21))
+        self.assertEqual([percentile(values, p) for p in (0, 50, 90, 95, 99, 100)], [1, 10, 18, 19, 20, 20])
+        self.assertEqual(percentile([7], 95), 7)
+
+
+class RequestTimingTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        Product.objects.create(title='Phone', description='phone', price=10, category=category)
+
+    def test_server_timing_header(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser('admin@test.com', '123456'))
+        response = client.get('/api/v1/products/')
+        timing = response['Server-Timing']
+        for metric in ('db;dur=', 'view;dur=', 'render;dur=', 'total;dur='):
+            self.assertIn(metric, timing)
+        # валидатор ETag, COUNT(*), продукты, лайки пользователя
+        self.assertIn('desc="4 queries"', timing)
+
+    def test_server_timing_is_hidden_from_public(self):
+        self.assertNotIn('Server-Timing', APIClient().get('/api/v1/products/'))
+        with override_settings(DEBUG=True):
+            self.assertIn('Server-Timing', APIClient().get('/api/v1/products/'))
+
+    def test_slow_request_is_logged(self):
+        with override_settings(REQUEST_TIMING={'SLOW_QUERIES': 0}):
+            with self.assertLogs('shop.requests.slow', 'WARNING') as logs:
+                APIClient().get('/api/v1/products/')
+        self.assertIn('"slowest"', logs.output[0])
+
+
+class AsyncViewsTest(TransactionTestCase):
+    # запросы идут из потоков пула main/async_views.py - данные должны быть закоммичены
+    databases = '__all__'
+
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.product = Product.objects.create(title='Phone', description='phone', price=10, category=category)
+
+    def test_product_list_and_detail(self):
+        client = AsyncClient()
+        response = async_to_sync(client.get)('/api/v1/async/products/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['id'], self.product.pk)
+
+        response = async_to_sync(client.get)(f'/api/v1/async/products/{self.product.pk}/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = async_to_sync(client.get)(f'/api/v1/async/products/{self.product.pk}/',
+                                             headers=[(b'if-none-match', etag.encode())])
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(DEBUG=True)
+    def test_sync_view_queries_are_counted(self):
+        # sync view под ASGI выполняется не в том потоке, где middleware
+        response = async_to_sync(AsyncClient().get)(f'/api/v1/products/{self.product.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('desc="0 queries"', response['Server-Timing'])
+
+
+@override_settings(DATABASE_ROUTING={'REPLICAS': ['replica1']})
+class ReplicaRoutingTest(TransactionTestCase):
+    # TestCase держит тест в transaction.atomic(), а внутри транзакции всё читается с primary
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.routed = {}
+        self.middleware = ReplicaRoutingMiddleware(self.get_response)
+
+    def get_response(self, request):
+        self.routed = {'read': router.db_for_read(Product), 'write': router.db_for_write(Product)}
+        with transaction.atomic():
+            self.routed['atomic_read'] = router.db_for_read(Product)
+        return HttpResponse()
+
+    def test_safe_reads_go_to_replica(self):
+        self.middleware(self.factory.get('/api/v1/products/'))
+        self.assertEqual(self.routed, {'read': 'replica1', 'write': 'default', 'atomic_read': 'default'})
+        # вне запроса - primary
+        self.assertEqual(router.db_for_read(Product), 'default')
+
+    def test_client_reads_own_writes_from_primary(self):
+        response = self.middleware(self.factory.post('/api/v1/orders/', HTTP_AUTHORIZATION='Token one'))
+        self.assertEqual(self.routed['read'], 'default')
+
+        # после записи: по cookie и по тому же токену - primary, другой клиент - реплика
+        cookie = response.cookies['db_primary']
+        self.factory.cookies[cookie.key] = cookie.value
+        self.middleware(self.factory.get('/api/v1/orders/'))
+        self.assertEqual(self.routed['read'], 'default')
+        self.factory.cookies.clear()
+        self.middleware(self.factory.get('/api/v1/orders/', HTTP_AUTHORIZATION='Token one'))
+        self.assertEqual(self.routed['read'], 'default')
+        self.middleware(self.factory.get('/api/v1/orders/', HTTP_AUTHORIZATION='Token two'))
+        self.assertEqual(self.routed['read'], 'replica1')
+
+
+class PriceAdjustmentTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser('admin@test.com', '123456'))
+        phones = Category.objects.create(slug='phones', title='Phones')
+        laptops = Category.objects.create(slug='laptops', title='Laptops')
+        self.phone = Product.objects.create(title='Phone', description='phone', price='19.99', category=phones)
+        self.cheap_phone = Product.objects.create(title='Cheap phone', description='phone', price='3.00',
+                                                  category=phones)
+        self.laptop = Product.objects.create(title='Laptop', description='laptop', price=1000, category=laptops)
+
+    def prices(self):
+        return {product.pk: str(product.price) for product in Product.objects.all()}
+
+    def test_dry_run_only_counts(self):
+        before = self.prices()
+        response = self.client.post('/api/v1/products/adjust_prices/?category=phones',
+                                    {'percent': '-15', 'dry_run': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['matched'], 2)
+        self.assertEqual(response.data['updated'], 0)
+        self.assertEqual(response.data['new_price_max'], '16.99')
+        self.assertEqual(self.prices(), before)
+
+    def test_adjusts_filtered_products_and_resets_cache(self):
+        self.assertEqual(APIClient().get(f'/api/v1/products/{self.phone.pk}/').data['price'], '19.99')
+        response = self.client.post('/api/v1/products/adjust_prices/?category=phones&price_from=10',
+                                    {'percent': '-15'}, format='json')
+        self.assertEqual(response.data['updated'], 1)
+        self.assertEqual(APIClient().get(f'/api/v1/products/{self.phone.pk}/').data['price'], '16.99')
+
+        # цена не уходит ниже нуля, остальные продукты не тронуты
+        self.client.post('/api/v1/products/adjust_prices/?title=cheap', {'amount': '-5'}, format='json')
+        self.assertEqual(self.prices(), {self.phone.pk: '16.99', self.cheap_phone.pk: '0.00',
+                                         self.laptop.pk: '1000.00'})
+
+    def test_requires_admin_and_one_change(self):
+        response = self.client.post('/api/v1/products/adjust_prices/', {'percent': 5, 'amount': 1}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = APIClient().post('/api/v1/products/adjust_prices/', {'percent': 5}, format='json')
+        self.assertIn(response.status_code, (401, 403))
+
+
+class StockTest(TransactionTestCase):
+    # заказы создаются из нескольких потоков - данные должны быть закоммичены
+    def setUp(self):
+        category = Category.objects.create(slug='phones', title='Phones')
+        self.product = Product.objects.create(title='Phone', description='phone', price=10, category=category,
+                                              stock=10)
+        self.unlimited = Product.objects.create(title='Case', description='case', price=1, category=category)
+        self.users = [User.objects.create(f'buyer{i}@test.com', '123456', is_active=True) for i in range(30)]
+
+    def checkout(self, user, products):
+        client = APIClient(raise_request_exception=False)
+        client.force_authenticate(user)
+        try:
+            # SQLite не пускает параллельных писателей (500, table is locked) - клиент повторяет
+            for _ in range(50):
+                response = client.post('/api/v1/orders/', {'products': products}, format='json')
+                if response.status_code != 500:
+                    return response.status_code
+            return 500
+        finally:
+            connection.close()
+
+    def test_parallel_checkouts_do_not_oversell(self):
+        products = [{'product': self.product.pk, 'quantity': 1}, {'product': self.unlimited.pk, 'quantity': 1}]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            statuses = list(executor.map(lambda user: self.checkout(user, products), self.users))
+        self.assertNotIn(500, statuses)
+        # считаем по БД: на SQLite ответ 500 возможен и после коммита заказа
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(Order.objects.count(), 10)
+        # неудачный заказ откатывается целиком, вместе с позицией без учёта остатка
+        self.assertEqual(OrderItems.objects.filter(product=self.unlimited).count(), 10)
+
+    def test_cancel_restores_stock(self):
+        self.assertEqual(self.checkout(self.users[0], [{'product': self.product.pk, 'quantity': 4}]), 201)
+        order = Order.objects.get()
+        admin = APIClient()
+        admin.force_authenticate(User.objects.create_superuser('admin@test.com', '123456'))
+        admin.patch(f'/api/v1/orders/{order.pk}/', {'status': StatusChoices.cancelled}, format='json')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 10)
+
+        # вернуть из отмены можно, только если остаток ещё есть
+        Product.objects.filter(pk=self.product.pk).update(stock=3)
+        response = admin.patch(f'/api/v1/orders/{order.pk}/', {'status': StatusChoices.new}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Order.objects.get().status, StatusChoices.cancelled)
+
+    def test_save_keeps_counters_changed_since_load(self):
+        stale = Product.objects.get(pk=self.product.pk)
+        self.assertEqual(self.checkout(self.users[0], [{'product': self.product.pk, 'quantity': 4}]), 201)
+        Product.objects.filter(pk=self.product.pk).apply_rating_delta(5, 1)
+
+        admin = APIClient()
+        admin.force_authenticate(User.objects.create_superuser('admin@test.com', '123456'))
+        response = admin.patch(f'/api/v1/products/{self.product.pk}/', {'price': 20}, format='json')
+        self.assertEqual(response.status_code, 200)
+        stale.title = 'Phone 2'
+        stale.save()
+        product = Product.objects.get(pk=self.product.pk)
+        self.assertEqual((product.title, product.stock, product.rating_count), ('Phone 2', 6, 1))
+
+        # явно выставленный остаток сохраняется
+        stale.stock = 50
+        stale.save()
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 50)
+
+
+class CategoryStatsTest(TestCase):
+    def setUp(self):
+        self.phones = Category.objects.create(slug='phones', title='Phones')
+        self.laptops = Category.objects.create(slug='laptops', title='Laptops')
+        self.phone = Product.objects.create(title='Phone', description='phone', price=10, category=self.phones)
+        Product.objects.create(title='Phone pro', description='phone', price=30, category=self.phones)
+
+    def categories(self):
+        return {row['slug']: row for row in APIClient().get('/api/v1/categories/').data}
+
+    def test_stats_follow_product_changes(self):
+        phones = self.categories()['phones']
+        self.assertEqual((phones['products_count'], phones['price_min'], phones['price_max']), (2, '10.00', '30.00'))
+        self.assertEqual(self.categories()['laptops']['products_count'], 0)
+
+        # перенос в другую категорию пересчитывает обе, ответ из кэша сбрасывается
+        self.phone.category = self.laptops
+        self.phone.price = 50
+        self.phone.save()
+        categories = self.categories()
+        self.assertEqual((categories['phones']['products_count'], categories['phones']['price_min']), (1, '30.00'))
+        self.assertEqual((categories['laptops']['products_count'], categories['laptops']['price_max']),
+                         (1, '50.00'))
+
+        user = User.objects.create('buyer@test.com', '123456', is_active=True)
+        Review.objects.create(author=user, product=self.phone, text='ok', rating=4)
+        self.assertEqual(self.categories()['laptops']['rating_avg'], 4.0)
+
+    def test_review_changes_shift_rating_avg(self):
+        users = [User.objects.create(f'buyer{i}@test.com', '123456', is_active=True) for i in range(3)]
+        pro = Product.objects.get(title='Phone pro')
+        Review.objects.create(author=users[0], product=self.phone, text='ok', rating=4)
+        Review.objects.create(author=users[1], product=self.phone, text='ok', rating=1)
+        review = Review.objects.create(author=users[2], product=pro, text='ok', rating=5)
+        self.assertAlmostEqual(Category.objects.get(pk='phones').rating_avg, (2.5 + 5) / 2)
+
+        review.rating = 3
+        review.save()
+        self.assertAlmostEqual(Category.objects.get(pk='phones').rating_avg, (2.5 + 3) / 2)
+        review.delete()
+        phones = Category.objects.get(pk='phones')
+        self.assertEqual((phones.rated_count, phones.rating_avg), (1, 2.5))
+
+        # совпадает с полным пересчётом
+        Category.objects.refresh_stats()
+        self.assertEqual(Category.objects.get(pk='phones').rating_avg, 2.5)
+        Review.objects.filter(product=self.phone).delete()
+        phones = Category.objects.get(pk='phones')
+        self.assertEqual((phones.rated_count, phones.rating_total, phones.rating_avg), (0, 0, 0))
+
+    def test_list_is_cached_and_conditional(self):
+        client = APIClient()
+        response = client.get('/api/v1/categories/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        response = client.get('/api/v1/categories/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(client.get('/api/v1/categories/')['X-Cache'], 'HIT')
+
+
+class ProductFacetsTest(TestCase):
+    def setUp(self):
+        phones = Category.objects.create(slug='phones', title='Phones')
+        laptops = Category.objects.create(slug='laptops', title='Laptops')
+        for price, rating_count in ((50, 0), (150, 1), (700, 1)):
+            Product.objects.create(title='Phone', description='phone', price=price, category=phones,
+                                   rating=4.5 if rating_count else 0, rating_count=rating_count)
+        Product.objects.create(title='Laptop', description='laptop', price=1500, category=laptops,
+                               rating=3, rating_count=2)
+
+    def test_facets_for_filtered_list(self):
+        # валидатор ETag, COUNT(*), продукты, GROUP BY по категориям, один запрос на интервалы цены и рейтинга
+        with self.assertNumQueries(5):
+            response = APIClient().get('/api/v1/products/?price_from=100&facets=category,price,rating'
+                                       '&price_buckets=100,1000')
+        facets = response.data['facets']
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([(row['slug'], row['count']) for row in facets['category']], [('laptops', 1), ('phones', 2)])
+        self.assertEqual(facets['price'], [{'from': None, 'to': '100.00', 'count': 0},
+                                           {'from': '100.00', 'to': '1000.00', 'count': 2},
+                                           {'from': '1000.00', 'to': None, 'count': 1}])
+        self.assertEqual([(row['from'], row['count']) for row in facets['rating']], [(4, 2), (3, 3), (2, 3), (1, 3)])
+
+    def test_facets_are_opt_in_and_validated(self):
+        self.assertNotIn('facets', APIClient().get('/api/v1/products/').data)
+        self.assertEqual(APIClient().get('/api/v1/products/?facets=colour').status_code, 400)
+        self.assertEqual(APIClient().get('/api/v1/products/?facets=price&price_buckets=500,100').status_code, 400)
+        # не влезает в поле цены - 400, а не InvalidOperation в quantize
+        self.assertEqual(APIClient().get('/api/v1/products/?facets=price&price_buckets=0,1e30').status_code, 400)
+
+    def test_bad_facets_are_rejected_before_querying(self):
+        for query in ('facets=colour', 'facets=price&price_buckets=500,100'):
+            with self.assertNumQueries(0):
+                self.assertEqual(APIClient().get(f'/api/v1/products/?{query}').status_code, 400)
@@ -1,17 +1,30 @@
-from django.db.models import Avg
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Avg, Count, F, Max, Min, Prefetch, Sum
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 import django_filters.rest_framework as filters
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.filters import OrderingFilter
 from rest_framework import viewsets, mixins
 from rest_framework.generics import ListAPIView, RetrieveAPIView, CreateAPIView, UpdateAPIView, DestroyAPIView
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from .cache import CatalogCacheMixin, catalog_cache, invalidate
+from .conditional import ConditionalGetMixin
+from .export import CONTENT_TYPES, EXPORTERS
+from .facets import compute_facets, get_options as get_facet_options, parse_facets, parse_price_buckets
 from .filters import ProductFilter, OrderFilter
-from .models import Product, Review, Order, WishList
+from .models import Category, Product, Review, Order, OrderItems, WishList, DailySales, OutOfStock
+from .pagination import ShopPagination, KeysetPagination
 from .permissions import IsAuthororAdminPermission, DenyAll
-from .serializers import (ProductListSerializer,
-                          ProductDetailsSerializer, ReviewSerializer, OrderSerializer)
+from .serializers import (CategorySerializer, ProductListSerializer, ProductDetailsSerializer, ReviewSerializer,
+                          OrderSerializer, OrderDetailsSerializer, OrderUpdateSerializer, SalesQuerySerializer,
+                          PriceAdjustmentSerializer)
 
 
 # 1.Список товаров, доступен всем пользователям
@@ -64,12 +77,38 @@ from .serializers import (ProductListSerializer,
 #     serializer_class = ProductDetailsSerializer
 #     permission_classes = [IsAdminUser]
 
-class ProductViewSet(viewsets.ModelViewSet):
+def mark_liked(products, user):
+    '''is_liked для всей страницы продуктов - одним запросом к WishList'''
+    if not user.is_authenticated:
+        return
+    ids = [product['id'] for product in products]
+    liked = set(WishList.objects.filter(user=user, product_id__in=ids, is_liked=True)
+                .values_list('product_id', flat=True))
+    for product in products:
+        product['is_liked'] = product['id'] in liked
+
+
+# api/v1/categories/ - категории со сводкой по продуктам, для навигации
+class CategoryViewSet(ConditionalGetMixin, CatalogCacheMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Category.objects.order_by('title')
+    serializer_class = CategorySerializer
+    # категорий немного, навигации нужны все сразу
+    pagination_class = None
+
+    def get_cache_versions(self):
+        # сводка меняется вместе с любым продуктом категории, а они поднимают версию списков
+        return ['catalog', 'list']
+
+
+class ProductViewSet(ConditionalGetMixin, CatalogCacheMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductDetailsSerializer
     filter_backends = (filters.DjangoFilterBackend, OrderingFilter)
     filterset_class = ProductFilter
-    ordering_fields = ['title', 'price']
+    ordering_fields = ['title', 'price', 'rating']
+    pagination_class = ShopPagination
+    cached_actions = ('list', 'retrieve', 'reviews')
+    review_ordering_fields = ['created_at', 'rating']
 
 
     def get_serializer_class(self):
@@ -78,12 +117,56 @@ class ProductViewSet(viewsets.ModelViewSet):
         return super().get_serializer_class()
 
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update', 'destroy']:
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'adjust_prices']:
             return [IsAdminUser()]
         elif self.action in ['create_review', 'like']:
             return [IsAuthenticated()]
+        elif self.action == 'cache_stats':
+            return [IsAdminUser()]
         return []
 
+    # ?facets=category,price,rating - счётчики для фильтров рядом со страницей, см. main/facets.py.
+    # считаются внутри кэшируемой части list, ключ кэша учитывает параметры
+    facet_params = None
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.action == 'list' and self.facet_params is not None:
+            response.data['facets'] = self.get_facets(*self.facet_params)
+        return response
+
+    def parse_facet_params(self, params):
+        if not params.get('facets'):
+            return None
+        names = parse_facets(params['facets'])
+        edges = None
+        if params.get('price_buckets'):
+            edges = parse_price_buckets(params['price_buckets'], get_facet_options()['MAX_PRICE_BUCKETS'])
+        return names, edges
+
+    def get_facets(self, names, edges):
+        return compute_facets(self.filter_queryset(self.get_queryset()), names, edges)
+
+    # кэш общий для всех, is_liked добавляется поверх (в т.ч. закэшированного ответа)
+    def list(self, request, *args, **kwargs):
+        # кривые facets/price_buckets - сразу 400, до страницы и COUNT
+        self.facet_params = self.parse_facet_params(request.query_params)
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == 200:
+            mark_liked(response.data['results'], request.user)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        if response.status_code == 200:
+            mark_liked([response.data], request.user)
+        return response
+
+    # api/v1/products/cache_stats/ - счётчики кэша каталога этого процесса
+    @action(detail=False, methods=['GET'])
+    def cache_stats(self, request):
+        return Response(catalog_cache.stats())
+
     # api/v1/products/id/create_review/
     @action(detail=True, methods=['POST'])
     def create_review(self, request, pk):
@@ -97,20 +180,117 @@ class ProductViewSet(viewsets.ModelViewSet):
         else:
             return Response(serializer.errors, status=400)
 
+    # api/v1/products/id/reviews/?ordering=-rating
+    @action(detail=True, methods=['GET'])
+    def reviews(self, request, pk):
+        return self.cached(self.list_reviews, request, pk)
+
+    def list_reviews(self, request, pk):
+        if not Product.objects.filter(pk=pk).exists():
+            raise NotFound()
+        ordering = request.query_params.get('ordering', '-created_at')
+        if ordering.lstrip('-') not in self.review_ordering_fields:
+            ordering = '-created_at'
+        queryset = Review.objects.filter(product_id=pk).select_related('author').order_by(ordering)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = ReviewSerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+
+    # api/v1/products/adjust_prices/?category=&price_from=&price_to=&title=
+    # {"percent": -10} или {"amount": "5.00"}, "dry_run": true - только посчитать
+    @action(detail=False, methods=['POST'])
+    def adjust_prices(self, request):
+        params = PriceAdjustmentSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        percent, amount = params.validated_data.get('percent'), params.validated_data.get('amount')
+        queryset = filters.DjangoFilterBackend().filter_queryset(request, Product.objects.all(), self)
+        new_price = queryset.adjusted_price(percent, amount)
+        with transaction.atomic():
+            stats = queryset.aggregate(matched=Count('pk'), price_min=Min('price'), price_max=Max('price'),
+                                       new_price_min=Min(new_price), new_price_max=Max(new_price))
+            if stats['new_price_max'] is not None and stats['new_price_max'] >= 10 ** 8:
+                return Response('New price does not fit into the price field', status=400)
+            updated = 0
+            if not params.validated_data['dry_run']:
+                # до UPDATE: после него фильтр по цене может уже не найти те же продукты
+                categories = list(queryset.order_by().values_list('category', flat=True).distinct())
+                updated = queryset.adjust_prices(percent, amount)
+                Category.objects.filter(pk__in=categories).refresh_stats()
+                # продуктов может быть тысячи - сбрасываем весь каталог одной версией
+                invalidate(catalog_cache.invalidate_all)
+        data = {'dry_run': params.validated_data['dry_run'], 'matched': stats.pop('matched'), 'updated': updated}
+        data.update((key, None if value is None else format_money(value)) for key, value in stats.items())
+        return Response(data)
+
     @action(detail=True, methods=['POST'])
     def like(self, request, pk):
         product = self.get_object()
-        user = request.user
-        like_obj, created = WishList.objects.get_or_create(product=product, user=user)
+        is_liked = WishList.objects.toggle(request.user, product)
+        invalidate(catalog_cache.invalidate_product, product.pk)
+        return Response('liked' if is_liked else 'disliked')
+
+
+# api/v1/me/wishlist/ - лайкнутые продукты, последние лайки первыми
+class WishListView(ListAPIView):
+    serializer_class = ProductListSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = ShopPagination
 
-        if like_obj.is_liked:
-            like_obj.is_liked = False
-            like_obj.save()
-            return Response('disliked')
+    def get_queryset(self):
+        return (Product.objects
+                .filter(wishlist__user=self.request.user, wishlist__is_liked=True)
+                .annotate(liked_at=F('wishlist__liked_at'), liked_id=F('wishlist__id'))
+                .order_by('-liked_at', '-liked_id'))
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        for product in response.data['results']:
+            product['is_liked'] = True
+        return response
+
+
+def format_money(value):
+    # как DecimalField в сериализаторах: строка с двумя знаками
+    return str(Decimal(value).quantize(Decimal('0.01')))
+
+
+# api/v1/analytics/sales/?date_from=&date_to=&group_by=day|product|category - только админы
+class SalesSummaryView(APIView):
+    '''отчёт по продажам из сводки DailySales, без агрегации заказов'''
+    permission_classes = [IsAdminUser]
+    group_fields = {
+        'day': ('day',),
+        'product': ('product_id', 'product__title'),
+        'category': ('product__category_id',),
+    }
+    output_names = {'product__title': 'title', 'product__category_id': 'category'}
+
+    def get(self, request):
+        params = SalesQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+        queryset = DailySales.objects.filter(day__range=(params['date_from'], params['date_to']))
+        if 'product' in params:
+            queryset = queryset.filter(product_id=params['product'])
+        if 'category' in params:
+            queryset = queryset.filter(product__category_id=params['category'])
+
+        sums = {'quantity': Sum('quantity'), 'revenue': Sum('revenue'), 'orders_count': Sum('orders_count')}
+        totals = queryset.aggregate(**sums)
+        rows = queryset.values(*self.group_fields[params['group_by']]).annotate(**sums)
+        if params['group_by'] == 'day':
+            rows = rows.order_by('day')
         else:
-            like_obj.is_liked = True
-            like_obj.save()
-            return Response('liked')
+            rows = rows.order_by('-revenue')[:params['limit']]
+        results = []
+        for row in rows:
+            row = {self.output_names.get(key, key): value for key, value in row.items()}
+            row['revenue'] = format_money(row['revenue'])
+            results.append(row)
+        totals = {key: value or 0 for key, value in totals.items()}
+        totals['revenue'] = format_money(totals['revenue'])
+        return Response({'totals': totals, 'results': results})
 
 
 # 4. Создание отзывов, доступно только залогиненным пользователям
@@ -135,27 +315,90 @@ class ReviewViewSet(mixins.CreateModelMixin,
         return [IsAuthororAdminPermission()]
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
     filter_backends = (filters.DjangoFilterBackend, OrderingFilter)
     filterset_class = OrderFilter
     ordering_fields = ['total_sum', 'created_at']
+    pagination_class = ShopPagination
+    # в заказе показываются название/цена продуктов; join с позициями - только по странице,
+    # её позиции и продукты всё равно подгружаются для ответа (см. main/conditional.py)
+    conditional_fields = ('updated_at', 'items__product__updated_at')
+    conditional_per_page = True
+    max_batch_size = 100
+    export_chunk_size = 2000
 
     def get_permissions(self):
-        if self.action in ['create', 'list', 'retrieve']:
+        if self.action in ['create', 'list', 'retrieve', 'batch']:
             return [IsAuthenticated()]
-        elif self.action in ['update', 'partial_update']:
+        elif self.action in ['update', 'partial_update', 'export']:
             return [IsAdminUser()]
         else:
             return [DenyAll()]
 
+    def get_serializer_class(self):
+        if self.action in ['list', 'retrieve']:
+            return OrderDetailsSerializer
+        if self.action in ['update', 'partial_update']:
+            return OrderUpdateSerializer
+        return super().get_serializer_class()
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            # блокировка строки: два параллельных "отменить" не вычтут заказ из сводки
+            # и не вернут остаток дважды
+            old_status = Order.objects.select_for_update().values_list('status', flat=True).get(
+                pk=serializer.instance.pk
+            )
+            order = serializer.save()
+            DailySales.objects.apply_status_change(order.pk, old_status, order.status)
+            try:
+                order.apply_stock_change(old_status)
+            except OutOfStock as exc:
+                raise ValidationError({'status': [str(exc)]})
+
     def get_queryset(self):
         queryset = super().get_queryset()
         if not self.request.user.is_staff:
             queryset = queryset.filter(user=self.request.user)
+        if self.action in ['list', 'retrieve']:
+            # позиции вместе с продуктами одним запросом на всю страницу
+            items = OrderItems.objects.select_related('product')
+            queryset = queryset.prefetch_related(Prefetch('items', queryset=items))
         return queryset
 
+    # api/v1/orders/batch/ - список заказов одним запросом (для B2B)
+    @action(detail=False, methods=['POST'])
+    def batch(self, request):
+        if not isinstance(request.data, list) or not request.data:
+            return Response('Expected a non-empty list of orders', status=400)
+        if len(request.data) > self.max_batch_size:
+            return Response(f'Batch cannot contain more than {self.max_batch_size} orders', status=400)
+        serializer = self.get_serializer(data=request.data, many=True)
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data, status=201)
+        else:
+            return Response(serializer.errors, status=400)
+
+    # api/v1/orders/export/?type=csv|ndjson - все заказы по фильтрам одним потоком (для админов)
+    @action(detail=False, methods=['GET'])
+    def export(self, request):
+        export_type = request.query_params.get('type', 'csv')
+        if export_type not in EXPORTERS:
+            return Response(f'type must be one of: {", ".join(EXPORTERS)}', status=400)
+        queryset = self.filter_queryset(self.get_queryset())
+        if not queryset.ordered:
+            queryset = queryset.order_by('pk')
+        # ответ читается уже после middleware: БД (реплику) выбираем сейчас
+        queryset = queryset.using(queryset.db)
+        content = EXPORTERS[export_type](queryset, self.export_chunk_size)
+        response = StreamingHttpResponse(content, content_type=CONTENT_TYPES[export_type])
+        filename = f'orders-{timezone.now():%Y%m%d-%H%M%S}.{export_type}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
 #products/
 # POST - create
 # GET -list
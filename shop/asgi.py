@@ -9,8 +9,9 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+from shop.handlers import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shop.settings')
 
+# свой ASGIHandler: StreamingHttpResponse (orders/export/) отдаётся по кускам, см. shop/handlers.py
 application = get_asgi_application()
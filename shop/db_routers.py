@@ -0,0 +1,145 @@
+'''
+Чтение с реплик БД (settings.DATABASE_ROUTING['REPLICAS'] - алиасы из DATABASES).
+
+ReplicaRoutingMiddleware на каждый запрос решает, откуда читать:
+    - безопасные методы (GET, HEAD, OPTIONS) - со случайной реплики,
+      одной на весь запрос, чтобы не смешивать данные реплик с разным отставанием
+    - POST/PUT/PATCH/DELETE - всё с primary
+    - после любого небезопасного запроса клиент PIN_SECONDS секунд читает с primary
+      (read-your-own-writes): ставим cookie PIN_COOKIE и, если был заголовок
+      Authorization, отметку в кэше CACHES[PIN_CACHE_ALIAS] - API клиенты cookie
+      обычно не хранят. При нескольких воркерах кэш должен быть общим.
+
+Локально реплику можно изобразить вторым файлом SQLite: DB_ENGINE=django.db.backends.sqlite3,
+DB_REPLICAS=replica.sqlite3, migrate и копия файла primary -> replica
+(migrate для реплик ничего не делает). Записи на primary в копию не попадут -
+так удобно смотреть, откуда читает запрос.
+
+ReplicaRouter только читает выбор middleware. Вне запроса (manage.py, сигналы,
+пул картинок) и внутри transaction.atomic() на primary всё идёт на primary,
+запись - всегда на primary, даже для объектов, прочитанных с реплики.
+Принудительно читать с primary внутри запроса - with use_primary().
+
+Выбор хранится в contextvar: под ASGI он виден и в sync_to_async,
+и в пуле main/async_views.py (пул копирует контекст).
+StreamingHttpResponse отдаётся уже после middleware - генератор должен
+сам запомнить алиас (queryset.using(queryset.db)), иначе прочитает с primary.
+
+Кэш каталога может успеть закэшировать ответ с отстающей реплики сразу после
+сброса - такой ответ живёт не дольше CATALOG_CACHE['TIMEOUT'].
+'''
+import asyncio
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+
+DEFAULT_SETTINGS = {
+    'REPLICAS': [],
+    'PIN_SECONDS': 5,
+    'PIN_COOKIE': 'db_primary',
+    'PIN_CACHE_ALIAS': 'default',
+}
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# алиас реплики для текущего запроса, None - primary
+_read_alias = ContextVar('db_read_alias', default=None)
+
+
+def get_options():
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'DATABASE_ROUTING', {}))
+
+
+@contextmanager
+def use_primary():
+    token = _read_alias.set(None)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # без этого Django пишет в ту БД, откуда объект прочитан (instance._state.db)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # на репликах те же данные, что и на primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # схему и данные реплика получает от primary
+        if db in get_options()['REPLICAS']:
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.options = get_options()
+        if not self.options['REPLICAS']:
+            raise MiddlewareNotUsed
+        self.pins = caches[self.options['PIN_CACHE_ALIAS']]
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token = _read_alias.set(self.read_alias(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _read_alias.reset(token)
+        self.pin(request, response)
+        return response
+
+    async def __acall__(self, request):
+        token = _read_alias.set(self.read_alias(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _read_alias.reset(token)
+        self.pin(request, response)
+        return response
+
+    @staticmethod
+    def pin_key(request):
+        authorization = request.META.get('HTTP_AUTHORIZATION')
+        if not authorization:
+            return None
+        return 'db-pin:' + hashlib.sha1(authorization.encode()).hexdigest()
+
+    def read_alias(self, request):
+        if request.method not in SAFE_METHODS or self.options['PIN_COOKIE'] in request.COOKIES:
+            return None
+        key = self.pin_key(request)
+        if key is not None and self.pins.get(key):
+            return None
+        return random.choice(self.options['REPLICAS'])
+
+    def pin(self, request, response):
+        if request.method in SAFE_METHODS:
+            return
+        seconds = self.options['PIN_SECONDS']
+        response.set_cookie(self.options['PIN_COOKIE'], '1', max_age=seconds, httponly=True, samesite='Lax')
+        key = self.pin_key(request)
+        if key is not None:
+            self.pins.set(key, 1, seconds)
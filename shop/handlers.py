@@ -0,0 +1,63 @@
+'''
+ASGIHandler, который отдаёт StreamingHttpResponse, не блокируя event loop.
+
+Django 3.1 перебирает streaming_content прямо в event loop: генератор, который ходит
+в БД, падает с SynchronousOnlyOperation, а медленный генератор держит весь loop.
+Здесь каждый кусок берётся через sync_to_async(thread_sensitive=True) - в том же потоке,
+где работал sync view, т.е. с тем же соединением (и серверным курсором) - и сразу
+отправляется клиенту. Остальные ответы отдаются как в Django.
+'''
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler as BaseASGIHandler
+
+
+async def iterate_in_thread(iterable):
+    '''async-генератор поверх синхронного итератора: каждый next() - в sync-потоке'''
+    iterator = await sync_to_async(iter, thread_sensitive=True)(iterable)
+    get_next = sync_to_async(next, thread_sensitive=True)
+    done = object()
+    try:
+        while True:
+            part = await get_next(iterator, done)
+            if part is done:
+                break
+            yield part
+    finally:
+        # клиент отвалился - генератор закрываем там же, где он работал (курсор, соединение)
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=True)()
+
+
+class ASGIHandler(BaseASGIHandler):
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        # заголовки - как в BaseASGIHandler.send_response
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append((b'Set-Cookie', c.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+        async for part in iterate_in_thread(response):
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    '''как django.core.asgi.get_asgi_application, но с ASGIHandler отсюда'''
+    import django
+
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -0,0 +1,230 @@
+'''
+Замеры каждого запроса: SQL (кол-во, суммарное время, самые медленные), время view и рендера.
+
+На каждом соединении стоит одна execute_wrapper, она пишет в метрики текущего запроса
+из contextvar. Так SQL считается в любом потоке, где выполняется запрос: под ASGI sync view
+идёт в потоке sync_to_async, async view - в пуле main/async_views.py, contextvar виден и там,
+а чужие запросы в том же потоке не смешиваются. Обёртка только считает perf_counter
+и держит кучу из TOP_QUERIES самых медленных запросов (SQL без параметров, обрезанный) -
+поэтому можно держать включённым в проде.
+
+Результат:
+    - заголовок Server-Timing: db, view, render, total (если SERVER_TIMING) - только
+      для staff и при DEBUG, остальным незачем видеть устройство сервера
+    - строка JSON в лог shop.requests (уровень INFO)
+    - запросы дольше SLOW_MS или с числом SQL больше SLOW_QUERIES -
+      в лог shop.requests.slow (WARNING) вместе с самыми медленными SQL
+
+Для StreamingHttpResponse учитывается только время до начала отдачи.
+'''
+import asyncio
+import heapq
+import json
+import logging
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.functional import SimpleLazyObject, empty
+
+logger = logging.getLogger('shop.requests')
+slow_logger = logging.getLogger('shop.requests.slow')
+
+DEFAULT_SETTINGS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True,
+    'SLOW_MS': 500,
+    'SLOW_QUERIES': 50,
+    'TOP_QUERIES': 3,
+    'SQL_MAX_LENGTH': 300,
+}
+
+
+# метрики текущего запроса, None - вне запроса
+_current_metrics = ContextVar('request_metrics', default=None)
+
+
+def get_options():
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'REQUEST_TIMING', {}))
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def install_wrapper(connection, **kwargs):
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+def is_staff(request):
+    # ленивый request.user не вычисляем: под ASGI report() работает в event loop, там в БД нельзя.
+    # DRF после аутентификации кладёт в request.user уже готового пользователя
+    user = getattr(request, 'user', None)
+    if isinstance(user, SimpleLazyObject):
+        user = None if user._wrapped is empty else user._wrapped
+    return bool(getattr(user, 'is_staff', False))
+
+
+class RequestMetrics:
+    def __init__(self, top_queries, sql_max_length):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = []
+        self.top_queries = top_queries
+        self.sql_max_length = sql_max_length
+        self.view_started = None
+        self.view_finished = None
+        self.render_finished = None
+
+    def __call__(self, execute, sql, params, many, context):
+        '''execute_wrapper'''
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += duration
+            item = (duration, self.queries, sql)
+            if len(self.slowest) < self.top_queries:
+                heapq.heappush(self.slowest, item)
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def timings(self, finished):
+        '''мс: total, view, render, db'''
+        total = finished - self.started
+        view = render = 0.0
+        if self.view_started is not None:
+            view_finished = self.view_finished or finished
+            view = view_finished - self.view_started
+            if self.render_finished is not None:
+                render = self.render_finished - view_finished
+        return {
+            'total': round(total * 1000, 2),
+            'view': round(view * 1000, 2),
+            'render': round(render * 1000, 2),
+            'db': round(self.db_time * 1000, 2),
+        }
+
+    def slowest_queries(self):
+        return [{'ms': round(duration * 1000, 2), 'sql': sql[:self.sql_max_length]}
+                for duration, _, sql in sorted(self.slowest, reverse=True)]
+
+
+def server_timing(timings, queries):
+    return ', '.join([
+        f'db;dur={timings["db"]};desc="{queries} queries"',
+        f'view;dur={timings["view"]}',
+        f'render;dur={timings["render"]}',
+        f'total;dur={timings["total"]}',
+    ])
+
+
+class RequestTimingMiddleware:
+    '''ставить первым в MIDDLEWARE, чтобы total включал остальные middleware'''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.options = get_options()
+        if not self.options['ENABLED']:
+            raise MiddlewareNotUsed
+        # соединения потоков открываются позже, уже открытые - только в этом потоке
+        connection_created.connect(install_wrapper, dispatch_uid='request_timing')
+        for connection in connections.all():
+            install_wrapper(connection)
+        if asyncio.iscoroutinefunction(get_response):
+            # как в MiddlewareMixin: Django будет вызывать нас как корутину
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            # хуки тоже корутины, иначе Django гоняет каждый вызов через sync_to_async
+            self.process_view = self.process_view_async
+            self.process_template_response = self.process_template_response_async
+
+    def start(self, request):
+        metrics = RequestMetrics(self.options['TOP_QUERIES'], self.options['SQL_MAX_LENGTH'])
+        request._metrics = metrics
+        return metrics
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics = self.start(request)
+        token = _current_metrics.set(metrics)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            _current_metrics.reset(token)
+            raise
+        if asyncio.iscoroutine(response):
+            # Django 3.1.0: SecurityMiddleware не помечает себя async, и под ASGI
+            # цепочка ниже выглядит синхронной, но отдаёт корутину
+            return self.finish_async(request, response, metrics, token)
+        _current_metrics.reset(token)
+        self.report(request, response, metrics)
+        return response
+
+    async def __acall__(self, request):
+        metrics = self.start(request)
+        token = _current_metrics.set(metrics)
+        return await self.finish_async(request, self.get_response(request), metrics, token)
+
+    async def finish_async(self, request, response, metrics, token):
+        try:
+            response = await response
+        finally:
+            _current_metrics.reset(token)
+        self.report(request, response, metrics)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = getattr(request, '_metrics', None)
+        if metrics is not None:
+            metrics.view_started = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # DRF Response рендерится после view: отделяем время сериализации в JSON
+        metrics = getattr(request, '_metrics', None)
+        if metrics is not None:
+            metrics.view_finished = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: self.render_finished(metrics))
+        return response
+
+    async def process_view_async(self, request, view_func, view_args, view_kwargs):
+        return self.process_view(request, view_func, view_args, view_kwargs)
+
+    async def process_template_response_async(self, request, response):
+        return self.process_template_response(request, response)
+
+    @staticmethod
+    def render_finished(metrics):
+        metrics.render_finished = time.perf_counter()
+
+    def report(self, request, response, metrics):
+        timings = metrics.timings(time.perf_counter())
+        if self.options['SERVER_TIMING'] and (settings.DEBUG or is_staff(request)):
+            response['Server-Timing'] = server_timing(timings, metrics.queries)
+
+        slow = timings['total'] > self.options['SLOW_MS'] or metrics.queries > self.options['SLOW_QUERIES']
+        if not slow and not logger.isEnabledFor(logging.INFO):
+            return
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': metrics.queries,
+            **{f'{name}_ms': value for name, value in timings.items()},
+        }
+        logger.info(json.dumps(record))
+        if slow:
+            record['slowest'] = metrics.slowest_queries()
+            slow_logger.warning(json.dumps(record, ensure_ascii=False))
@@ -26,7 +26,7 @@ BASE_DIR = Path(__file__).resolve(strict=True).parent.parent
 SECRET_KEY = config('SECRET_KEY')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = config('DEBUG')
+DEBUG = config('DEBUG', cast=bool)
 
 ALLOWED_HOSTS = config('ALLOWED_HOSTS').split(',')
 
@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shop.instrumentation.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -59,6 +60,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # последним: ниже SecurityMiddleware цепочка под ASGI честно async
+    'shop.db_routers.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'shop.urls'
@@ -85,17 +88,49 @@ WSGI_APPLICATION = 'shop.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# DB_ENGINE=django.db.backends.sqlite3 - локально, DB_NAME тогда путь к файлу
+DB_ENGINE = config('DB_ENGINE', default='django.db.backends.postgresql')
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': DB_ENGINE,
         'NAME': config('DB_NAME'),
-        'USERNAME': config('DB_USER'),
-        'PASSWORD': config('DB_PASSWORD'),
-        'HOST': config('DB_HOST'),
-        'PORT': config('DB_PORT', cast=int),
+        'USER': config('DB_USER', default=''),
+        'PASSWORD': config('DB_PASSWORD', default=''),
+        'HOST': config('DB_HOST', default=''),
+        'PORT': config('DB_PORT', default=''),
+        # сек жизни соединения, 0 - новое на каждый запрос
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=0, cast=int),
     }
 }
 
+# реплики только для чтения, через запятую: host[:port] (для sqlite - путь к файлу).
+# Алиасы replica1, replica2...; CONN_MAX_AGE - DB_REPLICA_CONN_MAX_AGE
+# или REPLICA1_CONN_MAX_AGE для отдельной реплики
+DB_REPLICAS = config('DB_REPLICAS', default='')
+REPLICA_CONN_MAX_AGE = config('DB_REPLICA_CONN_MAX_AGE', default=DATABASES['default']['CONN_MAX_AGE'], cast=int)
+for number, address in enumerate(filter(None, map(str.strip, DB_REPLICAS.split(','))), 1):
+    alias = f'replica{number}'
+    replica = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    if DB_ENGINE.endswith('sqlite3'):
+        replica['NAME'] = address
+    else:
+        replica['HOST'], _, port = address.partition(':')
+        replica['PORT'] = port or replica['PORT']
+    replica['CONN_MAX_AGE'] = config(f'{alias.upper()}_CONN_MAX_AGE', default=REPLICA_CONN_MAX_AGE, cast=int)
+    DATABASES[alias] = replica
+
+DATABASE_ROUTERS = ['shop.db_routers.ReplicaRouter']
+
+# чтение с реплик, см. shop/db_routers.py
+DATABASE_ROUTING = {
+    'REPLICAS': [alias for alias in DATABASES if alias != 'default'],
+    # сколько секунд после записи клиент читает с primary
+    'PIN_SECONDS': config('DB_PIN_SECONDS', default=5, cast=int),
+    'PIN_COOKIE': 'db_primary',
+    'PIN_CACHE_ALIAS': config('DB_PIN_CACHE_ALIAS', default='default'),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -130,6 +165,12 @@ USE_L10N = True
 USE_TZ = True
 
 AUTH_USER_MODEL = 'account.User'
+
+# срок жизни одноразовых кодов (account.OneTimeCode), сек
+ONE_TIME_CODE_TTL = {
+    'activation': config('ACTIVATION_CODE_TTL', default=60 * 60 * 24, cast=int),
+    'password_reset': config('PASSWORD_RESET_CODE_TTL', default=60 * 60, cast=int),
+}
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
@@ -138,6 +179,15 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# уменьшенные копии картинок продуктов, см. main/images.py
+IMAGE_RENDITIONS = {
+    'SIZES': (200, 400, 800),
+    'FORMATS': ('webp', 'jpeg'),
+    'QUALITY': config('IMAGE_RENDITIONS_QUALITY', default=80, cast=int),
+    'WORKERS': config('IMAGE_RENDITIONS_WORKERS', default=2, cast=int),
+    'ASYNC': config('IMAGE_RENDITIONS_ASYNC', default=True, cast=bool),
+}
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_USE_TLS = True
@@ -145,10 +195,82 @@ EMAIL_PORT = 587
 EMAIL_HOST_USER = config('EMAIL_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_PASSWORD')
 
+# письма уходят через очередь OutgoingEmail, см. account/outbox.py
+EMAIL_OUTBOX = {
+    'IN_PROCESS': config('EMAIL_OUTBOX_IN_PROCESS', default=False, cast=bool),
+    'WORKERS': config('EMAIL_OUTBOX_WORKERS', default=4, cast=int),
+    'BATCH_SIZE': config('EMAIL_OUTBOX_BATCH_SIZE', default=100, cast=int),
+    'MAX_ATTEMPTS': config('EMAIL_OUTBOX_MAX_ATTEMPTS', default=5, cast=int),
+    'RETRY_DELAY': config('EMAIL_OUTBOX_RETRY_DELAY', default=30, cast=int),
+}
+
+# кэш ответов каталога: 'lru' - в памяти процесса, 'django' - кэш CACHES[ALIAS].
+# Версии (сброс кэша) всегда в CACHES[VERSIONS_ALIAS]: при нескольких воркерах
+# он ДОЛЖЕН быть общим (redis, memcached), иначе сброс увидит только свой процесс
+CATALOG_CACHE = {
+    'BACKEND': config('CATALOG_CACHE_BACKEND', default='lru'),
+    'ALIAS': config('CATALOG_CACHE_ALIAS', default='default'),
+    'VERSIONS_ALIAS': config('CATALOG_CACHE_VERSIONS_ALIAS', default='default'),
+    'TIMEOUT': config('CATALOG_CACHE_TIMEOUT', default=60, cast=int),
+    'MAX_ENTRIES': config('CATALOG_CACHE_MAX_ENTRIES', default=1000, cast=int),
+}
+
+# фасеты списка продуктов (products/?facets=...), см. main/facets.py
+PRODUCT_FACETS = {
+    # границы интервалов цены, клиент может передать свои в price_buckets
+    'PRICE_BUCKETS': (0, 100, 500, 1000, 5000),
+    'RATING_BANDS': (4, 3, 2, 1),
+    'MAX_PRICE_BUCKETS': 20,
+}
+
+# максимальный page_size, который клиент может запросить в keyset-пагинации
+MAX_PAGE_SIZE = config('MAX_PAGE_SIZE', default=100, cast=int)
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 5,
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'account.authentication.CachedTokenAuthentication',
     ]
-}
\ No newline at end of file
+}
+
+# кэш аутентификации по токену, см. account/authentication.py
+TOKEN_AUTH_CACHE = {
+    'MAX_ENTRIES': config('TOKEN_CACHE_MAX_ENTRIES', default=10000, cast=int),
+    'LOCAL_TIMEOUT': config('TOKEN_CACHE_LOCAL_TIMEOUT', default=60, cast=int),
+    'SHARED_ALIAS': config('TOKEN_CACHE_SHARED_ALIAS', default=None),
+    'SHARED_TIMEOUT': config('TOKEN_CACHE_SHARED_TIMEOUT', default=300, cast=int),
+    # поколения токенов проверяются на каждый запрос, при нескольких воркерах - общий кэш
+    'GENERATION_ALIAS': config('TOKEN_CACHE_GENERATION_ALIAS', default='default'),
+}
+
+# async view (main/async_views.py): потоков с соединением к БД и длина очереди до 503
+ASYNC_DB = {
+    'MAX_CONNECTIONS': config('ASYNC_DB_MAX_CONNECTIONS', default=10, cast=int),
+    'MAX_WAITING': config('ASYNC_DB_MAX_WAITING', default=1000, cast=int),
+}
+
+# замеры запросов (SQL, время view/рендера), см. shop/instrumentation.py
+REQUEST_TIMING = {
+    'ENABLED': config('REQUEST_TIMING_ENABLED', default=True, cast=bool),
+    'SERVER_TIMING': config('REQUEST_TIMING_SERVER_TIMING', default=True, cast=bool),
+    'SLOW_MS': config('SLOW_REQUEST_MS', default=500, cast=int),
+    'SLOW_QUERIES': config('SLOW_REQUEST_QUERIES', default=50, cast=int),
+    'TOP_QUERIES': 3,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # INFO - строка на каждый запрос, WARNING - только медленные
+        'shop.requests': {
+            'handlers': ['console'],
+            'level': config('REQUEST_LOG_LEVEL', default='WARNING'),
+            'propagate': False,
+        },
+    },
+}
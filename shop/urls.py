@@ -21,14 +21,25 @@ from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework.permissions import AllowAny
 from rest_framework.routers import SimpleRouter
-from main.views import ReviewViewSet, ProductViewSet, OrderViewSet
+from main import async_views
+from main.views import (CategoryViewSet, ReviewViewSet, ProductViewSet, OrderViewSet, WishListView,
+                        SalesSummaryView)
 
 
 router = SimpleRouter()
+router.register('categories', CategoryViewSet)
 router.register('products', ProductViewSet)
 router.register('reviews', ReviewViewSet)
 router.register('orders', OrderViewSet)
 
+# async варианты для запуска под shop/asgi.py, см. main/async_views.py
+async_urlpatterns = [
+    path('products/', async_views.product_list),
+    path('products/<int:pk>/', async_views.product_detail),
+    path('products/<int:pk>/like/', async_views.product_like),
+    path('orders/', async_views.order_list),
+]
+
 schema_view = get_schema_view(
     openapi.Info(
         title='My API',
@@ -42,6 +53,9 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/v1/', include(router.urls)),
+    path('api/v1/async/', include(async_urlpatterns)),
+    path('api/v1/me/wishlist/', WishListView.as_view()),
+    path('api/v1/analytics/sales/', SalesSummaryView.as_view()),
     path('api/v1/', include('account.urls')),
     path('api/v1/docs/', schema_view.with_ui('swagger')),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)